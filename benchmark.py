@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Import time of the `radio` scripting commands
+
+Runs each command in a fresh interpreter with ``python -X importtime`` and
+reports the total time spent importing modules, and which of the slow
+dependencies got imported. The commands run against a port where no server
+listens (with an empty $HOME, i.e. default settings), so they fail right
+after their imports.
+
+Usage: python benchmark.py [--repeat N]
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import socket
+import argparse
+import subprocess
+from shutil import rmtree
+from tempfile import mkdtemp
+
+COMMANDS = [
+    ['status', '--song', '--quiet'],
+    ['toggle'],
+    ['pause'],
+    ['stop'],
+    ['volume'],
+    ['play', 'lush'],
+]
+# dependencies the scripting commands should not import
+SLOW = ['bottle', 'PIL', 'pyfiglet', 'pylast', 'bs4', 'tty_radio.ui']
+RUN = ("import sys; from tty_radio.__main__ import radio; "
+       "radio(sys.argv[1:], prog_name='radio')")
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def import_times(cmd, env):
+    """Return total import time (in microseconds) and imported modules"""
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', RUN] + cmd, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (_, err) = proc.communicate()
+    total = 0
+    modules = set()
+    for line in err.decode('utf-8', 'replace').splitlines():
+        match = IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        (self_us, _, _, module) = match.groups()
+        total += int(self_us)
+        modules.add(module)
+    return (total, modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per command, the best one is reported')
+    args = parser.parse_args()
+    home = mkdtemp()
+    try:
+        with open(os.path.join(home, '.tty_radio-settings.ini'), 'w') as f:
+            f.write('[Server]\nport = %d\n' % free_port())
+        env = dict(os.environ)
+        env['HOME'] = home
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.abspath(__file__))] +
+            [p for p in [env.get('PYTHONPATH')] if p])
+        print("%-24s %10s  %s" % ('command', 'import ms', 'slow imports'))
+        for cmd in COMMANDS:
+            runs = [import_times(cmd, env) for i in range(args.repeat)]
+            (total, modules) = min(runs, key=lambda run: run[0])
+            slow = [m for m in SLOW if m in modules]
+            print("%-24s %10.1f  %s" % (
+                ' '.join(cmd), total / 1000.0, ', '.join(slow) or '-'))
+    finally:
+        rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
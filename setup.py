@@ -26,6 +26,7 @@ setup(
     entry_points={
         'console_scripts': [
             'radio = tty_radio.__main__:radio',
+            'radio-status = tty_radio.ipc:main',
         ]
     },
     include_package_data=True,
@@ -1,11 +1,62 @@
 #!/usr/bin/env python
 from time import sleep, time
-from json import loads
-from threading import Thread
+from json import loads, dumps
+from threading import Event, Thread, Timer
+import socket
+from contextlib import contextmanager
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.error import HTTPError
+import requests
+from io import BytesIO
+from random import Random
+from tempfile import mkdtemp
 import tty_radio.__main__
-from tty_radio.radio import Radio
-from tty_radio.stream import mpg_running
+from tty_radio.radio import (
+    Radio, StatusFeed, IDLE, STARTING, PLAYING, STOPPING)
+from tty_radio.stream import mpg_running, player_stats, LineSplitter
 from tty_radio.api import Server, Client
+from tty_radio.album import render_art, gen_art, GREYSCALE
+from tty_radio.cache import DiskCache, fetch
+from tty_radio.station import Favs, Station
+from tty_radio.ipc import StatusSocketServer, query
+from tty_radio.settings import Settings
+from tty_radio.meta import DEFAULT_RULES, rules_for
+from tty_radio.history import History
+from tty_radio.scrobble import Scrobbler, ScrobbleQueue, BACKOFF_MIN
+from tty_radio.notify import NotifyClient, Sink, FileSink
+from tty_radio.relay import Relay
+from tty_radio.icy import read_meta
+from tty_radio.playlist import parse as parse_playlist, PlaylistCache
+from tty_radio.nowplaying import NowPlaying, HostLimiter
+from tty_radio.stream import Stream
+
+
+@contextmanager
+def serve(handle):
+    """Serve HTTP on an ephemeral port of localhost, yield its base URL
+
+    Every GET and POST request is passed to `handle`, as the
+    BaseHTTPRequestHandler."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_request(self, code='-', size='-'):
+            pass
+
+        def do_GET(self):
+            handle(self)
+
+        do_POST = do_GET
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.daemon_threads = True
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        yield 'http://127.0.0.1:%d' % httpd.server_port
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
 
 
 def test_obj():  # noqa
@@ -71,6 +122,27 @@ def test_obj():  # noqa
     assert not r.set('favs', 'ewqrewrwer')
 
 
+def test_obj_switch():
+    """Check switching to a pretuned stream, with the old one playing on
+    until the new one takes over"""
+    r = Radio()
+    assert r.play('favs', 'BAGeL Radio')[1] is not None
+    assert r.pretune('favs', 'WCPE Classical') == 'WCPE Classical'
+    stats = player_stats()
+    assert stats['pretuned'] is not None
+    r.stop()  # a plain stop ends the playback, but keeps the pretuned stream
+    assert not mpg_running() and player_stats()['pretuned'] is not None
+    assert r.play('favs', 'BAGeL Radio')[1] is not None
+    r.request_stop()
+    assert r.play('favs', 'WCPE Classical')[1] == 'WCPE Classical'
+    stats = player_stats()
+    assert stats['pretuned_switches'] == 1 and mpg_running()
+    while player_stats()['switch_latency'] is None:
+        sleep(0.1)
+    r.stop()
+    assert not mpg_running()
+
+
 def test_api_serv():  # noqa
     r = Radio()
     s = Server('127.0.0.1', 7887, radio=r)
@@ -187,8 +259,720 @@ def test_api_client():  # noqa
     assert r
 
 
+class FakeStream(object):
+    """Records the actions of the Radio's worker, which wait for `gates`"""
+    def __init__(self, name, fail=False):
+        self.station = 'favs'
+        self.name = name
+        self.fail = fail
+        self.meta = self.meta_name = self.meta_song = None
+        self.calls = []
+        self.gates = {'play': Event(), 'pause': Event(), 'stop': Event()}
+        for gate in self.gates.values():
+            gate.set()
+
+    def play(self):
+        self.gates['play'].wait()
+        self.calls.append('play')
+        if self.fail:
+            raise IOError('no player')
+
+    def pause(self):
+        self.gates['pause'].wait()
+        self.calls.append('pause')
+
+    def stop(self, switching=False):
+        self.gates['stop'].wait()
+        self.calls.append('switch' if switching else 'stop')
+
+
+def fake_radio(stream):
+    r = Radio(history=History(size=3))
+    r._station = r.station_obj('favs')
+    r._stream = stream
+    return r
+
+
+def test_transitions():
+    """Check the order and the final state of queued transitions"""
+    # play, stop, play: the stop keeps the audio going for the next play
+    stream = FakeStream('Lush')
+    stream.gates['play'].clear()
+    r = fake_radio(stream)
+    ts = [r.request_play(), r.request_stop(), r.request_play()]
+    assert r.request_play() is None  # already starting
+    assert r.state == STARTING
+    stream.gates['play'].set()
+    assert ts[2].wait(5)
+    assert all(t.done.is_set() for t in ts)
+    assert stream.calls == ['play', 'switch', 'play']
+    assert r.state == PLAYING and r.transition(ts[0].id).error is None
+    # a transition superseded by a later one doesn't set the state
+    stream = FakeStream('Lush')
+    stream.gates['play'].clear()
+    stream.gates['stop'].clear()
+    r = fake_radio(stream)
+    (play, stop) = (r.request_play(), r.request_stop())
+    stream.gates['play'].set()
+    assert play.wait(5)
+    assert r.state == STOPPING
+    stream.gates['stop'].set()
+    assert stop.wait(5)
+    assert stream.calls == ['play', 'stop'] and r.state == IDLE
+    # a stop without anything playing is done right away
+    assert r.request_stop().done.is_set() and stream.calls == ['play', 'stop']
+    # a failed play ends idle, with the error in the transition
+    stream = FakeStream('Lush', fail=True)
+    r = fake_radio(stream)
+    t = r.request_play()
+    assert t.wait(5)
+    assert t.as_dict()['error'] == 'no player'
+    assert stream.calls == ['play', 'stop'] and r.state == IDLE
+
+
+def test_status_feed():
+    """Check waiting for status changes, and the events endpoint"""
+    feed = StatusFeed()
+    feed.notify()
+    t1 = time()
+    assert feed.wait(0, timeout=5) == 1  # stale: returns right away
+    assert time() - t1 < 1
+    assert feed.wait(1, timeout=0.2) == 1  # current: times out
+    assert time() - t1 >= 0.2
+    Timer(0.1, feed.notify).start()
+    assert feed.wait(1, timeout=5) == 2
+    assert time() - t1 < 1
+    # the same over HTTP, with the version in the ETag
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    r = fake_radio(FakeStream('Lush'))
+    s = Server('127.0.0.1', port, radio=r)
+    Thread(target=s.run, daemon=True).start()
+    assert s.wait_ready(5)
+    c = Client('127.0.0.1', port)
+    (version, status) = c.events()
+    assert version == r.feed.version and status['stream'] == 'Lush'
+    assert c.events(version, timeout=0.2) == (version, None)
+    Timer(0.1, r.feed.notify).start()
+    (version, status) = c.events(version, timeout=5)
+    assert version == r.feed.version and status['state'] == IDLE
+    resp = requests.get(
+        'http://127.0.0.1:%d/api/v1.1/player/events' % port,
+        headers={'If-None-Match': '"%d"' % version},
+        params={'timeout': 0.1})
+    assert resp.status_code == 304
+    assert resp.headers['ETag'] == '"%d"' % version
+    # play/pause/stop can wait for the transition, and report its error
+    assert c.play(wait=5) and r.state == PLAYING
+    assert c.stop(wait=5) and r.state == IDLE
+    r._stream = FakeStream('Lush', fail=True)
+    assert not c.play(wait=5)
+    assert r.state == IDLE
+
+
+def test_batch():
+    """Check that batch ops are validated before they run"""
+    s = Server('127.0.0.1', 7887, radio=Radio())
+    (success, results) = s._batch([
+        {'op': 'status'},
+        {'op': 'history', 'limit': 1},
+        {'op': 'stations', 'include': ['streams']},
+        {'op': 'volume', 'value': 11000},
+    ])
+    assert success and all(r['success'] for r in results)
+    assert results[1]['resp']['history'] == []
+    assert results[2]['resp']['stations'][0]['name'] == 'favs'
+    assert results[3]['resp'] == 'Setting volume to 11000'
+    invalid = [
+        ('x', 'Invalid op: not an object'),
+        ({'op': 'x'}, 'Invalid op: unknown op "x"'),
+        ({'op': ['play']}, 'Invalid op: invalid value of op'),
+        ({'op': 'stream', 'station': 'favs'},
+         'Invalid op: op stream needs argument stream'),
+        ({'op': 'stop', 'now': True},
+         'Invalid op: op stop has no argument now'),
+        ({'op': 'station', 'station': {}},
+         'Invalid op: invalid value of station'),
+        ({'op': 'streams', 'include': 1},
+         'Invalid op: invalid value of include'),
+        ({'op': 'history', 'limit': 'x'}, "Invalid history request: "
+         "invalid literal for int() with base 10: 'x'"),
+    ]
+    (success, results) = s._batch([op for (op, resp) in invalid])
+    assert not success
+    for (result, (op, resp)) in zip(results, invalid):
+        assert (result['success'], result['resp']) == (False, resp)
+
+
+def test_server_ready():
+    """Check that a server is ready once it listens, and not if another
+    process has its port"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    s = Server('127.0.0.1', sock.getsockname()[1], radio=Radio())
+
+    def run():
+        try:
+            s.run()
+        except SystemExit:  # cannot bind
+            pass
+
+    Thread(target=run, daemon=True).start()
+    assert not s.wait_ready(5)
+    sock.close()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    s = Server('127.0.0.1', port, radio=Radio())
+    Thread(target=s.run, daemon=True).start()
+    assert s.wait_ready(5)
+    assert Client('127.0.0.1', port).status() is not None
+
+
 def test_radio_config():
     """Check that `radio config` docstring and actual default settings match"""
     tty_radio.__main__._config_from_docstr(
         tty_radio.__main__.config.__doc__,
         check_against_default=True)
+
+
+def test_render_art():
+    """Check that ascii art has the right shape and a seed reproduces it"""
+    from PIL import Image
+    img = BytesIO()
+    Image.linear_gradient('L').resize((400, 300)).save(img, 'PNG')
+    art = render_art(img.getvalue(), 80, 60, rng=Random(42))
+    lines = art.split("\n")
+    assert len(lines) == 29 and all(len(line) == 78 for line in lines)
+    assert set(lines[0]) <= set(GREYSCALE[-1] + GREYSCALE[-2])  # black
+    assert lines[-1].strip() == ""  # white
+    assert art == render_art(img.getvalue(), 80, 60, rng=Random(42))
+
+
+def test_disk_cache():
+    """Check revalidation, LRU eviction, and offline hits of rendered art"""
+    from PIL import Image
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from functools import partial
+    root = mkdtemp()
+    Image.linear_gradient('L').save(root + '/art.png')
+    requests_seen = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def log_request(self, code='-', size='-'):
+            requests_seen.append(code)
+
+    httpd = HTTPServer(
+        ('127.0.0.1', 0), partial(Handler, directory=root))
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/art.png' % httpd.server_port
+    cache = DiskCache(10 * 1024 * 1024, path=root + '/cache')
+    data = fetch(url, cache)
+    assert fetch(url, cache) == data
+    assert [int(c) for c in requests_seen] == [200, 304]
+    art = gen_art(url, 80, 60, cache=cache)
+    httpd.shutdown()
+    httpd.server_close()
+    assert gen_art(url, 80, 60, cache=cache) == art  # no network needed
+    small = DiskCache(6000, path=root + '/small')
+    small.put('a', b'a' * 2000)
+    small.put('b', b'b' * 2000)
+    small.get('a')  # a is now more recently used than b
+    small.put('c', b'c' * 2000)
+    assert small.get('b') == (None, None)
+    assert small.get('a')[0] == b'a' * 2000
+    assert small.get('c')[0] == b'c' * 2000
+    # a server error after a successful fetch returns the cached copy
+
+    def handle(request):
+        codes.append(500 if codes else 200)
+        request.send_response(codes[-1])
+        request.end_headers()
+        request.wfile.write(b'page %d' % codes[-1])
+
+    codes = []
+    cache = DiskCache(100000, path=mkdtemp())
+    with serve(handle) as url:
+        assert fetch(url + '/page', cache) == b'page 200'
+        assert fetch(url + '/page', cache) == b'page 200'
+        assert codes == [200, 500]
+        try:
+            fetch(url + '/other')
+        except HTTPError as e:
+            assert e.code == 500
+        else:
+            assert False, 'no HTTPError without a cached copy'
+
+
+def test_station_index():
+    """Check stream lookup by name/URL, and reloading a changed file"""
+    import os
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = mkdtemp()
+    try:
+        favs = Favs()
+    finally:
+        os.environ['HOME'] = home
+    lush = favs.stream_obj('Lush')
+    assert lush.url == 'http://ice.somafm.com/lush'
+    assert favs.stream_by_url('http://ice.somafm.com/lush') is lush
+    assert favs.stream_obj('No such stream') is None
+    assert not favs.reload()
+    strs = favs.stream_strs
+    with open(favs.file, 'a') as f:
+        f.write('http://example.com/new,New Stream,desc,http://x.com/a.png\n')
+    os.utime(favs.file, (time() + 10, time() + 10))
+    assert favs.reload()
+    assert favs.stream_obj('New Stream').url == 'http://example.com/new'
+    assert favs.stream_strs != strs
+
+
+def test_station_refresh():
+    """Check that a stale station file is served while it is rebuilt, and
+    kept if the rebuild fails"""
+    import os
+    builds = []
+
+    class Flaky(Station):
+        def build_file(self):
+            builds.append(time())
+            if len(builds) == 1:
+                raise IOError('network down')
+            self.refresh_warnings.append("couldn't get a page")
+            with open(self.file, 'w') as f:
+                f.write('http://example.com/new,New,desc,http://x.com/a.png')
+
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = mkdtemp()
+    try:
+        fname = os.path.join(os.environ['HOME'], '.tty_radio-flaky.csv')
+        with open(fname, 'w') as f:
+            f.write('http://example.com/old,Old,desc,http://x.com/a.png')
+        os.utime(fname, (0, 0))
+        st = Flaky('flaky')
+    finally:
+        os.environ['HOME'] = home
+    assert st.stream_obj('Old') is not None  # served while refreshing
+    for i in range(50):
+        if st.refresh_status != 'running' and len(builds) > 0:
+            break
+        sleep(0.1)
+    assert st.refresh_status == 'failed'
+    assert st.refresh_info()['error'] == 'network down'
+    assert st.stream_obj('Old') is not None
+    assert not st.revalidate()  # waiting to retry
+    assert st.refresh()
+    info = st.refresh_info()
+    assert info['age'] < 10 and info['warnings'] == ["couldn't get a page"]
+    assert st.stream_obj('New') is not None and st.stream_obj('Old') is None
+
+
+def test_status_socket():
+    """Check the line protocol of the status socket"""
+    path = mkdtemp() + '/status.sock'
+    server = StatusSocketServer(path, {'song': lambda args: 'Song %s' % args})
+    server.start()
+    try:
+        assert query('song', path) == "Song []"
+        assert query('song stream', path) == "Song ['stream']"
+        assert query('nonsense', path).startswith('error')
+    finally:
+        server.close()
+    assert query('song', path) is None
+
+
+def test_line_splitter():
+    """Check filtering, decoding and the length cap of player output"""
+    splitter = LineSplitter(prefixes=('@I ICY-', '@P'), max_line=100)
+    assert splitter.feed(b'@F 1 2 3\n@I ICY-NAME: Caf\xc3\xa9') == []
+    assert splitter.feed(b'\n@I ICY-NAME: Caf\xe9\n@P 0\n') == [
+        u'@I ICY-NAME: Caf\xe9', u'@I ICY-NAME: Caf\xe9', u'@P 0']
+    lines = splitter.feed(b'@I ICY-META: ' + b'x' * 1000)
+    assert len(lines) == 1 and len(lines[0]) == 100
+    assert splitter.feed(b'x' * 1000 + b'\n@P 1\n') == [u'@P 1']
+
+
+def test_parse_meta():
+    """Check parsing of ICY metadata into artist and title"""
+    meta = DEFAULT_RULES.parse_song(
+        "StreamTitle='Stone Soup Soldiers - Pharaoh's Tears; Part 2';"
+        "StreamUrl='http://SomaFM.com/suburbsofgoa/';", timestamp=1)
+    assert meta.artist == "Stone Soup Soldiers"
+    assert meta.title == "Pharaoh's Tears; Part 2"
+    assert meta.url == 'http://SomaFM.com/suburbsofgoa/'
+    meta = DEFAULT_RULES.parse_song(u"StreamTitle='A \u2013 B';")
+    assert (meta.song, meta.artist, meta.title) == (u"A \u2013 B", "A", "B")
+    meta = DEFAULT_RULES.parse_song("StreamTitle='Commercial-free - SomaFM';")
+    assert meta.song is not None and meta.artist is None
+    assert DEFAULT_RULES.parse_song("StreamTitle='';") is None
+    for metadata in ("StreamTitle='Foo - Bar';adw_ad='true';",
+                     "StreamTitle='Foo - Bar'",
+                     "StreamTitle='Foo - Bar';\0\0\0\0",
+                     "StreamTitle='Foo - Bar'\0\0"):
+        meta = DEFAULT_RULES.parse_song(metadata)
+        assert (meta.artist, meta.title) == ('Foo', 'Bar'), metadata
+    meta = DEFAULT_RULES.parse_song(
+        "StreamTitle='It''s - A; B';StreamUrl='http://x/'\0")
+    assert (meta.song, meta.url) == ("It''s - A; B", 'http://x/')
+    # DEF CON is hidden only on its own stream
+    assert DEFAULT_RULES.parse_name("Default Radio") == "Default Radio"
+    for url in ('http://ice.somafm.com/defcon',
+                'http://ice1.somafm.com/defcon-128-mp3',
+                'https://ice4.somafm.com/defcon-256-mp3'):
+        rules = rules_for(url, DEFAULT_RULES)
+        assert rules.parse_name("DefCon Radio (SomaFM)") == '', url
+    rules = rules_for('http://ice1.somafm.com/lush-128-mp3', DEFAULT_RULES)
+    assert rules is DEFAULT_RULES
+
+
+def test_history():
+    """Check the song history ring buffer and its rotated log"""
+    logfile = mkdtemp() + '/history.log'
+    history = History(size=3, logfile=logfile, max_size=200, backups=1)
+    for i in range(5):
+        meta = DEFAULT_RULES.parse_song(
+            "StreamTitle='Artist - Song %d';" % i, timestamp=10 * i)
+        history.start('favs', 'Lush', meta)
+    history.end(45)
+    (tracks, total) = history.tracks()
+    assert total == 3 and [t['title'] for t in tracks] == [
+        'Song 2', 'Song 3', 'Song 4']
+    assert tracks[-1]['end'] == 45
+    (tracks, total) = history.tracks(since=40, limit=1)
+    assert total == 1 and tracks[0]['title'] == 'Song 4'
+    with open(logfile) as f:
+        assert loads(f.readlines()[-1])['title'] == 'Song 4'
+    with open(logfile + '.1') as f:
+        assert loads(f.readline())['title'] == 'Song 2'
+
+
+class FakeLastfm(object):
+    """Stand-in for pylast.LastFMNetwork, offline for the first `down`
+    requests"""
+    def __init__(self, down=0):
+        self.down = down
+        self.batches = []
+        self.now_playing = []
+
+    def _request(self):
+        if self.down > 0:
+            self.down -= 1
+            raise IOError('offline')
+
+    def update_now_playing(self, artist, title):
+        self._request()
+        self.now_playing.append((artist, title))
+
+    def scrobble_many(self, tracks):
+        self._request()
+        self.batches.append(tracks)
+
+
+def test_scrobbler():
+    """Check that scrobbles are batched, and persist while offline"""
+    path = mkdtemp() + '/scrobbles.jsonl'
+    lastfm = FakeLastfm(down=1)
+    scrobbler = Scrobbler(
+        lambda renew=False: lastfm, ScrobbleQueue(path), log=str)
+    for i in range(120):
+        scrobbler.queue.put('Artist', 'Song %d' % i, 1000 + i)
+    assert not scrobbler.step()
+    assert scrobbler.backoff == BACKOFF_MIN
+    # a restart keeps the queue
+    scrobbler = Scrobbler(
+        lambda renew=False: lastfm, ScrobbleQueue(path), log=str)
+    assert len(scrobbler.queue) == 120
+    assert scrobbler.step(now_playing=('Artist', 'Song 120'))
+    assert lastfm.now_playing == [('Artist', 'Song 120')]
+    assert [len(batch) for batch in lastfm.batches] == [50, 50, 20]
+    assert lastfm.batches[2][-1]['title'] == 'Song 119'
+    assert scrobbler.backoff == 0 and len(ScrobbleQueue(path)) == 0
+
+
+class LastfmError(Exception):
+    """Like pylast.WSError"""
+    def __init__(self, status, details):
+        super(LastfmError, self).__init__(details)
+        self.status = status
+
+    def get_id(self):
+        return self.status
+
+
+class HttpLastfm(object):
+    """The part of pylast.LastFMNetwork the Scrobbler uses, for a stand-in
+    of the Last.fm API at `url`"""
+    def __init__(self, url):
+        self.url = url
+
+    def _request(self, method, params):
+        params = dict(params, method=method)
+        resp = requests.post(self.url, data=params, timeout=5)
+        error = re.search(r'<error code="(\d+)">([^<]*)<', resp.text)
+        if error is not None:
+            raise LastfmError(error.group(1), error.group(2))
+
+    def update_now_playing(self, artist, title):
+        self._request(
+            'track.updateNowPlaying', {'artist': artist, 'track': title})
+
+    def scrobble_many(self, tracks):
+        params = {}
+        for (i, track) in enumerate(tracks):
+            params['artist[%d]' % i] = track['artist']
+            params['track[%d]' % i] = track['title']
+            params['timestamp[%d]' % i] = track['timestamp']
+        self._request('track.scrobble', params)
+
+
+def test_scrobbler_errors():
+    """Check that only rejected scrobbles are dropped, and that temporary
+    Last.fm errors are retried"""
+    errors = []  # error codes of the next responses
+    scrobbled = []
+
+    def handle(request):
+        body = request.rfile.read(int(request.headers['Content-Length']))
+        params = parse_qs(body.decode('utf-8'))
+        request.send_response(200)
+        request.end_headers()
+        if len(errors) > 0:
+            request.wfile.write(
+                b'<lfm status="failed"><error code="%s">Error</error></lfm>'
+                % errors.pop(0).encode('ascii'))
+            return
+        scrobbled.extend(v[0] for (k, v) in sorted(params.items())
+                         if k.startswith('track['))
+        request.wfile.write(b'<lfm status="ok"></lfm>')
+
+    renewed = []
+
+    def connect(renew=False):
+        renewed.append(renew)
+        return lastfm
+
+    with serve(handle) as url:
+        lastfm = HttpLastfm(url)
+        scrobbler = Scrobbler(
+            connect, ScrobbleQueue(mkdtemp() + '/scrobbles.jsonl'), log=str)
+        for i in range(60):
+            scrobbler.queue.put('Artist', 'Song %d' % i, 1000 + i)
+        for code in ('11', '16', '29', '9'):  # all temporary
+            errors.append(code)
+            assert not scrobbler.step()
+            assert len(scrobbler.queue) == 60
+        assert scrobbler.backoff == 8 * BACKOFF_MIN
+        errors.append('6')  # the first batch is rejected
+        assert scrobbler.step()
+        assert renewed == [False, False, False, False, True]
+        assert len(scrobbler.queue) == 0 and len(scrobbled) == 10
+        assert scrobbler.backoff == 0
+        # new scrobbles don't cut a backoff short
+        errors.append('16')
+        scrobbler.queue.put('Artist', 'Song 60', 1060)
+        assert not scrobbler.step()
+        scrobbler.start()
+        scrobbler.scrobble('Artist', 'Song 61', 1061)
+        sleep(0.3)
+        assert len(scrobbled) == 10 and len(scrobbler.queue) == 2
+
+
+def test_sinks():
+    """Check that rapid status changes are coalesced by notification sinks"""
+
+    class ListSink(Sink):
+        def __init__(self, **kwargs):
+            super(ListSink, self).__init__(**kwargs)
+            self.payloads = []
+
+        def send(self, payload):
+            self.payloads.append(payload)
+
+    path = mkdtemp() + '/song'
+    sinks = [ListSink(debounce=0.1, log=str),
+             FileSink(path, debounce=0.1, log=str)]
+    for sink in sinks:
+        sink.start()
+    for i in range(10):
+        status = {'currently_streaming': True, 'paused': False,
+                  'stream': 'Lush', 'song': 'Artist - Song %d' % i}
+        for sink in sinks:
+            sink.update(status)
+    sleep(0.5)
+    assert sinks[0].payloads == ['Lush\nArtist - Song 9']
+    assert sinks[0].coalesced == 9 and 0.1 <= sinks[0].latency < 0.5
+    s = Server('127.0.0.1', 7887, radio=Radio())
+    s.notify_client = NotifyClient(Settings(read_file=False))
+    s.notify_client.sinks = sinks
+    resp = loads(s.sinks())['resp']['sinks']
+    assert [(r['name'], r['sent']) for r in resp] == [('sink', 1), ('file', 1)]
+    with open(path) as f:
+        assert f.read() == 'Lush\nArtist - Song 9\n'
+
+
+def test_relay():
+    """Check that a relay strips the ICY metadata, and fans out the audio"""
+    audio = bytes(bytearray(range(250))) * 4
+    meta = b"StreamTitle='Artist - Title';"
+    block = bytearray([2]) + meta.ljust(32, b'\0')
+
+    def handle(request):
+        request.send_response(200)
+        request.send_header('icy-metaint', '100')
+        request.send_header('icy-name', 'Test Radio')
+        request.end_headers()
+        for i in range(0, len(audio), 100):
+            # blocks split across writes, too
+            request.wfile.write(audio[i:i + 100] + block[:10])
+            request.wfile.flush()
+            sleep(0.01)
+            request.wfile.write(block[10:])
+        sleep(1)
+
+    with serve(handle) as url:
+        relay = Relay(url + '/lush').start()
+        lines = []
+        relay.subscribe(lines.append)
+        listeners = [relay.listen(), relay.listen()]
+        for listener in listeners:
+            data = b''
+            while len(data) < len(audio):
+                data += next(listener)
+            assert data == audio
+            listener.close()
+    assert lines == ['ICY-NAME: Test Radio',
+                     "ICY-META: StreamTitle='Artist - Title';"]
+    assert relay.listeners == 0
+
+
+def test_read_meta():
+    """Check reading only the metadata of a stream, given a playlist"""
+
+    def handle(request):
+        request.send_response(200)
+        if request.path.endswith('.pls'):
+            request.end_headers()
+            request.wfile.write(playlist.encode('ascii'))
+            return
+        request.send_header('icy-metaint', '1000')
+        request.end_headers()
+        for i in range(4):
+            meta = b"StreamTitle='Artist - Song %d';" % (i // 2)
+            request.wfile.write(b'x' * 1000 + b'\2' + meta.ljust(32, b'\0'))
+        request.wfile.write(b'x' * 1000 + b'\0')
+
+    with serve(handle) as url:
+        playlist = '[playlist]\nNumberOfEntries=2\nFile1=%s/stream\n' % url
+        playlist += 'Title1=Stream\nFile2=http://127.0.0.1:1/backup\n'
+        assert parse_playlist(playlist) == [
+            url + '/stream', 'http://127.0.0.1:1/backup']
+        assert list(read_meta(url + '/radio.pls')) == [
+            "ICY-META: StreamTitle='Artist - Song 0';",
+            "ICY-META: StreamTitle='Artist - Song 1';"]
+    # the fallback reader ends once the player reports titles itself
+    lines = []
+    stream = Stream('soma', 'Lush', url + '/stream', '', '', lines.append)
+    stream._meta_timer = Timer(60, stream._start_meta_reader)
+    stream._start_meta_reader()
+    stream._meta_reader.reader("ICY-META: StreamTitle='Artist - Song 0';")
+    assert stream._meta_reader is not None
+    stream.reader("ICY-META: StreamTitle='Artist - Song 1';")
+    assert stream._meta_reader is None and stream._meta_timer is None
+    assert stream.meta_song == 'Artist - Song 1'
+    assert len(lines) == 2
+
+
+def test_now_playing():
+    """Check a sweep over 40 streams, with a limit of connections per host"""
+    active = []
+
+    def handle(request):
+        active.append(request.path)
+        request.send_response(200)
+        request.send_header('icy-metaint', '16000')
+        request.end_headers()
+        sleep(0.1)  # connecting to a remote server
+        meta = b"StreamTitle='Artist - Song%s';" % request.path.encode()
+        request.wfile.write(b'x' * 16000 + b'\3' + meta.ljust(48, b'\0'))
+        active.append(None)
+
+    def most_active():
+        (count, most) = (0, 0)
+        for path in list(active):
+            count += 1 if path is not None else -1
+            most = max(most, count)
+        return most
+
+    with serve(handle) as url:
+        streams = [Stream('soma', 'Stream %d' % i, '%s/%d' % (url, i),
+                          '', '', None) for i in range(40)]
+        now_playing = NowPlaying(
+            lambda: streams, limiter=HostLimiter(concurrency=8, interval=0.01))
+        t1 = time()
+        now_playing.sweep()
+        assert time() - t1 < 2
+        assert now_playing.get(streams[7])['title'] == 'Song/7'
+        assert all(now_playing.get(stm) is not None for stm in streams)
+        assert most_active() <= 8
+        now_playing.sweep()  # nothing to do
+    assert len(active) == 80
+    # SomaFM titles come from its channel list, in a single request
+    channels = {'channels': [
+        {'id': 'lush', 'lastPlaying': "Sade - No Ordinary Love"},
+        {'id': 'defcon', 'lastPlaying': "Robot's - Hack"}]}
+    del active[:]
+
+    def handle(request):
+        active.append(request.path)
+        request.send_response(200)
+        request.end_headers()
+        request.wfile.write(dumps(channels).encode())
+
+    with serve(handle) as url:
+        streams = [
+            Stream('soma', 'Lush', 'http://ice1.somafm.com/lush-128-mp3',
+                   '', '', None),
+            Stream('soma', 'DEF CON', 'http://ice.somafm.com/defcon',
+                   '', '', None),
+            Stream('soma', 'Gone', 'http://ice.somafm.com/gone', '', '', None)]
+        now_playing = NowPlaying(
+            lambda: streams, channels=url + '/channels.json')
+        now_playing.sweep()
+        assert active == ['/channels.json']
+        assert now_playing.get(streams[0])['artist'] == 'Sade'
+        assert now_playing.get(streams[1])['title'] == 'Hack'
+        assert now_playing.get(streams[2]) is None
+
+
+def test_playlist_cache():
+    """Check that playlists are resolved once, with failover"""
+
+    def handle(request):
+        request.send_response(200)
+        request.end_headers()
+        request.wfile.write(playlist.encode('ascii'))
+
+    playlist = '[playlist]\nFile1=http://a/1\nFile2=http://b/2\n'
+    disk = DiskCache(100000, path=mkdtemp())
+    playlists = PlaylistCache(disk)
+    with serve(handle) as url:
+        url += '/radio.pls'
+        assert playlists.urls('http://a/1') == ['http://a/1']
+        assert playlists.urls(url) == ['http://a/1', 'http://b/2']
+        playlists.failed(url, 'http://a/1')
+        assert playlists.urls(url) == ['http://b/2', 'http://a/1']
+        assert playlists.fetches == 1
+        # kept on disk
+        playlists = PlaylistCache(disk, ttl=0.2)
+        assert playlists.urls(url) == ['http://b/2', 'http://a/1']
+        playlists.succeeded(url, 'http://a/1')
+        assert playlists.urls(url)[0] == 'http://a/1'
+        assert playlists.fetches == 0
+    # fetched again after the ttl, but used if that fails
+    sleep(0.3)
+    assert playlists.urls(url) == ['http://a/1', 'http://b/2']
+    assert playlists.fetches == 1
@@ -6,30 +6,45 @@ import json
 import re
 import configparser
 from textwrap import dedent
-from time import sleep
+from contextlib import contextmanager
 from shutil import copyfile
 from threading import Thread
 
 import requests
 import click
 
-from .ui import ui as start_ui
-from .api import Server, Client, ApiConnError
-from .color import load_theme
+# The scripting commands (status, play, ...) only need the Client. The UI
+# and server modules import slow dependencies (bottle, PIL, pyfiglet, bs4),
+# and are imported in `main`.
+from .client import Client, ApiConnError, TRANSITION_WAIT
 from .settings import Settings, _check_volume
+from .ipc import query
 from .notify import NotifyClient, _render_song_str
-from .stream import Stream
 
 
 __version__ = '2.0.0'
+# seconds to wait for the server to accept connections
+SERVER_START_TIMEOUT = 10
 
 
 def main(do_ui, theme=None, vol=None, scrobble=None):
+    from .ui import ui as start_ui
+    from .api import Server
+    from .color import load_theme
+    from .stream import Stream
+    from .radio import Radio
+    from .history import History
     try:
         settings = Settings(theme=theme, vol=vol, scrobble=scrobble)
         Stream.vol = settings.config['Server']['volume']
         host = settings.config['Server']['host']
         port = settings.config['Server']['port']
+        backend = settings.config['Server']['backend']
+        status_socket = settings.config['Server']['status_socket']
+        relay = settings.config['Server'].getboolean('relay')
+        history = History(
+            settings.config['Server'].getint('history_size'),
+            settings.config['Server']['history_logfile'])
         if do_ui:
             load_theme(settings)
     except (ValueError, TypeError) as exc_info:
@@ -38,7 +53,9 @@ def main(do_ui, theme=None, vol=None, scrobble=None):
 
     try:
         # is there a server running already?
-        Client(host, port).status()  # raises ApiConnError if no server running
+        # raises ApiConnError if no server running
+        with Client(host, port, retries=0) as client:
+            client.status()
         if not do_ui:
             click.echo("Server already running")
             sys.exit(1)
@@ -47,18 +64,23 @@ def main(do_ui, theme=None, vol=None, scrobble=None):
         sys.exit(1)
     except ApiConnError:
         # no server running ...
-        s = Server(host, port)
+        s = Server(
+            host, port, radio=Radio(history=history), backend=backend,
+            status_socket=status_socket, relay=relay)
         # ... start server in background thread
         server_thread = Thread(target=s.run)
         server_thread.daemon = True
         server_thread.start()
-        sleep(1.0)
+        if not s.wait_ready(SERVER_START_TIMEOUT):
+            click.echo("Server did not start")
+            sys.exit(1)
         # run notify-client in background (always together with server)
         try:
             notify_client = NotifyClient(settings)
         except ValueError as exc_info:
             click.echo("Cannot start notify-thread: %s" % exc_info)
             sys.exit(1)
+        s.notify_client = notify_client
         notify_thread = Thread(
             name='notify_client', target=notify_client.run)
         notify_thread.daemon = True
@@ -175,8 +197,13 @@ def ui(theme, vol, scrobble):
     main(do_ui=True, theme=theme, vol=vol, scrobble=scrobble)
 
 
+@contextmanager
 def _get_client(quiet=False):
-    """Get Client instance, for the scripting interface commands"""
+    """Context with a Client instance, for the scripting interface commands
+
+    Exits if the server cannot be reached. There is no separate probe for a
+    running server, so each command only makes the requests it needs.
+    """
     try:
         settings = Settings()
         host = settings.config['Server']['host']
@@ -186,7 +213,7 @@ def _get_client(quiet=False):
         sys.exit(1)
     client = Client(host, port)
     try:
-        client.status()
+        yield client
     except requests.exceptions.RequestException as exc_info:
         if not quiet:
             click.echo("Error connecting to server: %s" % exc_info)
@@ -195,21 +222,24 @@ def _get_client(quiet=False):
         if not quiet:
             click.echo("Cannot connect to server")
         sys.exit(1)
-    return client
+    finally:
+        client.close()
 
 
 @radio.command()
 def pause():
     """Pause playback."""
-    client = _get_client()
-    client.pause()
+    with _get_client() as client:
+        if not client.pause(wait=TRANSITION_WAIT):
+            sys.exit(1)
 
 
 @radio.command()
 def stop():
     """Stop playback."""
-    client = _get_client()
-    client.stop()
+    with _get_client() as client:
+        if not client.stop(wait=TRANSITION_WAIT):
+            sys.exit(1)
 
 
 def _find_station(stations, search_str, station):
@@ -238,30 +268,42 @@ def play(station, search):
     streams are searched for a matching stream name (case-insensitive, ignoring
     whitespace).
     """
-    client = _get_client()
-    stream = None
-    if len(search) > 0:
-        search_str = "".join(search)
-        stations = client.stations()
-        try:
-            station, stream = _find_station(stations, search_str, station)
-        except TypeError:
-            if station is None:
-                click.echo(
-                    "Cannot find a stream matching '%s'" % search_str)
-            else:
-                click.echo(
-                    "Cannot find a stream matching '%s' in station '%s'"
-                    % (search_str, station))
+    with _get_client() as client:
+        stream = None
+        if len(search) > 0:
+            search_str = "".join(search)
+            results = client.batch([{'op': 'stations'}, {'op': 'status'}])
+            if results is None:
+                sys.exit(1)
+            stations = results[0]['resp']['stations']
+            status = results[1]['resp']
+            try:
+                station, stream = _find_station(stations, search_str, station)
+            except TypeError:
+                if station is None:
+                    click.echo(
+                        "Cannot find a stream matching '%s'" % search_str)
+                else:
+                    click.echo(
+                        "Cannot find a stream matching '%s' in station '%s'"
+                        % (search_str, station))
+                sys.exit(1)
+            click.echo("Playing station: %s" % stream)
+        else:
+            status = client.status()
+        if stream is None and status['stream'] is None:
+            click.echo("No active stream. Specify a stream name")
+            sys.exit(1)
+        ops = []
+        if not status['paused'] or status['currently_streaming']:
+            ops.append({'op': 'stop'})
+        ops.append({'op': 'play', 'station': station, 'stream': stream})
+        results = client.batch(ops)
+        if results is None or not results[-1]['success']:
+            click.echo('API request failure: %s' % results)
+            sys.exit(1)
+        if not client.check_transition(results[-1]['transition']):
             sys.exit(1)
-        click.echo("Playing station: %s" % stream)
-    status = client.status()
-    if not status['paused'] or status['currently_streaming']:
-        client.stop()
-    if stream is None and status['stream'] is None:
-        click.echo("No active stream. Specify a stream name")
-        sys.exit(1)
-    client.play(station, stream)
 
 
 @radio.command()
@@ -273,22 +315,53 @@ def play(station, search):
     help='Print the current stream name. In combination with --song, two '
     'lines may be printed (stream name on the first line, song title on '
     'the second line)')
+@click.option(
+    '--sinks', is_flag=True,
+    help='Print the delivery metrics of the notification sinks (number of '
+    'updates sent, coalesced and failed, and their latency)')
 @click.option(
     '--quiet', is_flag=True, help='Fail silenty if no server is running')
-def status(song, stream, quiet):
+def status(song, stream, sinks, quiet):
     """Print the player status.
 
     ``radio status --song --quiet`` is useful to generate a string to be shown
-    in a UI element.
+    in a UI element. For frequent queries, the `radio-status` command is
+    faster.
     """
-    client = _get_client(quiet=quiet)
-    status = client.status()
+    if sinks:
+        with _get_client(quiet=quiet) as client:
+            click.echo(json.dumps(client.sinks()))
+        return
+    answer = _query_status_socket(song, stream)
+    if answer is not None:
+        click.echo(answer)
+        return
+    with _get_client(quiet=quiet) as client:
+        status = client.status()
+        if song:
+            click.echo(_render_song_str(status, show_stream=stream))
+        elif stream:
+            click.echo(status['stream'])
+        else:
+            click.echo(json.dumps(status))
+
+
+def _query_status_socket(song, stream):
+    """Answer of the server's status socket, or None if unavailable"""
+    try:
+        path = Settings().config['Server']['status_socket']
+    except (ValueError, TypeError):
+        return None
+    if not path:
+        return None
     if song:
-        click.echo(_render_song_str(status, show_stream=stream))
-    elif stream:
-        click.echo(status['stream'])
+        command = 'song stream' if stream else 'song'
     else:
-        click.echo(json.dumps(status))
+        command = 'stream' if stream else 'status'
+    try:
+        return query(command, path)
+    except AttributeError:  # no Unix domain sockets
+        return None
 
 
 @radio.command()
@@ -298,18 +371,18 @@ def status(song, stream, quiet):
 )
 def stations(print_json):
     """List available stations and feeds"""
-    client = _get_client()
-    stations = client.stations()
-    if print_json:
-        click.echo(json.dumps(stations))
-    else:
-        for s in stations:
-            click.echo("")
-            title = "%s (%s)" % (s['ui_name'], s['name'])
-            click.echo(title)
-            click.echo("-" * len(title))
-            for stream in s['streams']:
-                click.echo(stream)
+    with _get_client() as client:
+        stations = client.stations()
+        if print_json:
+            click.echo(json.dumps(stations))
+        else:
+            for s in stations:
+                click.echo("")
+                title = "%s (%s)" % (s['ui_name'], s['name'])
+                click.echo(title)
+                click.echo("-" * len(title))
+                for stream in s['streams']:
+                    click.echo(stream)
 
 
 @click.option(
@@ -317,18 +390,20 @@ def stations(print_json):
 @radio.command()
 def toggle(stop):
     """Toggle between play/pause."""
-    client = _get_client()
-    status = client.status()
-    if status['stream'] is None:
-        click.echo("Not tuned into a stream")
-        return
-    if status['paused'] or not status['currently_streaming']:
-        client.play()
-    else:
-        if stop:
-            client.stop()
+    with _get_client() as client:
+        status = client.status()
+        if status['stream'] is None:
+            click.echo("Not tuned into a stream")
+            return
+        if status['paused'] or not status['currently_streaming']:
+            success = client.play(wait=TRANSITION_WAIT)
         else:
-            client.pause()
+            if stop:
+                success = client.stop(wait=TRANSITION_WAIT)
+            else:
+                success = client.pause(wait=TRANSITION_WAIT)
+        if not success:
+            sys.exit(1)
 
 
 @radio.command()
@@ -347,52 +422,54 @@ def volume(value, reset, format):
     """Show or adjust the volume.
 
     If called without arguments, print the current volume and exit. The volume
-    can be changed by passing a --value, or --reset. Changing the volume stops
-    and re-starts any active stream.
+    can be changed by passing a --value, or --reset. Changing the volume takes
+    effect immediately, without interrupting any active stream.
 
     If --format is not specified, the format of --value will be autodetected
     """
-    client = _get_client()
-    status = client.status()
-    if reset:
-        settings = Settings()
-        value = _check_volume(settings.config['Server']['volume'])
-        format = 'int'
-    if value is not None:
-        input_format = format
-        if input_format is None:
-            try:
-                input_format = _get_volume_input_format(value)
-            except (ValueError, TypeError):
-                click.echo("Invalid value: %s" % value)
-                sys.exit(1)
-        if input_format == 'float':
-            value = int(float(value) * 32000)
-        elif input_format == 'percent':
-            if value.endswith('%'):
-                value = value[:-1]
-            value = int(float(value) * 320)
-        if value != status['volume']:
-            client.volume(value)
-            if status['currently_streaming']:
-                client.stop()
-                client.play()
-            status = client.status()
-    value = status['volume']
-    float_str = str(float(value)/32000.0)
-    int_str = str(int(value))
-    percent_str = str(int(float(value)/320)) + "%"
-    if reset:
-        format = None
-    if format == 'float':
-        value_str = float_str
-    elif format == 'int':
-        value_str = int_str
-    elif format == 'percent':
-        value_str = percent_str
-    else:
-        value_str = "%s / %s / %s" % (int_str, float_str, percent_str)
-    click.echo(value_str)
+    with _get_client() as client:
+        status = client.status()
+        if reset:
+            settings = Settings()
+            value = _check_volume(settings.config['Server']['volume'])
+            format = 'int'
+        if value is not None:
+            input_format = format
+            if input_format is None:
+                try:
+                    input_format = _get_volume_input_format(value)
+                except (ValueError, TypeError):
+                    click.echo("Invalid value: %s" % value)
+                    sys.exit(1)
+            if input_format == 'float':
+                value = int(float(value) * 32000)
+            elif input_format == 'percent':
+                if value.endswith('%'):
+                    value = value[:-1]
+                value = int(float(value) * 320)
+            if value != status['volume']:
+                results = client.batch(
+                    [{'op': 'volume', 'value': value}, {'op': 'status'}])
+                if results is None:
+                    sys.exit(1)
+                if not results[0]['success']:
+                    click.echo('API request failure: %s' % results[0])
+                status = results[1]['resp']
+        value = status['volume']
+        float_str = str(float(value)/32000.0)
+        int_str = str(int(value))
+        percent_str = str(int(float(value)/320)) + "%"
+        if reset:
+            format = None
+        if format == 'float':
+            value_str = float_str
+        elif format == 'int':
+            value_str = int_str
+        elif format == 'percent':
+            value_str = percent_str
+        else:
+            value_str = "%s / %s / %s" % (int_str, float_str, percent_str)
+        click.echo(value_str)
 
 
 def _config_from_docstr(docstring, check_against_default=True):
@@ -446,10 +523,19 @@ def config(write, default, backup):
         [Server]                      ; Settings for the server
         host = 127.0.0.1              ; Network address to bind to
         port = 7887                   ; Network port to bind to
+        backend = threaded            ; Server backend (see notes)
+        status_socket = ~/.tty_radio-status.sock  ; Status queries (see notes)
+        relay = no                    ; Relay the streams (see notes)
         volume = 11000                ; The default volume (0..32k)
         scrobble = no                 ; Send scrobbles to Last.fm?
         notify_logfile =              ; Log file for srobbles/notifications
+        history_size = 500            ; Number of songs kept in the history
+        history_logfile =             ; Log file of all songs played
         update_btt_widget = no        ; Update any BetterTouchTool widget?
+        desktop_notify = no           ; Desktop notification for new songs?
+        status_file =                 ; File (or FIFO) to write the song to
+        webhook_url =                 ; URL to POST status changes to
+        notify_debounce = 0.25        ; Seconds to wait for further changes
 
         \b
         [UI]                          ; Settings for the terminal UI
@@ -490,6 +576,7 @@ def config(write, default, backup):
             whimsy, xbritebi, xcourbi
         #
         show_stream_ascii_art = yes   ; Render stream img in ascii (pillow)?
+        art_cache_size = 10           ; Max. MB of cached stream art (0: off)
 
         \b
         [theme_miami_vice]            ; Settings for colortheme 'miami_vice'
@@ -551,12 +638,43 @@ def config(write, default, backup):
           The host 0.0.0.0 binds to all available interfaces, and thus allows
           remote clients, and remote access to the web interface.
 
+        * The 'threaded' backend handles each request in its own thread.
+          Alternatively, the name of any server adapter supported by bottle
+          may be given, e.g. 'waitress' or 'aiohttp' (asyncio), provided the
+          corresponding package is installed. The 'wsgiref' backend handles
+          one request at a time, which delays clients waiting for events.
+
+        * The server answers simple status queries on the Unix domain socket
+          `status_socket` (leave empty to disable). The `radio-status`
+          command queries it without reading the config file; set
+          $TTY_RADIO_SOCKET if you change the path.
+
+        * Notifications (BTT widget, desktop, status_file, webhook_url) are
+          sent in the background; status changes within `notify_debounce`
+          seconds are combined into one update. The notify_logfile shows how
+          long each update took.
+
+        * With relay = yes, the server opens one connection per stream, and
+          serves it to the player, and to any other listener, at
+          http://<host>:<port>/relay/<station>/<stream>. Several machines
+          can then share one upstream connection, by playing the relayed
+          stream (e.g. with `mpg123 http://<host>:<port>/relay/favs/Lush`).
+          Relay mode doesn't work with the 'wsgiref' backend.
+
+        * Playlist (.pls, .m3u) stream URLs are resolved once a day, and kept
+          in ~/.tty_radio-cache/playlists. If a stream URL of a playlist
+          fails, the next one is played.
+
         * You must register at https://www.last.fm/api/account/create to get
           the Last.fm API key and shared secret.
 
         * The Last.fm password hash should be optained with the Python command
           `import pylast; pylast.md5("your_password")`
 
+        * Scrobbles that could not be sent to Last.fm (e.g. while offline) are
+          kept in ~/.tty_radio-scrobbles.jsonl, and sent once Last.fm is
+          reachable again.
+
         * The BTT shared secret is an optional setting in the "Advanced
           Settings" in BetterTouchTool ("General" tab)
 
@@ -5,58 +5,91 @@ if platform.python_version().startswith('3'):
     PY3 = True
 from bisect import bisect
 from io import BytesIO
-from random import choice
+from os import urandom
+import socket
 if PY3:
-    from urllib.request import urlopen, URLError
+    from urllib.request import URLError
 else:
-    from urllib2 import urlopen, URLError
+    from urllib2 import URLError
+
+from .cache import fetch
+
 PYPILLOW = True
 try:
-    from PIL import Image
+    from PIL import Image, ImageChops
 except ImportError:
     PYPILLOW = False
     print("Hey-o, you don't have image manipulation libs installed:")
     print("  pip install pillow")
 
 
-def gen_art(url, term_w, term_h):
+# greyscale.. the following strings represent
+# 7 tonal ranges, from lighter to darker.
+# for a given pixel tonal level, choose a character
+# at random from that range.
+GREYSCALE = [" ",
+             " ",
+             "-",      # ".,-",
+             "=~+*",   # "_ivc=!/|\\~",
+             "[]()",   # "gjez2]/(YL)t[+T7Vf",
+             "mdbwz",  # "mdK4ZGbNDXY5P*Q",
+             "WKMA",
+             "#@$&"    # "#%$"
+             ]
+
+# using the bisect class to put luminosity values
+# in various ranges.
+# these are the luminosity cut-off points for each
+# of the 7 tonal levels. At the moment, these are 7 bands
+# of even width, but they could be changed to boost
+# contrast or change gamma, for example.
+ZONEBOUNDS = [36, 72, 108, 144, 180, 216, 252]
+
+# The whole image is mapped to characters at once: each pixel becomes a
+# byte band * 32 + r, where band is its tonal range and r is a random
+# number 0..31. A single 256-byte translation table maps that byte to a
+# glyph of the band.
+BAND_LUT = [32 * bisect(ZONEBOUNDS, 255 - val) for val in range(256)]
+RAND_LUT = [val % 32 for val in range(256)]
+GLYPHS = bytes(bytearray(
+    ord(GREYSCALE[val // 32][(val % 32) % len(GREYSCALE[val // 32])])
+    for val in range(256)))
+
+
+def gen_art(url, term_w, term_h, rng=None, cache=None):
     # Creates an ascii art image from an arbitrary image
     # orig author: Steven Kay 7 Sep 2009
     # mod by x0rion Feb 2014
     # print("Printing ASCII Art for " + url)
+    # If a DiskCache is given, rendered art is reused without any network
+    # traffic, and downloaded images are revalidated instead of re-fetched
     if not PYPILLOW:
         return
-
-    # greyscale.. the following strings represent
-    # 7 tonal ranges, from lighter to darker.
-    # for a given pixel tonal level, choose a character
-    # at random from that range.
-    greyscale = [" ",
-                 " ",
-                 "-",      # ".,-",
-                 "=~+*",   # "_ivc=!/|\\~",
-                 "[]()",   # "gjez2]/(YL)t[+T7Vf",
-                 "mdbwz",  # "mdK4ZGbNDXY5P*Q",
-                 "WKMA",
-                 "#@$&"    # "#%$"
-                 ]
-
-    # using the bisect class to put luminosity values
-    # in various ranges.
-    # these are the luminosity cut-off points for each
-    # of the 7 tonal levels. At the moment, these are 7 bands
-    # of even width, but they could be changed to boost
-    # contrast or change gamma, for example.
-
-    zonebounds = [36, 72, 108, 144, 180, 216, 252]
+    key = 'art:%s:%d:%d' % (url, term_w, term_h)
+    if cache is not None:
+        (art, meta) = cache.get(key)
+        if art is not None:
+            return art.decode('ascii')
 
     # open image and resize
     try:
-        image = urlopen(url).read()
-    except URLError:
+        image = fetch(url, cache)
+    except (URLError, ValueError, OSError, socket.timeout):
+        # socket.timeout is not an OSError on Python 2
         print("Warning: couldn't retrieve file" + url)
         return
+    art = render_art(image, term_w, term_h, rng=rng)
+    if cache is not None:
+        cache.put(key, art.encode('ascii'))
+    return art
+
+
+def render_art(image, term_w, term_h, rng=None):
+    """Render the (encoded) `image` data as ascii art for the terminal size
 
+    The glyph for each pixel is chosen at random from its tonal range. Pass
+    a seeded `random.Random` instance as `rng` for reproducible output.
+    """
     im = Image.open(BytesIO(image))
     w, h = im.size
 
@@ -77,14 +110,19 @@ def gen_art(url, term_w, term_h):
     im = im.resize((im_width, im_height), Image.BILINEAR)
     im = im.convert("L")  # convert to mono
 
-    # now, work our way over the pixels
-    # build up str
-    str_ = ""
-    for y in range(0, im.size[1]):
-        for x in range(0, im.size[0]):
-            lum = 255 - im.getpixel((x, y))
-            row = bisect(zonebounds, lum)
-            str_ = str_ + choice(greyscale[row])
-        if y != (im.size[1] - 1):
-            str_ = str_ + "\n"
-    return str_
+    # map all pixels to glyphs in one go, then join the rows once
+    bands = im.point(BAND_LUT)
+    noise = Image.frombytes(
+        "L", im.size, _random_bytes(im_width * im_height, rng))
+    chars = ImageChops.add(bands, noise.point(RAND_LUT)).tobytes()
+    chars = chars.translate(GLYPHS).decode('ascii')
+    return "\n".join(
+        chars[i:i + im_width] for i in range(0, len(chars), im_width))
+
+
+def _random_bytes(n, rng=None):
+    if rng is None:
+        return urandom(n)
+    if PY3:
+        return rng.getrandbits(8 * n).to_bytes(n, 'little')
+    return bytes(bytearray(rng.getrandbits(8) for i in range(n)))
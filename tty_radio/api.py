@@ -4,24 +4,45 @@ PY3 = False
 if platform.python_version().startswith('3'):
     PY3 = True
 import json
-import requests
 import sys
 import os
+import socket
+from time import sleep
+from threading import Event, RLock, Thread
+from uuid import uuid4
+from wsgiref.simple_server import WSGIServer
+import requests
 from bottle import (
     run,
     route, post, put, delete,
-    request,  # response, hook
+    request, response,  # hook
 )
 if PY3:
     from urllib.parse import unquote
+    from socketserver import ThreadingMixIn
 else:
     from urllib import unquote
+    from SocketServer import ThreadingMixIn
 
-from .radio import Radio
-from .stream import Stream
+from .radio import Radio, STARTING, PLAYING
+from .stream import Stream, player_stats
+from .ipc import StatusSocketServer
+from .relay import RelayHub
+from .nowplaying import NowPlaying
+from .notify import _render_song_str
+# the Client lives in its own module, so that scripts using it don't need to
+# import the server's dependencies; it remains importable from here
+from .client import (  # noqa: F401
+    Client, ApiConnError, EVENTS_TIMEOUT)
 
 
 BOTTLE_DEBUG = False
+# maximum seconds a long-poll for player events is held open
+EVENTS_TIMEOUT_MAX = 300
+# maximum seconds a request may wait for a transition to finish
+TRANSITION_WAIT_MAX = 30
+# seconds between checks whether a starting server accepts connections
+READY_POLL_INTERVAL = 0.01
 
 
 def load_request(possible_keys):
@@ -33,19 +54,72 @@ def load_request(possible_keys):
     return pdata
 
 
-class ApiConnError(BaseException):
-    pass
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """WSGIServer handling each request in its own thread
+
+    Required for long-polling: a held-open events request must not block
+    all other requests.
+    """
+    daemon_threads = True
 
 
 class Server(object):
-    def __init__(self, host, port, radio=None):
+    # operations that may be combined in a batch request, with their
+    # (required, optional) arguments
+    batch_ops = {
+        'status': ((), ()),
+        'station': (('station', ), ()),
+        'stations': ((), ('include', )),
+        'stream': (('station', 'stream'), ()),
+        'streams': ((), ('station', 'include')),
+        'history': ((), ('since', 'limit', 'offset')),
+        'set': (('station', ), ('stream', )),
+        'play': ((), ('station', 'stream')),
+        'pretune': ((), ('station', 'stream')),
+        'volume': (('value', ), ()),
+        'pause': ((), ()),
+        'stop': ((), ()),
+    }
+
+    def __init__(self, host, port, radio=None, backend='threaded',
+                 status_socket=None, relay=False):
         self.host = host
         self.port = port
+        self.backend = backend
+        # relay mode: one upstream connection per stream, served to the
+        # player and other listeners at /relay/<station>/<stream>
+        self.relay = relay
+        # path of a Unix domain socket for status queries (see ipc module)
+        self.status_socket = status_socket
+        self._status_server = None
         self.radio = radio
         if radio is None:
             self.radio = Radio()
+        # serializes changes of the player (batches run atomically). Read-only
+        # requests do not take it. Play/pause/stop only queue a transition of
+        # the radio and return its id, so no request waits for mpg123
+        self._lock = RLock()
+        self._catalogue = None
+        self._catalogue_key = None
+        # the NotifyClient running alongside the server, for the metrics of
+        # its sinks
+        self.notify_client = None
+        # titles of all streams, sampled while clients ask for them
+        self.now_playing = NowPlaying(self._all_streams)
+        # set once the server accepts connections, or failed to start
+        self.is_ready = False
+        self._started = Event()
+        # identifies this server to _watch_ready
+        self._token = uuid4().hex
 
     def run(self):
+        if self.relay and self.backend == 'wsgiref':
+            # the player's request for /relay would wait for the end of the
+            # request it is part of
+            print("SERVER ERROR: relay mode needs a backend that handles "
+                  "requests concurrently, not 'wsgiref'.")
+            print("Check the backend and relay settings in config")
+            sys.exit(1)
         # UI Functions
         route('/')(self.frontend)
         # route('/', method='OPTIONS')(self.options_handler)
@@ -77,18 +151,136 @@ class Server(object):
         route('/api/v1.1/streams/<station>')(self.streams)
         route('/api/v1.1/streams/<station>/<stream>')(self.stream)
         route('/api/v1.1/player')(self.status)
+        route('/api/v1.1/player/events')(self.events)
+        route('/api/v1.1/transitions/<tid>')(self.transition)
+        route('/api/v1.1/history')(self.history)
+        route('/api/v1.1/sinks')(self.sinks)
         post('/api/v1.1/player')(self.play)
         post('/api/v1.1/player/<station>/<stream>')(self.play)
+        post('/api/v1.1/pretune')(self.pretune)
+        post('/api/v1.1/pretune/<station>/<stream>')(self.pretune)
         post('/api/v1.1/volume/<value>')(self.volume)
         put('/api/v1.1/player')(self.pause)
         delete('/api/v1.1/player')(self.stop)
+        post('/api/v1.1/batch')(self.batch)
+        if self.relay:
+            route('/api/v1.1/relays')(self.relays)
+            route('/relay/<station>/<stream>')(self.relay_stream)
+            Stream.relay = RelayHub(
+                'http://%s/relay' % self._connect_netloc())
+        # 'threaded' is wsgiref with a thread per request, any other backend
+        # is a bottle server adapter (e.g. 'wsgiref' handles one request at a
+        # time, 'aiohttp' is asyncio based, 'waitress' is a thread pool)
+        server = self.backend
+        options = {}
+        if server == 'threaded':
+            server = 'wsgiref'
+            options['server_class'] = self._ready_class(ThreadingWSGIServer)
+        elif server == 'wsgiref':
+            options['server_class'] = self._ready_class(WSGIServer)
+        else:
+            # no hook into the setup of other backends
+            route('/api/v1.1/ready/<token>')(self.ready)
+            watcher = Thread(target=self._watch_ready, name='server_ready')
+            watcher.daemon = True
+            watcher.start()
+        if self.status_socket:
+            self._start_status_socket()
         try:
-            run(host=self.host, port=self.port,
-                debug=BOTTLE_DEBUG, quiet=not BOTTLE_DEBUG)
+            run(host=self.host, port=self.port, server=server,
+                debug=BOTTLE_DEBUG, quiet=not BOTTLE_DEBUG, **options)
         except (OSError, OverflowError) as exc_info:
             print("SERVER ERROR: %s." % exc_info)
             print("Check network settings (host, port) in config")
             sys.exit(1)
+        except (ImportError, AttributeError) as exc_info:
+            print("SERVER ERROR: cannot use backend '%s': %s."
+                  % (self.backend, exc_info))
+            print("Check the backend setting in config")
+            sys.exit(1)
+        finally:
+            self._started.set()
+            if self._status_server is not None:
+                self._status_server.close()
+
+    def _start_status_socket(self):
+        self._status_server = StatusSocketServer(self.status_socket, {
+            'status': self._socket_status,
+            'song': self._socket_song,
+            'stream': self._socket_stream,
+        })
+        try:
+            self._status_server.start()
+        except (socket.error, AttributeError) as exc_info:
+            # AttributeError: no Unix domain sockets on this platform
+            print("Warning: cannot listen on status socket %s: %s" %
+                  (self.status_socket, exc_info))
+            self._status_server = None
+
+    def _socket_status(self, args):
+        return json.dumps(self.status_dict())
+
+    def _socket_song(self, args):
+        return _render_song_str(
+            self.status_dict(), show_stream=('stream' in args))
+
+    def _socket_stream(self, args):
+        return str(self.radio.stream)
+
+    def _connect_host(self):
+        # address for connecting to the server from this machine
+        if self.host in ('', '0.0.0.0'):
+            return '127.0.0.1'
+        elif self.host == '::':
+            return '::1'
+        return self.host
+
+    def _connect_netloc(self):
+        # host:port for URLs of the server, from this machine
+        host = self._connect_host()
+        if ':' in host:
+            host = '[%s]' % host  # IPv6 literal
+        return '%s:%s' % (host, self.port)
+
+    def _ready_class(self, server_class):
+        # server_class, telling the Server once it listens on its socket
+        server = self
+
+        class ReadyServer(server_class):
+            def server_activate(self):
+                server_class.server_activate(self)
+                server.is_ready = True
+                server._started.set()
+
+        return ReadyServer
+
+    def _watch_ready(self):
+        # wait until this server answers, not just any process that
+        # listens on the port
+        url = 'http://%s/api/v1.1/ready/%s' % (
+            self._connect_netloc(), self._token)
+        while not self._started.is_set():
+            try:
+                resp = requests.get(url, timeout=1.0)
+                if resp.json()['success']:
+                    self.is_ready = True
+                    self._started.set()
+                    return
+            except (requests.RequestException, ValueError, KeyError):
+                pass
+            sleep(READY_POLL_INTERVAL)
+
+    def ready(self, token):
+        return reply(token == self._token, 'ready')
+
+    def wait_ready(self, timeout=None):
+        """Block until the server accepts connections
+
+        Returns False if the server failed to start, or did not start within
+        `timeout` seconds.
+        """
+        self._started.wait(timeout)
+        return self.is_ready
 
 
     # def enable_cors(self):
@@ -115,28 +307,105 @@ class Server(object):
     def index(self):
         success = True
         resp = 'TTY Radio API is running'
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+        return reply(success, resp)
+
+    def status_dict(self):
+        status = self.radio.snapshot()
+        status['volume'] = Stream.vol
+        status['player'] = player_stats()
+        return status
+
+    def _status(self):
+        return (True, self.status_dict())
 
     def status(self):
+        return reply(*self._status())
+
+    def events(self):
+        """Long-poll for a change of the player status
+
+        The client sends the last status version it has seen as an
+        If-None-Match header (or `version` query parameter). The request
+        returns the status as soon as its version differs, with the new
+        version in the ETag header. Without a change within `timeout`
+        seconds (query parameter), the response is 304 Not Modified.
+        """
+        seen = request.headers.get('If-None-Match')
+        if seen is None:
+            seen = request.query.get('version')
+        try:
+            seen = int(str(seen).strip('"'))
+        except ValueError:
+            seen = None
+        try:
+            timeout = float(request.query.get('timeout', EVENTS_TIMEOUT))
+        except ValueError:
+            timeout = EVENTS_TIMEOUT
+        timeout = min(max(timeout, 0), EVENTS_TIMEOUT_MAX)
+        version = self.radio.feed.wait(seen, timeout)
+        response.set_header('ETag', '"%d"' % version)
+        if version == seen:
+            response.status = 304
+            return ''
         success = True
+        resp = self.status_dict()
+        return json.dumps(
+            {'success': success, 'resp': resp, 'version': version}) + '\n'
+
+    def transition(self, tid):
+        """Report on the play/pause/stop transition with the id `tid`
+
+        With the `wait` query parameter, wait up to that many seconds for
+        the transition to finish.
+        """
+        try:
+            t = self.radio.transition(int(tid))
+        except ValueError:
+            t = None
+        if t is None:
+            return reply(False, 'Unknown transition %s' % tid)
+        try:
+            wait = float(request.query.get('wait', 0))
+        except ValueError:
+            wait = 0
+        wait = min(max(wait, 0), TRANSITION_WAIT_MAX)
+        if wait > 0:
+            t.wait(wait)
+        return reply(True, t.as_dict())
+
+    def _history(self, since=None, limit=None, offset=0):
+        try:
+            if since is not None:
+                since = float(since)
+            if limit is not None:
+                limit = max(int(limit), 0)
+            offset = max(int(offset), 0)
+        except (ValueError, TypeError) as exc_info:
+            return (False, 'Invalid history request: %s' % exc_info)
+        (tracks, total) = self.radio.history.tracks(since, limit, offset)
         resp = {
-            'currently_streaming': self.radio.is_playing,
-            'paused': self.radio.is_paused,
-            'station': self.radio.station,
-            'stream': self.radio.stream,
-            'song': self.radio.song,
-            'volume': Stream.vol,
+            'history': tracks,
+            'total': total,
         }
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+        return (True, resp)
 
-    # TODO incl streams w/ station data
-    def station(self, station):
-        station = unquote(station)
+    def history(self):
+        """Recently played songs, oldest first
+
+        Query parameters: `since` (epoch seconds, only songs playing after
+        that time), `limit` and `offset` (for paging through the results).
+        """
+        return reply(*self._history(
+            request.query.get('since'), request.query.get('limit'),
+            request.query.get('offset', 0)))
+
+    def _station(self, station):
         success = False
         name = None
         ui_n = None
         file = None
         rebuild = None
+        refresh = None
         found_st = self.radio.station_obj(station)
         if found_st is not None:
             success = True
@@ -144,28 +413,24 @@ class Server(object):
             ui_n = found_st.ui_name
             file = found_st.file
             rebuild = found_st.rebuild
+            refresh = found_st.refresh_info()
         resp = {
             'name': name,
             'ui_name': ui_n,
             'file': file,
             'rebuild': rebuild,
+            'refresh': refresh,
         }
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+        return (success, resp)
 
-    def stream(self, station, stream):
-        station_search = unquote(station)
-        stream = unquote(stream)
+    # TODO incl streams w/ station data
+    def station(self, station):
+        return reply(*self._station(unquote(station)))
+
+    def _stream(self, station, stream):
         success = False
-        station = None
-        name = None
-        url = None
-        desc = None
-        art = None
-        meta_name = None
-        meta_song = None
-        is_playing = None
-        is_paused = None
-        found_stn = self.radio.station_obj(station_search)
+        resp = stream_dict(None)
+        found_stn = self.radio.station_obj(station)
         if found_stn is not None:
             # print('fstn %s' % found_stn)
             # print('searching %s' % stream)
@@ -173,87 +438,211 @@ class Server(object):
             if found_stm is not None:
                 # print('fstm %s' % found_stm)
                 success = True
-                station = found_stm.station
-                name = found_stm.name
-                url = found_stm.url
-                desc = found_stm.desc
-                art = found_stm.art
-                meta_name = found_stm.meta_name
-                meta_song = found_stm.meta_song
-                is_playing = found_stm.is_playing
-                is_paused = found_stm.is_paused
-        resp = {
-            'station': station,
-            'name': name,
-            'url': url,
-            'desc': desc,
-            'art': art,
-            'meta_name': meta_name,
-            'meta_song': meta_song,
-            'is_playing': is_playing,
-            'is_paused': is_paused,
-        }
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+                resp = stream_dict(found_stm)
+        return (success, resp)
 
-    # TODO incl streams w/ station data
-    def stations(self):
+    def stream(self, station, stream):
+        return reply(*self._stream(unquote(station), unquote(stream)))
+
+    def relay_stream(self, station, stream):
+        found_stn = self.radio.station_obj(unquote(station))
+        found_stm = None
+        if found_stn is not None:
+            found_stm = found_stn.stream_obj(unquote(stream))
+        if found_stm is None:
+            response.status = 404
+            return 'No such stream\n'
+        relay = Stream.relay.relay(found_stm.url)
+        response.content_type = 'audio/mpeg'
+        response.set_header('Cache-Control', 'no-cache')
+        if relay.name is not None:
+            response.set_header('icy-name', relay.name)
+        return relay.listen()
+
+    def _relays(self):
+        success = True
+        resp = {'relays': Stream.relay.stats()}
+        return (success, resp)
+
+    def relays(self):
+        return reply(*self._relays())
+
+    def _sinks(self):
+        sinks = []
+        if self.notify_client is not None:
+            for sink in self.notify_client.sinks:
+                stats = sink.stats()
+                stats['name'] = sink.name
+                sinks.append(stats)
         success = True
+        resp = {'sinks': sinks}
+        return (success, resp)
+
+    def sinks(self):
+        """Delivery metrics of the notification sinks (see `notify.Sink`)"""
+        return reply(*self._sinks())
+
+    def _stations(self, include=()):
+        success = True
+        if len(include) == 0:
+            stations = self.radio.stations
+        elif 'meta' not in include and 'now_playing' not in include:
+            # without metadata, the expanded view only changes with the
+            # station files
+            key = (tuple(include), self.radio.catalogue_key)
+            if key != self._catalogue_key:
+                self._catalogue = self._stations_view(include)
+                self._catalogue_key = key
+            stations = self._catalogue
+        else:
+            stations = self._stations_view(include)
         resp = {
-            'stations': self.radio.stations
+            'stations': stations
         }
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+        return (success, resp)
 
-    def streams(self, station=None):
-        if station is not None:
-            station = unquote(station)
+    def _stations_view(self, include):
+        stations = []
+        with_meta = 'meta' in include
+        for st in self.radio._stations:
+            if 'streams' in include:
+                streams = [stream_dict(stm, with_meta) for stm in st.streams]
+                if 'now_playing' in include:
+                    for (stream, stm) in zip(streams, st.streams):
+                        stream['now_playing'] = self._now_playing(stm)
+            else:
+                streams = [stm.name for stm in st.streams]
+            station = {
+                'name': st.name,
+                'ui_name': st.ui_name,
+                'streams': streams}
+            if 'now_playing' in include and 'streams' not in include:
+                station['now_playing'] = [
+                    self._now_playing(stm) for stm in st.streams]
+            if with_meta:
+                station['file'] = st.file
+                station['rebuild'] = st.rebuild
+                station['refresh'] = st.refresh_info()
+            stations.append(station)
+        return stations
+
+    def stations(self):
+        """List all stations
+
+        The `include` query parameter may contain a comma-separated list of
+        'streams' (full stream details instead of only their names),
+        'meta' (station files, their age and refresh status, and current
+        stream metadata) and 'now_playing' (the current song of each
+        stream, see `streams`), to get the entire catalogue in a single
+        request.
+        """
+        include = _split(request.query.get('include', ''))
+        return reply(*self._stations(include))
+
+    def _all_streams(self):
+        streams = []
+        for st in self.radio._stations:
+            streams.extend(st.streams)
+        return streams
+
+    def _now_playing(self, stm):
+        # the stream that is playing knows its title best
+        if stm.is_playing and stm.meta is not None:
+            return stm.meta.as_dict()
+        return self.now_playing.get(stm)
+
+    def _streams(self, station=None, include=()):
+        self.radio.reload()
         streams = []
+        now_playing = []
         for st in self.radio._stations:
             if station is None or st.name == station:
-                streams_str = [str(s) for s in st.streams]
-                streams.extend(streams_str)
+                streams.extend(st.stream_strs)
+                if 'now_playing' in include:
+                    now_playing.extend(
+                        self._now_playing(stm) for stm in st.streams)
         success = True
-        if (station is not None and
-                station not in [st.name for st in self.radio._stations]):
+        if station is not None and self.radio.station_obj(station) is None:
             success = False
         resp = {
             'streams': streams
         }
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+        if 'now_playing' in include:
+            resp['now_playing'] = now_playing
+        return (success, resp)
+
+    def streams(self, station=None):
+        """List all streams (of `station`)
+
+        If the `include` query parameter contains 'now_playing', the
+        response also lists the current song of each stream (the metadata
+        of its last sample, or None), in the same order.
+        """
+        if station is not None:
+            station = unquote(station)
+        include = _split(request.query.get('include', ''))
+        return reply(*self._streams(station, include))
+
+    def _set(self, station, stream=None):
+        with self._lock:
+            success = self.radio.set(station, stream)
+        resp = 'Setting active stream to %s %s' % (station, stream)
+        return (success, resp)
 
     def set(self, station, stream=None):
         station = unquote(station)
         if stream is not None:
             stream = unquote(stream)
-        success = self.radio.set(station, stream)
-        resp = 'Setting active stream to %s %s' % (station, stream)
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+        return reply(*self._set(station, stream))
 
-    def play(self, station=None, stream=None):
-        # Any conditions when auto-stop make sense?
-        if self.radio.is_playing and not self.radio.is_paused:
+    def _play(self, station=None, stream=None):
+        with self._lock:
+            # Any conditions when auto-stop make sense?
+            if self.radio.state in (STARTING, PLAYING):
+                success = False
+                resp = 'Failure: stop/pause before playing'
+                return (success, resp)
+            if (station is not None and stream is not None and
+                    (self.radio.station != station or
+                     self.radio.stream != stream)):
+                if not self.radio.set(station, stream):
+                    success = False
+                    resp = 'Failure: could not set the station/stream'
+                    return (success, resp)
+            t = self.radio.request_play()
+        if t is None:
             success = False
-            resp = 'Failure: stop/pause before playing'
-            return json.dumps({'success': success, 'resp': resp}) + '\n'
+            resp = 'Failure: could not play'
+            return (success, resp)
+        success = True
+        resp = 'Playing %s %s' % (t.station, t.stream)
+        return (success, resp, {'transition': t.id})
+
+    def play(self, station=None, stream=None):
         if station is not None:
             station = unquote(station)
         if stream is not None:
             stream = unquote(stream)
-        if (station is not None and stream is not None and
-                (self.radio.station != station or
-                 self.radio.stream != stream)):
-            if not self.radio.set(station, stream):
-                success = False
-                resp = 'Failure: could not set the station/stream'
-                return json.dumps({'success': success, 'resp': resp}) + '\n'
-        (station, stream) = self.radio.play()
-        success = True
-        resp = 'Playing %s %s' % (station, stream)
-        if station is None or stream is None:
+        return reply(*self._play(station, stream))
+
+    def _pretune(self, station=None, stream=None):
+        name = self.radio.pretune(station, stream)
+        if name is None:
             success = False
-            resp = 'Failure: could not play'
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+            resp = 'Failure: could not pretune'
+            return (success, resp)
+        success = True
+        resp = 'Pretuned %s' % name
+        return (success, resp, {'stream': name})
 
-    def volume(self, value):
+    def pretune(self, station=None, stream=None):
+        if station is not None:
+            station = unquote(station)
+        if stream is not None:
+            stream = unquote(stream)
+        return reply(*self._pretune(station, stream))
+
+    def _volume(self, value):
         val_ok = False
         try:
             if 0 <= int(value) <= 32000:
@@ -261,154 +650,137 @@ class Server(object):
         except (ValueError, TypeError):
             pass
         if val_ok:
-            Stream.vol = str(value)
+            with self._lock:
+                Stream.set_volume(value)
+            self.radio.feed.notify()
             success = True
             resp = 'Setting volume to %s' % (Stream.vol, )
         else:
             success = False
             resp = 'Invalid volume %s. Must be integer 0..32k.' % value
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+        return (success, resp)
 
-    def pause(self):
-        (station, stream) = self.radio.pause()
-        success = True
-        resp = 'Pausing %s %s' % (station, stream)
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
+    def volume(self, value):
+        return reply(*self._volume(value))
 
-    def stop(self):
-        (station, stream) = self.radio.stop()
+    def _pause(self):
+        with self._lock:
+            t = self.radio.request_pause()
         success = True
-        resp = 'Stopping %s %s' % (station, stream)
-        return json.dumps({'success': success, 'resp': resp}) + '\n'
-
-
-class Client(object):
-    """Importable Python object to wrap REST calls"""
-    version = 'v1.1'
-
-    def __init__(self, host, port):
-        self.host = host
-        self.port = port
-
-    def url(self, endpoint):
-        return ('http://%s:%s/api/%s/%s' %
-                (self.host, self.port, self.version, endpoint))
-
-    def get(self, endpoint):
-        try:
-            resp = requests.get(self.url(endpoint))
-        except requests.ConnectionError as e:
-            raise ApiConnError(e)
-        try:
-            resp_val = json.loads(resp.text)
-        except ValueError as e:
-            # remote server fails and kills connection or returns nothing
-            raise ApiConnError(e)
-        return resp_val
-
-    def post(self, endpoint, data={}):
-        try:
-            resp = requests.post(self.url(endpoint), data=json.dumps(data))
-        except requests.ConnectionError as e:
-            raise ApiConnError(e)
-        try:
-            resp_val = json.loads(resp.text)
-        except ValueError as e:
-            # remote server fails and kills connection or returns nothing
-            raise ApiConnError(e)
-        return resp_val
-
-    def put(self, endpoint, data={}):
-        try:
-            resp = requests.put(self.url(endpoint), data=json.dumps(data))
-        except requests.ConnectionError as e:
-            raise ApiConnError(e)
-        try:
-            resp_val = json.loads(resp.text)
-        except ValueError as e:
-            # remote server fails and kills connection or returns nothing
-            raise ApiConnError(e)
-        return resp_val
-
-    def delete(self, endpoint):
-        try:
-            resp = requests.delete(self.url(endpoint))
-        except requests.ConnectionError as e:
-            raise ApiConnError(e)
-        try:
-            resp_val = json.loads(resp.text)
-        except ValueError as e:
-            # remote server fails and kills connection or returns nothing
-            raise ApiConnError(e)
-        return resp_val
-
-    def status(self, station=None):
-        rjson = self.get('player')
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return None
-        return rjson['resp']
-
-    def station(self, station):
-        rjson = self.get('stations/%s' % station)
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return None
-        return rjson['resp']
-
-    def stations(self):
-        rjson = self.get('stations')
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return []
-        return rjson['resp']['stations']
-
-    def stream(self, station, stream):
-        rjson = self.get('stations/%s/streams/%s' % (station, stream))
-        # aso streams/<station>/<stream>
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return None
-        return rjson['resp']
-
-    def streams(self, station=None):
-        if station is None:
-            rjson = self.get('streams')
-        else:
-            rjson = self.get('stations/%s/streams' % station)
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return []
-        return rjson['resp']['streams']
-
-    def play(self, station=None, stream=None):
-        url = 'player'
-        if station is not None and stream is not None:
-            url = 'player/%s/%s' % (station, stream)
-        rjson = self.post(url)
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return False
-        return True
-
-    def volume(self, value):
-        url = 'volume/%s' % value
-        rjson = self.post(url)
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return False
-        return True
+        resp = 'Pausing %s %s' % (t.station, t.stream)
+        return (success, resp, {'transition': t.id})
 
     def pause(self):
-        rjson = self.put('player')
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return False
-        return True
+        return reply(*self._pause())
+
+    def _stop(self):
+        with self._lock:
+            t = self.radio.request_stop()
+        success = True
+        resp = 'Stopping %s %s' % (t.station, t.stream)
+        return (success, resp, {'transition': t.id})
 
     def stop(self):
-        rjson = self.delete('player')
-        if rjson is None or not rjson['success']:
-            print('API request failure: %s' % rjson)
-            return False
-        return True
+        return reply(*self._stop())
+
+    def _check_op(self, op):
+        # error message for an invalid batch op, or None
+        if not isinstance(op, dict):
+            return 'not an object'
+        for (arg, value) in op.items():
+            if arg == 'include':
+                values = value if isinstance(value, list) else [value]
+                valid = all(isinstance(v, (str, type(u''))) for v in values)
+            else:
+                valid = not isinstance(value, (dict, list))
+            if not valid:
+                return 'invalid value of %s' % arg
+        name = op.get('op')
+        if name not in self.batch_ops:
+            return 'unknown op %s' % json.dumps(name)
+        (required, optional) = self.batch_ops[name]
+        for arg in required:
+            if arg not in op:
+                return 'op %s needs argument %s' % (name, arg)
+        for arg in op:
+            if arg != 'op' and arg not in required + optional:
+                return 'op %s has no argument %s' % (name, arg)
+        return None
+
+    def _batch(self, ops):
+        results = []
+        with self._lock:
+            for op in ops:
+                error = self._check_op(op)
+                if error is not None:
+                    result = (False, 'Invalid op: %s' % error)
+                else:
+                    name = op['op']
+                    args = dict((k, v) for (k, v) in op.items() if k != 'op')
+                    if name in ('stations', 'streams'):
+                        args['include'] = _split(args.get('include', ''))
+                    result = getattr(self, '_' + name)(**args)
+                entry = {'success': result[0], 'resp': result[1]}
+                if len(result) > 2:
+                    entry.update(result[2])
+                results.append(entry)
+        success = all(r['success'] for r in results)
+        return (success, results)
+
+    def batch(self):
+        """Run several operations in one request, without interleaving with
+        other requests
+
+        The post data is ``{"ops": [{"op": <name>, <arg>: <value>, ...}]}``
+        with names from `batch_ops`, and arguments as for the corresponding
+        single requests, e.g. ``{"op": "play", "station": "favs", "stream":
+        "Lush"}``. No other request changes the player while the operations
+        run. The response lists the result of each operation.
+        """
+        try:
+            ops = load_request(['ops'])['ops']
+        except ValueError:
+            ops = None
+        if not isinstance(ops, list):
+            return reply(False, 'Invalid batch request: no list of ops')
+        return reply(*self._batch(ops))
+
+
+def reply(success, resp, extra=None):
+    """JSON reply; `extra` (a dict) adds top-level keys, e.g. a transition
+    id"""
+    rjson = {'success': success, 'resp': resp}
+    if extra is not None:
+        rjson.update(extra)
+    return json.dumps(rjson) + '\n'
+
+
+def _split(value):
+    if isinstance(value, (list, tuple)):
+        return value
+    return [v.strip() for v in value.split(',') if v.strip() != '']
+
+
+def stream_dict(stm, with_meta=True):
+    """Details of the Stream `stm` (all None if `stm` is None)"""
+    resp = {
+        'station': None,
+        'name': None,
+        'url': None,
+        'desc': None,
+        'art': None,
+    }
+    if with_meta:
+        resp.update({
+            'meta_name': None,
+            'meta_song': None,
+            'meta': None,
+            'is_playing': None,
+            'is_paused': None,
+        })
+    if stm is not None:
+        for key in resp:
+            resp[key] = getattr(stm, key)
+        if resp.get('meta') is not None:
+            resp['meta'] = resp['meta'].as_dict()
+    return resp
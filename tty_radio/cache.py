@@ -0,0 +1,162 @@
+from __future__ import print_function
+import platform
+PY3 = False
+if platform.python_version().startswith('3'):
+    PY3 = True
+import os
+import json
+from hashlib import sha1
+from threading import Lock
+from time import time
+from os.path import (
+    expanduser,
+    join as path_join,
+    getsize as getsize,
+    isdir as isdir)
+if PY3:
+    from urllib.request import urlopen, Request, URLError
+else:
+    from urllib2 import urlopen, Request, URLError
+
+# next to the .tty_radio-*.csv files
+CACHE_DIR = '.tty_radio-cache'
+FETCH_TIMEOUT = 10  # in seconds
+
+
+class DiskCache(object):
+    """Size-capped store of byte strings on disk, with LRU eviction
+
+    Every entry is a data file and a small json file of metadata (e.g. HTTP
+    validators), named by the hash of the entry's key. Reading an entry
+    bumps its mtime; when the total size exceeds `max_size` bytes, the
+    least recently used entries are removed.
+
+    Args:
+        max_size (int): cap on the total size of all entries, in bytes
+        path (str): cache directory, defaults to ``~/.tty_radio-cache``
+    """
+    def __init__(self, max_size, path=None):
+        if path is None:
+            path = path_join(expanduser('~'), CACHE_DIR)
+        self.dir = path
+        self.max_size = max_size
+        self._lock = Lock()
+
+    def __str__(self):
+        return 'DiskCache(dir=%s,max_size=%s)' % (self.dir, self.max_size)
+
+    def __repr__(self):
+        return str(self)
+
+    def _path(self, key):
+        name = sha1(key.encode('utf-8')).hexdigest()
+        return path_join(self.dir, name)
+
+    def get(self, key):
+        """Return ``(data, meta)`` for `key`, or ``(None, None)``"""
+        path = self._path(key)
+        try:
+            with open(path + '.data', 'rb') as f:
+                data = f.read()
+            with open(path + '.meta', 'r') as f:
+                meta = json.load(f)
+            _touch(path + '.data')
+        except (IOError, OSError, ValueError):
+            return (None, None)
+        return (data, meta)
+
+    def put(self, key, data, meta=None):
+        if meta is None:
+            meta = {}
+        meta['key'] = key
+        meta['stored'] = time()
+        path = self._path(key)
+        with self._lock:
+            try:
+                if not isdir(self.dir):
+                    os.makedirs(self.dir)
+                atomic_write(path + '.meta', json.dumps(meta).encode('utf-8'))
+                atomic_write(path + '.data', data)
+                _touch(path + '.data')
+            except (IOError, OSError) as e:
+                print("Warning: couldn't write cache entry %s: %s" % (key, e))
+                return
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for fname in os.listdir(self.dir):
+            if not fname.endswith('.data'):
+                continue
+            path = path_join(self.dir, fname[:-len('.data')])
+            try:
+                size = getsize(path + '.data') + getsize(path + '.meta')
+                entries.append((os.stat(path + '.data').st_mtime, size, path))
+            except OSError:
+                continue
+            total += size
+        entries.sort()
+        while total > self.max_size and len(entries) > 0:
+            (mtime, size, path) = entries.pop(0)
+            for ext in ('.data', '.meta'):
+                try:
+                    os.remove(path + ext)
+                except OSError:
+                    pass
+            total -= size
+
+
+def _touch(fname):
+    # explicit times: the implicit "now" can be too coarse to order entries
+    now = time()
+    os.utime(fname, (now, now))
+
+
+def atomic_write(fname, data):
+    """Write the bytes `data` to `fname` such that readers never see a
+    partially written file"""
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    if PY3:
+        os.replace(tmp, fname)
+    else:
+        os.rename(tmp, fname)
+
+
+def fetch(url, cache=None, timeout=FETCH_TIMEOUT):
+    """Return the body of `url`, using `cache` (a DiskCache) if given
+
+    A cached copy is revalidated with its ETag/Last-Modified validators;
+    if the server replies 304 Not Modified (or with an error, or cannot be
+    reached), the cached copy is returned.
+
+    Raises:
+        URLError: if `url` cannot be retrieved and there is no cached copy
+    """
+    key = 'url:' + url
+    (data, meta) = (None, None)
+    if cache is not None:
+        (data, meta) = cache.get(key)
+    req = Request(url)
+    if data is not None:
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        resp = urlopen(req, timeout=timeout)
+        body = resp.read()
+    except (URLError, IOError, OSError):
+        # a 304 Not Modified (an HTTPError) revalidates the cached copy;
+        # on other errors it is stale, but better than nothing
+        if data is not None:
+            return data
+        raise
+    if cache is not None:
+        cache.put(key, body, {
+            'etag': resp.info().get('ETag'),
+            'last_modified': resp.info().get('Last-Modified'),
+        })
+    return body
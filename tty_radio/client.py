@@ -0,0 +1,290 @@
+from __future__ import print_function
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# default seconds a long-poll for player events is held open
+EVENTS_TIMEOUT = 30
+# seconds to wait for a connection and for a response, and number of
+# retries of failed connection attempts
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 30
+RETRIES = 2
+# seconds to wait for a play/pause/stop to be done, if waiting at all
+TRANSITION_WAIT = 30
+
+
+class ApiConnError(BaseException):
+    pass
+
+
+class Client(object):
+    """Importable Python object to wrap REST calls
+
+    All calls go through one pooled `requests.Session`, so consecutive calls
+    reuse the same keep-alive connection. Use as a context manager, or call
+    `close` when done.
+
+    Args:
+        host (str): server host
+        port (int): server port
+        timeout (tuple): seconds to wait for a connection and for a response
+        retries (int): number of retries for failed connection attempts
+    """
+    version = 'v1.1'
+
+    def __init__(self, host, port,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.session = requests.Session()
+        # only connecting is retried, play/pause/etc. are not idempotent
+        retry = Retry(
+            total=retries, connect=retries, read=0, redirect=0,
+            backoff_factor=0.1)
+        self.session.mount('http://', HTTPAdapter(max_retries=retry))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def url(self, endpoint):
+        return ('http://%s:%s/api/%s/%s' %
+                (self.host, self.port, self.version, endpoint))
+
+    def _request(self, method, endpoint, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return self.session.request(
+                method, self.url(endpoint), timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise ApiConnError(e)
+
+    def _json_request(self, method, endpoint, **kwargs):
+        resp = self._request(method, endpoint, **kwargs)
+        try:
+            resp_val = json.loads(resp.text)
+        except ValueError as e:
+            # remote server fails and kills connection or returns nothing
+            raise ApiConnError(e)
+        return resp_val
+
+    def get(self, endpoint):
+        return self._json_request('GET', endpoint)
+
+    def post(self, endpoint, data={}):
+        return self._json_request('POST', endpoint, data=json.dumps(data))
+
+    def put(self, endpoint, data={}):
+        return self._json_request('PUT', endpoint, data=json.dumps(data))
+
+    def delete(self, endpoint):
+        return self._json_request('DELETE', endpoint)
+
+    def events(self, version=None, timeout=EVENTS_TIMEOUT):
+        """Wait for a change of the player status
+
+        Returns a tuple ``(version, status)``. `status` is None if nothing
+        changed relative to `version` within `timeout` seconds. Pass the
+        returned version to the next call.
+        """
+        headers = {}
+        if version is not None:
+            headers['If-None-Match'] = '"%s"' % version
+        # the server holds the request for up to `timeout` seconds
+        (connect_timeout, read_timeout) = self.timeout
+        resp = self._request(
+            'GET', 'player/events', headers=headers,
+            params={'timeout': timeout},
+            timeout=(connect_timeout, read_timeout + timeout))
+        if resp.status_code == 304:
+            return (version, None)
+        try:
+            rjson = json.loads(resp.text)
+        except ValueError as e:
+            # remote server fails and kills connection or returns nothing
+            raise ApiConnError(e)
+        if not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return (version, None)
+        return (rjson['version'], rjson['resp'])
+
+    def transition(self, tid, wait=0):
+        """Details of the play/pause/stop transition `tid` (a dict with a
+        'done' flag), waiting up to `wait` seconds for it to finish"""
+        (connect_timeout, read_timeout) = self.timeout
+        rjson = self._json_request(
+            'GET', 'transitions/%s' % tid, params={'wait': wait},
+            timeout=(connect_timeout, read_timeout + wait))
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return None
+        return rjson['resp']
+
+    def check_transition(self, tid, wait=TRANSITION_WAIT):
+        """Wait up to `wait` seconds for the play/pause/stop transition `tid`
+        to be done; print its error and return False if it failed"""
+        t = self.transition(tid, wait)
+        if t is None:
+            return False
+        if t['error'] is not None:
+            print('Failure: could not %s %s %s: %s' % (
+                t['action'], t['station'], t['stream'], t['error']))
+            return False
+        return True
+
+    def history(self, since=None, limit=None, offset=0):
+        """Recently played songs (a list of dicts), oldest first
+
+        Pass the `end` (or `start`) time of the last song seen as `since`
+        to only get the songs played after it.
+        """
+        params = {'offset': offset}
+        if since is not None:
+            params['since'] = since
+        if limit is not None:
+            params['limit'] = limit
+        rjson = self._json_request('GET', 'history', params=params)
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return []
+        return rjson['resp']['history']
+
+    def status(self, station=None):
+        rjson = self.get('player')
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return None
+        return rjson['resp']
+
+    def sinks(self):
+        """Delivery metrics of the notification sinks (a list of dicts)"""
+        rjson = self.get('sinks')
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return []
+        return rjson['resp']['sinks']
+
+    def station(self, station):
+        rjson = self.get('stations/%s' % station)
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return None
+        return rjson['resp']
+
+    def stations(self, include=None):
+        """List the stations
+
+        `include` may be a list of 'streams', 'meta' and/or 'now_playing',
+        see `Server.stations`.
+        """
+        endpoint = 'stations'
+        if include:
+            endpoint += '?include=%s' % ','.join(include)
+        rjson = self.get(endpoint)
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return []
+        return rjson['resp']['stations']
+
+    def stream(self, station, stream):
+        rjson = self.get('stations/%s/streams/%s' % (station, stream))
+        # aso streams/<station>/<stream>
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return None
+        return rjson['resp']
+
+    def streams(self, station=None, include=None):
+        """List the streams (as strings)
+
+        With `include` containing 'now_playing', return the tuple
+        ``(streams, now_playing)``, see `Server.streams`.
+        """
+        endpoint = 'streams'
+        if station is not None:
+            endpoint = 'stations/%s/streams' % station
+        if include:
+            endpoint += '?include=%s' % ','.join(include)
+        rjson = self.get(endpoint)
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            if include and 'now_playing' in include:
+                return ([], [])
+            return []
+        if include and 'now_playing' in include:
+            return (rjson['resp']['streams'], rjson['resp']['now_playing'])
+        return rjson['resp']['streams']
+
+    def play(self, station=None, stream=None, wait=0):
+        """Start playing; with `wait`, wait up to that many seconds for the
+        stream to start, and return False if it failed"""
+        url = 'player'
+        if station is not None and stream is not None:
+            url = 'player/%s/%s' % (station, stream)
+        rjson = self.post(url)
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return False
+        if wait > 0:
+            return self.check_transition(rjson['transition'], wait)
+        return True
+
+    def pretune(self, station=None, stream=None):
+        """Buffer a stream (by default, the next one of the current
+        station), so that playing it starts without delay"""
+        url = 'pretune'
+        if station is not None and stream is not None:
+            url = 'pretune/%s/%s' % (station, stream)
+        rjson = self.post(url)
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return False
+        return True
+
+    def volume(self, value):
+        url = 'volume/%s' % value
+        rjson = self.post(url)
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return False
+        return True
+
+    def batch(self, ops):
+        """Run several operations in a single request
+
+        `ops` is a list of dicts, see `Server.batch`. Returns the list of the
+        results (dicts with 'success' and 'resp') of all operations, or None
+        if the batch request itself failed.
+        """
+        rjson = self.post('batch', {'ops': ops})
+        if rjson is None or not isinstance(rjson['resp'], list):
+            print('API request failure: %s' % rjson)
+            return None
+        return rjson['resp']
+
+    def pause(self, wait=0):
+        rjson = self.put('player')
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return False
+        if wait > 0:
+            return self.check_transition(rjson['transition'], wait)
+        return True
+
+    def stop(self, wait=0):
+        rjson = self.delete('player')
+        if rjson is None or not rjson['success']:
+            print('API request failure: %s' % rjson)
+            return False
+        if wait > 0:
+            return self.check_transition(rjson['transition'], wait)
+        return True
@@ -0,0 +1,155 @@
+from __future__ import print_function
+import os
+import json
+from collections import deque
+from itertools import count
+from threading import Lock
+from time import time
+from os.path import expanduser, getsize
+
+# number of tracks kept in memory
+HISTORY_SIZE = 500
+# the log file is rotated when it exceeds LOG_MAX_SIZE bytes, keeping
+# LOG_BACKUPS old logs (log.1 is the most recent one)
+LOG_MAX_SIZE = 1024 * 1024
+LOG_BACKUPS = 3
+
+
+class Track(object):
+    """One played song"""
+    __slots__ = (
+        'id', 'station', 'stream', 'song', 'artist', 'title', 'url',
+        'start', 'end')
+
+    def __init__(self, tid, station, stream, song, artist=None, title=None,
+                 url=None, start=None, end=None):
+        self.id = tid
+        self.station = station
+        self.stream = stream
+        self.song = song
+        self.artist = artist
+        self.title = title
+        self.url = url
+        if start is None:
+            start = time()
+        self.start = start
+        self.end = end
+
+    def __str__(self):
+        return ('Track(id=%s,stream=%s,song=%s,start=%s,end=%s)' %
+                (self.id, self.stream, self.song, self.start, self.end))
+
+    def __repr__(self):
+        return str(self)
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+class History(object):
+    """Ring buffer of the most recently played tracks
+
+    A track starts when a stream reports a new song, and ends with the next
+    song or when playback stops. Finished tracks are also appended to
+    `logfile` (one json object per line), if given.
+
+    Args:
+        size (int): number of tracks kept in memory
+        logfile (str): path of the log file, or None
+        max_size (int): size in bytes at which the log file is rotated
+        backups (int): number of rotated log files to keep
+    """
+    def __init__(self, size=HISTORY_SIZE, logfile=None,
+                 max_size=LOG_MAX_SIZE, backups=LOG_BACKUPS):
+        self._tracks = deque(maxlen=size)
+        self._lock = Lock()
+        self._ids = count(1)
+        self.logfile = None
+        if logfile:
+            self.logfile = expanduser(logfile)
+        self.max_size = max_size
+        self.backups = backups
+
+    def __str__(self):
+        return ('History(size=%s,tracks=%d,logfile=%s)' %
+                (self._tracks.maxlen, len(self._tracks), self.logfile))
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def current(self):
+        """The track that is playing, or None"""
+        with self._lock:
+            if len(self._tracks) > 0 and self._tracks[-1].end is None:
+                return self._tracks[-1]
+        return None
+
+    def start(self, station, stream, meta):
+        """End the current track, and start one for the SongMeta `meta`"""
+        with self._lock:
+            self._end(meta.timestamp)
+            self._tracks.append(Track(
+                next(self._ids), station, stream, meta.song, meta.artist,
+                meta.title, meta.url, meta.timestamp))
+
+    def end(self, timestamp=None):
+        """End the current track (if any)"""
+        with self._lock:
+            self._end(timestamp)
+
+    def _end(self, timestamp):
+        if len(self._tracks) == 0 or self._tracks[-1].end is not None:
+            return
+        if timestamp is None:
+            timestamp = time()
+        track = self._tracks[-1]
+        track.end = timestamp
+        if self.logfile is not None:
+            self._log(track)
+
+    def tracks(self, since=None, limit=None, offset=0):
+        """Tracks in the order they were played, as dicts
+
+        Args:
+            since (float): only tracks that started or ended after this
+                time (epoch seconds); a client that was disconnected passes
+                the time of the last track it saw
+            limit (int): return at most this many tracks
+            offset (int): skip this many tracks (after filtering)
+
+        Returns:
+            tuple: ``(tracks, total)`` with `total` the number of tracks
+            before `offset` and `limit` were applied
+        """
+        with self._lock:
+            tracks = list(self._tracks)
+        if since is not None:
+            tracks = [t for t in tracks if t.start > since or
+                      t.end is None or t.end > since]
+        total = len(tracks)
+        tracks = tracks[offset:]
+        if limit is not None:
+            tracks = tracks[:limit]
+        return ([t.as_dict() for t in tracks], total)
+
+    def _log(self, track):
+        try:
+            if (os.path.isfile(self.logfile) and
+                    getsize(self.logfile) >= self.max_size):
+                self._rotate()
+            with open(self.logfile, 'a') as f:
+                f.write(json.dumps(track.as_dict()) + '\n')
+        except (IOError, OSError) as exc_info:
+            print("Warning: couldn't write to history log %s: %s" %
+                  (self.logfile, exc_info))
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            older = '%s.%d' % (self.logfile, i)
+            if os.path.isfile(older):
+                os.rename(older, '%s.%d' % (self.logfile, i + 1))
+        if self.backups > 0:
+            os.rename(self.logfile, self.logfile + '.1')
+        else:
+            os.remove(self.logfile)
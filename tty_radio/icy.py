@@ -0,0 +1,195 @@
+"""Shoutcast/Icecast (ICY) metadata in the stream data
+
+A client that sends the ``Icy-MetaData: 1`` request header gets the stream
+interval in the ``icy-metaint`` response header: after every `metaint` bytes
+of audio, the server inserts a metadata block. Its first byte is the length
+of the block in units of 16 bytes, followed by the metadata (e.g.
+``StreamTitle='Artist - Title';``), padded with NUL bytes.
+"""
+from __future__ import print_function
+from threading import Event, Thread
+
+import requests
+
+from .playlist import resolve
+
+# request header to ask for metadata in the stream
+REQUEST_HEADERS = {'Icy-MetaData': '1'}
+CONNECT_TIMEOUT = 10  # in seconds
+READ_TIMEOUT = 30  # in seconds
+# seconds to wait before reconnecting after an error
+RETRY_INTERVAL = 10
+
+
+class IcyParser(object):
+    """Split ICY stream data into audio and metadata
+
+    The data may be fed in chunks of any size.
+
+    Args:
+        metaint (int): the ``icy-metaint`` of the response; 0 if the server
+            sends no metadata (all data is audio)
+    """
+    def __init__(self, metaint):
+        self.metaint = metaint
+        self._audio_left = metaint  # bytes of audio until the next block
+        self._meta_left = None  # bytes of the current block still to read
+        self._meta = b''
+
+    def __str__(self):
+        return 'IcyParser(metaint=%s)' % self.metaint
+
+    def __repr__(self):
+        return str(self)
+
+    def feed(self, data):
+        """Return ``(audio, metadata)``: the audio bytes in `data`, and the
+        list of metadata blocks (as str) completed by it"""
+        if not self.metaint:
+            return (data, [])
+        audio = []
+        metadata = []
+        (i, n) = (0, len(data))
+        while i < n:
+            if self._meta_left is None and self._audio_left > 0:
+                take = min(self._audio_left, n - i)
+                audio.append(data[i:i + take])
+                self._audio_left -= take
+            elif self._meta_left is None:
+                self._meta_left = bytearray(data[i:i + 1])[0] * 16
+                take = 1
+                if self._meta_left == 0:
+                    self._end_block()
+            else:
+                take = min(self._meta_left, n - i)
+                self._meta += data[i:i + take]
+                self._meta_left -= take
+                if self._meta_left == 0:
+                    metadata.append(decode(self._meta.rstrip(b'\0')))
+                    self._end_block()
+            i += take
+        return (b''.join(audio), metadata)
+
+    def skip(self, fp):
+        """Read and drop the audio up to the next metadata block from the
+        file-like `fp`"""
+        while self._meta_left is None and self._audio_left > 0:
+            data = fp.read(min(self._audio_left, 65536))
+            if not data:
+                return
+            self._audio_left -= len(data)
+
+    def _end_block(self):
+        self._meta = b''
+        self._meta_left = None
+        self._audio_left = self.metaint
+
+
+class MetaReader(object):
+    """Follow the metadata of a stream, without decoding its audio
+
+    Connects to `url` (resolving playlists) in a background thread, and
+    passes the ICY lines of the stream to `reader` in the format mpg123
+    reports them (``ICY-NAME: ...``, ``ICY-META: StreamTitle='...';``).
+    The audio bytes are read and dropped. Reconnects after errors, until
+    `stop` is called; gives up if the server sends no metadata.
+    """
+    def __init__(self, url, reader):
+        self.url = url
+        self.reader = reader
+        self.error = None
+        self._stopped = Event()
+
+    def __str__(self):
+        return 'MetaReader(url=%s,error=%s)' % (self.url, self.error)
+
+    def __repr__(self):
+        return str(self)
+
+    def start(self):
+        thread = Thread(target=self._run, name='icy_meta')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _emit(self, line):
+        if not self._stopped.is_set():
+            self.reader(line)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                for line in read_meta(self.url, self._stopped):
+                    self._emit(line)
+                return  # no metadata, or stopped
+            except (requests.RequestException, IOError,
+                    ValueError) as exc_info:
+                self.error = str(exc_info)
+                self._stopped.wait(RETRY_INTERVAL)
+
+
+def read_meta(url, stopped=None, timeout=READ_TIMEOUT, session=None,
+              max_blocks=None):
+    """Generate the ICY lines of the stream `url`
+
+    Starts with the ``ICY-NAME`` (if any), followed by an ``ICY-META`` line
+    for every metadata block that differs from the previous one. Ends when
+    the event `stopped` is set, after `max_blocks` metadata blocks (if
+    given), or right away if the server sends no metadata. Requests are
+    made with the requests.Session `session`, if given.
+    """
+    if session is None:
+        session = requests
+    resp = session.get(
+        resolve(url, timeout, session), headers=REQUEST_HEADERS,
+        stream=True, timeout=(CONNECT_TIMEOUT, timeout))
+    try:
+        resp.raise_for_status()
+        name = resp.headers.get('icy-name')
+        if name is not None:
+            yield 'ICY-NAME: %s' % name
+        metaint = int(resp.headers.get('icy-metaint', 0))
+        if metaint <= 0:
+            return
+        parser = IcyParser(metaint)
+        current = None
+        blocks = 0
+        while stopped is None or not stopped.is_set():
+            if max_blocks is not None and blocks >= max_blocks:
+                return
+            blocks += 1
+            # skip to the next block without looking at the audio
+            parser.skip(resp.raw)
+            chunk = resp.raw.read(1)
+            if not chunk:
+                return
+            length = bytearray(chunk)[0] * 16
+            block = resp.raw.read(length) if length > 0 else b''
+            for meta in parser.feed(chunk + block)[1]:
+                if meta and meta != current:
+                    current = meta
+                    yield 'ICY-META: %s' % meta
+    finally:
+        resp.close()
+
+
+def read_title(url, timeout=CONNECT_TIMEOUT, session=None, max_blocks=2):
+    """Return the first metadata block of the stream `url`, or None if it
+    has none (within the first `max_blocks` blocks)"""
+    for line in read_meta(url, timeout=timeout, session=session,
+                          max_blocks=max_blocks):
+        if line.startswith('ICY-META: '):
+            return line[len('ICY-META: '):]
+    return None
+
+
+def decode(data):
+    """Decode metadata as UTF-8, falling back to Latin-1 (which many
+    stations use)"""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
@@ -0,0 +1,166 @@
+"""Player status over a Unix domain socket
+
+A cheaper alternative to the REST API for status bars and shell prompts,
+using only the standard library. A client connects, sends one command line,
+and reads the answer until the server closes the connection. Commands:
+
+    status        the player status as json (as returned by the REST API)
+    song          the current song, or stream name (`radio status --song`)
+    song stream   stream name and song on two lines
+    stream        the current stream name
+
+The `radio-status` console script queries the socket without parsing the
+config file; it uses $TTY_RADIO_SOCKET, or the default path.
+"""
+from __future__ import print_function
+import os
+import sys
+import socket
+from threading import Thread
+from os.path import expanduser, join as path_join
+
+# if you change SOCKET_FILE, make sure to update the documentation
+SOCKET_FILE = '.tty_radio-status.sock'
+SOCKET_ENV = 'TTY_RADIO_SOCKET'
+QUERY_TIMEOUT = 1.0  # in seconds
+MAX_COMMAND = 64  # in bytes
+
+
+def default_path():
+    return os.environ.get(SOCKET_ENV, path_join(expanduser('~'), SOCKET_FILE))
+
+
+class StatusSocketServer(object):
+    """Answer status commands on a Unix domain socket, in a daemon thread
+
+    Args:
+        path (str): file name of the socket. A stale socket file (from a
+            server that is no longer running) is replaced.
+        commands (dict): map of command names to callables that get the
+            remaining words of the command line and return the answer
+    """
+    def __init__(self, path, commands):
+        self.path = expanduser(path)
+        self.commands = commands
+        self.sock = None
+
+    def __str__(self):
+        return 'StatusSocketServer(path=%s)' % self.path
+
+    def __repr__(self):
+        return str(self)
+
+    def start(self):
+        """Bind the socket and start answering; raise socket.error if the
+        socket is in use by a running server"""
+        if query('status', self.path) is not None:
+            raise socket.error('%s is in use' % self.path)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(16)
+        thread = Thread(
+            target=self._serve, args=(self.sock, ), name='status_socket')
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self, sock):
+        while True:
+            try:
+                (conn, _) = sock.accept()
+            except socket.error:
+                return  # closed
+            try:
+                conn.settimeout(QUERY_TIMEOUT)
+                conn.sendall(self.answer(_read_line(conn)).encode('utf-8'))
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def answer(self, line):
+        words = line.split()
+        if len(words) == 0 or words[0] not in self.commands:
+            return 'error: unknown command %r\n' % line
+        try:
+            answer = self.commands[words[0]](words[1:])
+        except Exception as exc_info:
+            return 'error: %s\n' % exc_info
+        if answer is None:
+            answer = ''
+        return '%s\n' % answer
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                # wakes up the accept() in _serve
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def _read_line(conn):
+    data = b''
+    while b'\n' not in data and len(data) < MAX_COMMAND:
+        chunk = conn.recv(MAX_COMMAND)
+        if not chunk:
+            break
+        data += chunk
+    return data.split(b'\n')[0].decode('utf-8', 'replace').strip()
+
+
+def query(command, path=None, timeout=QUERY_TIMEOUT):
+    """Send `command` to the status socket, return the answer (without the
+    trailing newline), or None if no server is listening"""
+    if path is None:
+        path = default_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(expanduser(path))
+        sock.sendall(command.encode('utf-8') + b'\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    answer = b''.join(chunks).decode('utf-8', 'replace')
+    if answer.endswith('\n'):
+        answer = answer[:-1]
+    return answer
+
+
+def main(argv=None):
+    """Entry point of the `radio-status` console script
+
+    Usage: radio-status [status | song [stream] | stream]
+
+    Prints the answer of the server (default command: song); exits with
+    status 1, without output, if no server is listening.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] in ('-h', '--help'):
+        print(main.__doc__.split('\n\n')[1].strip())
+        return 0
+    command = ' '.join(argv) or 'song'
+    answer = query(command)
+    if answer is None:
+        return 1
+    print(answer)
+    return 0
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import re
+from time import time
+
+# key='value' fields of an ICY-META block, e.g.
+# StreamTitle='...';StreamUrl='...'; where a value may itself contain quotes
+# and semicolons: it ends at the quote before the ';' of the next key, or at
+# the end of the block (the last ';' may be missing)
+ICY_FIELD = re.compile(r"(\w+)='(.*?)'(?:;(?=\s*\w+=')|;?\s*$)", re.S)
+# padding after the last field
+ICY_PADDING = '\0\r\n '
+# channel of a SomaFM stream URL (its direct links add e.g. '-128-mp3')
+SOMA_CHANNEL = re.compile(
+    r"^\w+://(?:[\w-]+\.)*somafm\.com(?::\d+)?/([a-z0-9]+)", re.I)
+# "Artist  - Title" -> "Artist - Title"
+SPACED_DASH = re.compile(r'\s{2,}-')
+# typographic characters that would break the artist/title split
+NORMALIZE = [
+    (u" – ", u" - "),
+    (u"“", u'"'),
+    (u"”", u'"'),
+    (u"‘", u"'"),
+    (u"’", u"'"),
+]
+
+
+class SongMeta(object):
+    """Metadata of one song, parsed once from an ICY-META block
+
+    Attributes:
+        song (str): the title as shown to the user
+        artist (str): artist, or None if `song` doesn't split into an
+            artist and a title (or is filtered, e.g. an ad)
+        title (str): title, or None (like `artist`)
+        raw (str): the unparsed metadata
+        url (str): the StreamUrl of the metadata, if any
+        timestamp (float): when the metadata was received (epoch seconds)
+    """
+    def __init__(self, song, artist=None, title=None, raw=None, url=None,
+                 timestamp=None):
+        self.song = song
+        self.artist = artist
+        self.title = title
+        self.raw = raw
+        self.url = url
+        if timestamp is None:
+            timestamp = time()
+        self.timestamp = timestamp
+
+    def __str__(self):
+        return ('SongMeta(artist=%s,title=%s,url=%s,timestamp=%s)' %
+                (self.artist, self.title, self.url, self.timestamp))
+
+    def __repr__(self):
+        return str(self)
+
+    def as_dict(self):
+        return {
+            'song': self.song,
+            'artist': self.artist,
+            'title': self.title,
+            'raw': self.raw,
+            'url': self.url,
+            'timestamp': self.timestamp,
+        }
+
+
+class MetaRules(object):
+    """How a station's ICY metadata is interpreted
+
+    Args:
+        hide_names (tuple): ICY-NAMEs starting with any of these are not
+            shown (e.g. to not have 'DEF CON' all over your screen)
+        song_filters (tuple): songs containing any of these are not split
+            into artist and title, so they are not scrobbled (e.g. ads)
+    """
+    def __init__(self, hide_names=(), song_filters=()):
+        self.hide_names = tuple(hide_names)
+        self.song_filters = tuple(song_filters)
+
+    def __str__(self):
+        return ('MetaRules(hide_names=%s,song_filters=%s)' %
+                (self.hide_names, self.song_filters))
+
+    def __repr__(self):
+        return str(self)
+
+    def parse_name(self, name):
+        if name.startswith(self.hide_names):
+            return ''
+        return name
+
+    def parse_song(self, metadata, timestamp=None):
+        """Return the SongMeta of an ICY-META `metadata` block, or None if
+        it has no (non-empty) title"""
+        # example to parse:
+        # StreamTitle='Stone Soup Soldiers - Pharaoh's Tears';StreamUrl='http://SomaFM.com/suburbsofgoa/';  # noqa
+        fields = parse_fields(metadata)
+        song = SPACED_DASH.sub(' -', fields.get('StreamTitle', '')).strip()
+        if len(song) == 0:
+            return None
+        url = fields.get('StreamUrl')
+        (artist, title) = self.split(song)
+        return SongMeta(song, artist, title, metadata, url, timestamp)
+
+    def split(self, song):
+        """Return (artist, title) of `song`, or (None, None)"""
+        for s in self.song_filters:
+            if s in song:
+                return (None, None)
+        for (old, new) in NORMALIZE:
+            song = song.replace(old, new)
+        try:
+            (artist, title) = song.split(" - ", 1)
+        except ValueError:
+            return (None, None)
+        (artist, title) = (artist.strip(), title.strip())
+        if len(artist) == 0 or len(title) == 0:
+            return (None, None)
+        return (artist, title)
+
+
+def parse_fields(metadata):
+    """Return the dict of the key='value' fields of an ICY-META block"""
+    metadata = metadata.rstrip(ICY_PADDING)
+    return dict(m.groups() for m in ICY_FIELD.finditer(metadata))
+
+
+def soma_channel(url):
+    """Return the SomaFM channel (e.g. 'defcon') of the stream `url`, or
+    None if it is no SomaFM stream"""
+    soma = SOMA_CHANNEL.match(url)
+    if soma is None:
+        return None
+    return soma.group(1).lower()
+
+
+def stream_key(url):
+    """Return the key of the stream `url` in STREAM_RULES
+
+    SomaFM streams are keyed by their channel (e.g. ``somafm/defcon`` for
+    both http://ice.somafm.com/defcon and
+    http://ice1.somafm.com/defcon-128-mp3), other streams by the URL
+    without the scheme.
+    """
+    channel = soma_channel(url)
+    if channel is not None:
+        return 'somafm/' + channel
+    return url.split('://', 1)[-1].rstrip('/')
+
+
+def rules_for(url, default):
+    """Return the MetaRules of the stream `url`: its entry in STREAM_RULES,
+    or `default`"""
+    return STREAM_RULES.get(stream_key(url), default)
+
+
+DEFAULT_RULES = MetaRules(song_filters=("Commercial-free", ))
+# rules of single streams, by `stream_key`
+STREAM_RULES = {
+    # it's kinda poser having 'DEF CON' all over your screen
+    'somafm/defcon': MetaRules(
+        hide_names=("Def", ), song_filters=DEFAULT_RULES.song_filters),
+}
@@ -1,31 +1,60 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import os
+import sys
+import stat
+import errno
 from os.path import expanduser
 import time
 import datetime
 import subprocess
+from collections import deque
+from threading import Condition, Thread
 
-from .api import Client, ApiConnError
+import requests
 
-PYLAST = True
-try:
-    import pylast
-except ImportError:
-    PYLAST = False
-    print("Hey-o, you don't have the pylast last.fm client installed:")
-    print("  pip install pylast")
+from .cache import atomic_write
+from .client import Client, ApiConnError
+from .scrobble import Scrobbler, ScrobbleQueue
+
+pylast = None  # imported only when scrobbling, see _import_pylast
+# number of recent scrobbles remembered
+SCROBBLE_MEMORY = 100
+# seconds a sink waits for more status changes before sending the latest
+DEBOUNCE = 0.25
+WEBHOOK_TIMEOUT = 5  # in seconds
+
+
+def _import_pylast():
+    """Import the pylast module on first use, return False if missing"""
+    global pylast
+    if pylast is None:
+        try:
+            import pylast as pylast_module
+        except ImportError:
+            print("Hey-o, you don't have the pylast last.fm client installed:")
+            print("  pip install pylast")
+            return False
+        pylast = pylast_module
+    return True
 
 
 class NotifyClient(object):
-    """Client for polling and forwarding artist/title information
+    """Client for following and forwarding artist/title information
 
-    Monitors the server for changes in the metadata that indicate the currently
-    playing arist and song title.
+    Subscribes to the server's player events to monitor changes in the
+    metadata that indicate the currently playing arist and song title.
 
     If ``scrobble`` in the ``Server`` section of `settings` is activated, send
     songs to the Last.fm service, using the credentials specified in the
-    ``Lastfm`` section of `settings`.
+    ``Lastfm`` section of `settings`. Scrobbles are queued on disk and sent
+    by a background Scrobbler, so a slow or unreachable Last.fm never holds
+    up the event loop, and no scrobble is lost while offline.
+
+    Status changes are also forwarded to the notification sinks activated in
+    the ``Server`` section of `settings` (see `Sink`); their metrics are
+    served at ``/api/v1.1/sinks``.
 
     Args:
         settings (configparser.ConfigParser): config file settings
@@ -33,7 +62,8 @@ class NotifyClient(object):
     def __init__(self, settings):
         try:
             self._scrobble = (
-                settings.config['Server'].getboolean('scrobble') and PYLAST)
+                settings.config['Server'].getboolean('scrobble') and
+                _import_pylast())
         except ValueError as exc_info:
             raise ValueError(
                 "Error in configuration, section '%s', key '%s': %s"
@@ -43,20 +73,7 @@ class NotifyClient(object):
             self._log_fh = open(expanduser(logfile), 'w')
         else:
             self._log_fh = None
-        self._filters = ["Commercial-free", ]  # TODO: get this from config
-        try:
-            self._update_btt = (
-                settings.config['Server'].getboolean('update_btt_widget'))
-        except ValueError as exc_info:
-            raise ValueError(
-                "Error in configuration, section '%s', key '%s': %s"
-                % ('Server', 'update_btt_widget', exc_info))
-        if self._update_btt:
-            self._btt_widget_uuid  = settings.config['BTT']['widget UUID']
-            self._btt_shared_secret = settings.config['BTT']['shared secret']
-            if self._btt_widget_uuid == '':
-                self.log("Disabling update_bbt_widget: no widget UUID")
-                self._update_btt = False
+        self.sinks = self._make_sinks(settings)
         if self._scrobble:
             self._lastfm_api_key = settings.config['Lastfm']['api key']
             self._lastfm_api_secret = settings.config['Lastfm']['shared secret']
@@ -67,12 +84,43 @@ class NotifyClient(object):
             self.log("Last.fm username: %s" % self._lastfm_username)
             self.log("Last.fm password_hash: %s" % self._lastfm_password_hash)
             self._lastfm_network = None  # set by _authenticate_lastfm
-            self._authenticate_lastfm()
-            self._scrobbles = []
+            self._scrobbler = Scrobbler(
+                self._connect_lastfm, ScrobbleQueue(), log=self.log).start()
+            # recent scrobbles, to skip duplicates
+            self._scrobbles = deque(maxlen=SCROBBLE_MEMORY)
         host = settings.config['Server']['host']
         port = settings.config['Server'].getint('port')
         self.client = Client(host, port)
 
+    def _make_sinks(self, settings):
+        config = settings.config['Server']
+        try:
+            update_btt = config.getboolean('update_btt_widget')
+            desktop_notify = config.getboolean('desktop_notify')
+            debounce = config.getfloat('notify_debounce')
+        except ValueError as exc_info:
+            raise ValueError(
+                "Error in configuration, section '%s': %s"
+                % ('Server', exc_info))
+        sinks = []
+        if update_btt:
+            widget_uuid = settings.config['BTT']['widget UUID']
+            shared_secret = settings.config['BTT']['shared secret']
+            if widget_uuid == '':
+                self.log("Disabling update_bbt_widget: no widget UUID")
+            else:
+                sinks.append(BTTSink(widget_uuid, shared_secret))
+        if desktop_notify:
+            sinks.append(DesktopSink())
+        if len(config['status_file']) > 0:
+            sinks.append(FileSink(expanduser(config['status_file'])))
+        if len(config['webhook_url']) > 0:
+            sinks.append(WebhookSink(config['webhook_url']))
+        for sink in sinks:
+            sink.debounce = debounce
+            sink.log = self.log
+        return sinks
+
     def log(self, msg, timestamp=True):
         """Write a msg to the internal log file
 
@@ -119,36 +167,51 @@ class NotifyClient(object):
                 self.log("    " + str(exc_info), timestamp=False)
                 self.log("    No network connection", timestamp=False)
 
+    def _connect_lastfm(self, renew=False):
+        # called by the scrobbler thread; None if Last.fm can't be reached
+        if renew:
+            self._lastfm_network = None  # get a new session
+        if self._scrobble:
+            self._authenticate_lastfm()
+        return self._lastfm_network if self._scrobble else None
+
     def run(self):
         """Run the event loop
 
-        If scrobbling and btt updating is deactivated, return immediately.
+        If scrobbling is deactivated and there are no sinks, return
+        immediately.
         """
         current_artist = None
         current_title = None
         current_timestamp = 0
         try:
-            if not (self._scrobble or self._update_btt):
+            if not (self._scrobble or self.sinks):
                 self.log("Exit event loop: nothing to do")
                 return
+            for sink in self.sinks:
+                sink.start()
             prev_status = None
+            version = None
             while True:
                 try:
-                    status = self.client.status()
+                    # blocks until the server pushes a status change
+                    version, status = self.client.events(version)
                 except ApiConnError as exc_info:
                     self.log(str(exc_info))
+                    version = None
                     time.sleep(5)
                     continue
-                if status == prev_status:
-                    time.sleep(1.0)
+                if status is None or status == prev_status:
                     continue
                 else:
-                    self.update_btt(status)
+                    for sink in self.sinks:
+                        sink.update(status)
                     prev_status = status
                 self.log("status = %s" % str(status))
-                artist, title = self._get_artist_title(status)
+                artist, title, timestamp = self._get_artist_title(status)
                 if artist != current_artist or title != current_title:
-                    timestamp = int(time.time())
+                    if timestamp is None:
+                        timestamp = int(time.time())
                     play_duration = timestamp - current_timestamp
                     if self._scrobble:
                         need_to_scrobble = (
@@ -167,10 +230,11 @@ class NotifyClient(object):
                     current_artist = artist
                     current_title = title
                     current_timestamp = timestamp
+                    if self._scrobble and artist is not None:
+                        self._scrobbler.now_playing(artist, title)
                     self.log(
                         "Setting current artist/title: %s - %s"
                         % (current_artist, current_title))
-                time.sleep(1.0)
         except Exception as exc_info:
             self.log("FATAL: %s" % str(exc_info))
             raise
@@ -178,26 +242,11 @@ class NotifyClient(object):
             if self._log_fh is not None:
                 self._log_fh.close()
 
-    def update_btt(self, status):
-        if not self._update_btt:
-            return
-        song_str = _render_song_str(status)
-        song_str = song_str.replace("'", "\'")
-        cmd = [
-            'osascript', '-e',
-            'tell application "BetterTouchTool" '
-            'to update_touch_bar_widget "' + self._btt_widget_uuid +
-            '" text "' + song_str + '"']
-        if self._btt_shared_secret != '':
-            cmd[-1] = cmd[-1] + ' shared_secret "%s"' % self._btt_shared_secret
-        self.log(cmd)
-        subprocess.call(cmd)
-
     def scrobble(self, artist, title, timestamp):
         """Send a scrobble to Last.fm
 
-        Assuming srobbling is active in the config file settings, send the
-        given `artist`/`title` to Last.fm
+        Assuming srobbling is active in the config file settings, queue the
+        given `artist`/`title` for sending to Last.fm
 
         Args:
             artist (str): artist to submit in scrobble
@@ -206,7 +255,6 @@ class NotifyClient(object):
                 scrobble
         """
         if self._scrobble:
-            self._authenticate_lastfm()
             try:
                 prev_artist, prev_title = self._scrobbles[-1]
                 if artist == prev_artist and title == prev_title:
@@ -219,35 +267,219 @@ class NotifyClient(object):
                     artist, title,
                     time.strftime(
                         '%Y-%m-%d %H:%M:%S', time.localtime(int(timestamp)))))
-            try:
-                self._lastfm_network.scrobble(artist, title, int(timestamp))
-            except pylast.NetworkError as exc_info:
-                self.log(
-                    "Failed to scrobble %s - %s: %s"
-                    % (artist, title, str(exc_info)))
+            self._scrobbler.scrobble(artist, title, timestamp)
             self._scrobbles.append([artist, title])
 
     def _get_artist_title(self, status):
+        """Return (artist, title, timestamp) from the structured song
+        metadata in `status`, as parsed (once) by the server"""
+        meta = status.get('meta')
+        if meta is None or meta['artist'] is None:
+            self.log("cannot get artist/title: %s" % status.get('song'))
+            return None, None, None
+        return meta['artist'], meta['title'], int(meta['timestamp'])
+
+
+class Sink(object):
+    """Destination for status changes, updated in a background thread
+
+    `update` never blocks: it only replaces the pending status. The thread
+    waits `debounce` seconds for further changes, and sends only the latest
+    status, so rapid changes (e.g. skipping through streams) are coalesced
+    and a slow sink never delays the caller or other sinks. A status that
+    renders to what was sent last is not sent again.
+
+    Subclasses implement `send` (which returns False if there was nobody
+    to send to), and may override `render`.
+
+    Attributes:
+        sent (int): number of updates sent
+        coalesced (int): number of status changes that were superseded
+            before they were sent
+        failed (int): number of updates that could not be sent
+        latency (float): seconds from the status change to the completion
+            of the last update (including `debounce`)
+        max_latency (float): maximum of `latency`
+    """
+    name = 'sink'
+
+    def __init__(self, debounce=DEBOUNCE, log=print):
+        self.debounce = debounce
+        self.log = log
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.latency = None
+        self.max_latency = 0.0
+        self._pending = None
+        self._pending_since = None
+        self._last = None  # last payload sent
+        self._cond = Condition()
+
+    def __str__(self):
+        return ('%s(sent=%d,coalesced=%d,failed=%d,latency=%s)' % (
+            self.__class__.__name__, self.sent, self.coalesced,
+            self.failed, self.latency))
+
+    def __repr__(self):
+        return str(self)
+
+    def start(self):
+        thread = Thread(target=self.run, name='sink_%s' % self.name)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def update(self, status):
+        with self._cond:
+            if self._pending is None:
+                self._pending_since = time.time()
+            else:
+                self.coalesced += 1
+            self._pending = status
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+            time.sleep(self.debounce)
+            with self._cond:
+                status, since = self._pending, self._pending_since
+                self._pending = None
+            self.deliver(status, since)
+
+    def deliver(self, status, since):
+        try:
+            payload = self.render(status)
+            if payload is None or payload == self._last:
+                return
+            if self.send(payload) is False:
+                return  # nobody to send to
+        except Exception as exc_info:
+            self.failed += 1
+            self.log("%s: update failed: %s" % (self.name, exc_info))
+            return
+        self._last = payload
+        self.sent += 1
+        self.latency = time.time() - since
+        self.max_latency = max(self.max_latency, self.latency)
+        self.log("%s: updated in %.3fs" % (self.name, self.latency))
+
+    def render(self, status):
+        """Return the payload for `status`, or None to skip it"""
+        return _render_song_str(status)
+
+    def send(self, payload):
+        raise NotImplementedError()
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'latency': self.latency,
+            'max_latency': self.max_latency,
+        }
+
+
+class BTTSink(Sink):
+    """Update a BetterTouchTool touch bar widget"""
+    name = 'btt'
+
+    def __init__(self, widget_uuid, shared_secret='', **kwargs):
+        super(BTTSink, self).__init__(**kwargs)
+        self.widget_uuid = widget_uuid
+        self.shared_secret = shared_secret
+
+    def send(self, payload):
+        script = (
+            'tell application "BetterTouchTool" to update_touch_bar_widget '
+            '%s text %s' % (
+                _applescript_str(self.widget_uuid),
+                _applescript_str(payload)))
+        if self.shared_secret != '':
+            script += ' shared_secret %s' % _applescript_str(
+                self.shared_secret)
+        subprocess.check_call(['osascript', '-e', script])
+
+
+class DesktopSink(Sink):
+    """Show a desktop notification for every new song
+
+    Uses ``notify-send`` on Linux, and ``osascript`` on macOS.
+    """
+    name = 'desktop'
+
+    def render(self, status):
+        if not status['currently_streaming'] or status['paused']:
+            return None
+        return (str(status['stream']), _render_song_str(
+            status, show_stream=False))
+
+    def send(self, payload):
+        (stream, song) = payload
+        if sys.platform == 'darwin':
+            cmd = ['osascript', '-e', 'display notification %s with title %s'
+                   % (_applescript_str(song), _applescript_str(stream))]
+        else:
+            cmd = ['notify-send', '--app-name=tty_radio', stream, song]
+        subprocess.check_call(cmd)
+
+
+class FileSink(Sink):
+    """Write the song to a file, e.g. for status bars
+
+    A regular file is replaced atomically. If `path` is a FIFO, the song is
+    written to it only while a reader has it open.
+    """
+    name = 'file'
+
+    def __init__(self, path, **kwargs):
+        super(FileSink, self).__init__(**kwargs)
+        self.path = path
+
+    def send(self, payload):
+        data = (payload + '\n').encode('utf-8')
         try:
-            song = str(status['song'])
-            for s in self._filters:
-                if s in song:
-                    self.log("Filter %s" % song)
-                    return None, None
-            song = song.replace(" – ", " - ")
-            song = song.replace("“", '"')
-            song = song.replace("”", '"')
-            song = song.replace("‘", "'")
-            song = song.replace("’", "'")
-            artist, title = song.split(" - ", 1)
-            artist = artist.strip()
-            title = title.strip()
-            if len(artist) == 0 or len(title) == 0:
-                raise ValueError("empty artist or title")
-            return artist, title
-        except (ValueError, AttributeError, KeyError) as exc_info:
-            self.log("cannot get artist/title: %s" % exc_info)
-            return None, None
+            is_fifo = stat.S_ISFIFO(os.stat(self.path).st_mode)
+        except OSError:
+            is_fifo = False
+        if not is_fifo:
+            atomic_write(self.path, data)
+            return
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as exc_info:
+            if exc_info.errno == errno.ENXIO:
+                return False  # no reader
+            raise
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+class WebhookSink(Sink):
+    """POST the status (as json) to a URL"""
+    name = 'webhook'
+
+    def __init__(self, url, timeout=WEBHOOK_TIMEOUT, **kwargs):
+        super(WebhookSink, self).__init__(**kwargs)
+        self.url = url
+        self.timeout = timeout
+
+    def render(self, status):
+        return status
+
+    def send(self, payload):
+        requests.post(
+            self.url, json=payload, timeout=self.timeout).raise_for_status()
+
+
+def _applescript_str(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
 
 
 def _render_song_str(status, show_stopped=False, show_stream=True):
@@ -0,0 +1,215 @@
+"""What is playing on every stream, sampled in the background
+
+The titles of all SomaFM channels come with one request of its channel list
+(SOMA_CHANNELS); those of other streams are read from the ICY metadata of
+each stream (see `icy.read_title`), without playing it. Sweeps over the
+catalogue only run while somebody asks for the titles, so an idle server
+causes no traffic.
+"""
+from __future__ import print_function
+import platform
+PY3 = False
+if platform.python_version().startswith('3'):
+    PY3 = True
+from threading import Condition, Lock, Semaphore, Thread
+from time import sleep, time
+if PY3:
+    from urllib.parse import urlsplit
+else:
+    from urlparse import urlsplit
+
+import requests
+
+from .icy import read_title
+from .meta import soma_channel
+
+# seconds a sampled title is current; older ones are sampled again, and
+# they are dropped after twice that
+TITLE_TTL = 120
+# keep sweeping for this many seconds after titles were last asked for
+ACTIVE_TIMEOUT = 600
+# channel list of SomaFM, with the current title ('lastPlaying') of each
+SOMA_CHANNELS = 'https://somafm.com/channels.json'
+# streams sampled at the same time, in total and per host; every sample is
+# a new connection that reads up to two metadata blocks (some seconds of
+# audio), which is why the SomaFM streams are not sampled this way
+WORKERS = 16
+HOST_CONCURRENCY = 4
+# minimal seconds between the start of two connections to the same host
+HOST_INTERVAL = 0.05
+SAMPLE_TIMEOUT = 5  # in seconds
+
+
+class HostLimiter(object):
+    """Limit the concurrent connections to each host, and their rate
+
+    Args:
+        concurrency (int): connections to a host at the same time
+        interval (float): minimal seconds between the start of two
+            connections to a host
+    """
+    def __init__(self, concurrency=HOST_CONCURRENCY, interval=HOST_INTERVAL):
+        self.concurrency = concurrency
+        self.interval = interval
+        self._lock = Lock()
+        self._slots = {}  # host -> Semaphore
+        self._next = {}  # host -> earliest time of the next connection
+
+    def __str__(self):
+        return 'HostLimiter(concurrency=%s,interval=%s)' % (
+            self.concurrency, self.interval)
+
+    def __repr__(self):
+        return str(self)
+
+    def acquire(self, host):
+        """Block until a connection to `host` may be opened"""
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = Semaphore(self.concurrency)
+            slot = self._slots[host]
+        slot.acquire()
+        with self._lock:
+            now = time()
+            start = max(now, self._next.get(host, 0))
+            self._next[host] = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+    def release(self, host):
+        self._slots[host].release()
+
+
+class NowPlaying(object):
+    """Cache of the current titles of all streams, refreshed by sweeps
+
+    `get` returns the cached title of a stream right away; it also starts
+    sweeping (in a background thread) until ACTIVE_TIMEOUT seconds after
+    the last call. A sweep takes the titles of all SomaFM streams whose
+    title is older than `ttl` from the `channels` list, and samples the
+    other ones, `workers` at a time and limited per host by `limiter`.
+    SomaFM streams are sampled too if the channel list is not available.
+
+    Args:
+        streams (callable): returns the list of all Streams
+        ttl (float): seconds a sampled title is current
+        workers (int): number of streams sampled at the same time
+        limiter (HostLimiter): limits connections per host
+        channels (str): URL of the SomaFM channel list
+    """
+    def __init__(self, streams, ttl=TITLE_TTL, workers=WORKERS, limiter=None,
+                 channels=SOMA_CHANNELS):
+        self.streams = streams
+        self.ttl = ttl
+        self.workers = workers
+        if limiter is None:
+            limiter = HostLimiter()
+        self.limiter = limiter
+        self.channels = channels
+        self.sweeps = 0
+        self.sweep_time = None  # seconds the last sweep took
+        self._titles = {}  # url -> (meta dict or None, sampled time)
+        self._lock = Lock()
+        self._cond = Condition()
+        self._wanted = None  # time titles were last asked for
+        self._thread = None
+        self._session = requests.Session()
+
+    def __str__(self):
+        return 'NowPlaying(titles=%d,sweeps=%d,sweep_time=%s)' % (
+            len(self._titles), self.sweeps, self.sweep_time)
+
+    def __repr__(self):
+        return str(self)
+
+    def get(self, stream):
+        """Return the metadata (dict) last sampled for `stream`, or None"""
+        with self._cond:
+            self._wanted = time()
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='now_playing')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        with self._lock:
+            (meta, sampled) = self._titles.get(stream.url, (None, 0))
+        if time() - sampled > 2 * self.ttl:
+            return None
+        return meta
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while (self._wanted is None or
+                       time() - self._wanted > ACTIVE_TIMEOUT):
+                    self._cond.wait()
+            start = time()
+            self.sweep()
+            self.sweep_time = time() - start
+            self.sweeps += 1
+            sleep(self.ttl / 4.0)
+
+    def sweep(self):
+        """Sample all streams whose title is not current"""
+        from multiprocessing.pool import ThreadPool
+        streams = self.streams()
+        now = time()
+        todo = {}
+        with self._lock:
+            for stm in streams:
+                sampled = self._titles.get(stm.url, (None, 0))[1]
+                if now - sampled > self.ttl:
+                    todo[stm.url] = stm
+        soma = [stm for stm in todo.values()
+                if soma_channel(stm.url) is not None]
+        if len(soma) > 0 and self._sample_soma(soma):
+            for stm in soma:
+                del todo[stm.url]
+        if len(todo) == 0:
+            return
+        pool = ThreadPool(min(self.workers, len(todo)))
+        try:
+            pool.map(self._sample, list(todo.values()))
+        finally:
+            pool.close()
+
+    def _sample_soma(self, streams):
+        # all SomaFM titles at once, from the channel list; False if it
+        # isn't available
+        try:
+            resp = self._session.get(self.channels, timeout=SAMPLE_TIMEOUT)
+            resp.raise_for_status()
+            titles = dict(
+                (chan['id'], chan.get('lastPlaying'))
+                for chan in resp.json()['channels'])
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return False
+        for stm in streams:
+            song = titles.get(soma_channel(stm.url))
+            raw = None
+            if song is not None:
+                raw = "StreamTitle='%s';" % song
+            self._store(stm, raw)
+        return True
+
+    def _sample(self, stream):
+        host = urlsplit(stream.url).hostname
+        self.limiter.acquire(host)
+        try:
+            raw = read_title(
+                stream.url, timeout=SAMPLE_TIMEOUT, session=self._session)
+        except (requests.RequestException, IOError, ValueError):
+            raw = None
+        finally:
+            self.limiter.release(host)
+        self._store(stream, raw)
+
+    def _store(self, stream, raw):
+        # keep the title of the ICY-META block `raw` (None if none)
+        meta = None
+        if raw is not None:
+            meta = stream.rules.parse_song(raw)
+        if meta is not None:
+            meta = meta.as_dict()
+        with self._lock:
+            self._titles[stream.url] = (meta, time())
@@ -0,0 +1,171 @@
+"""Playlists (.pls, .m3u) of stream URLs
+
+Playlists are resolved to their stream URLs once, and kept (on disk) for
+PLAYLIST_TTL seconds by a PlaylistCache, so that playing a stream does not
+download its playlist every time.
+"""
+from __future__ import print_function
+import json
+from threading import Lock
+from time import time
+from os.path import expanduser, join as path_join
+
+import requests
+
+from .cache import CACHE_DIR, DiskCache
+
+# URLs with these endings are playlists (mpg123 LOADLIST instead of LOAD)
+PLAYLIST_EXTS = ('.pls', '.m3u')
+FETCH_TIMEOUT = 10  # in seconds
+# seconds a resolved playlist is used before it is fetched again
+PLAYLIST_TTL = 24 * 60 * 60
+# seconds a stream URL that failed is tried only after the other ones
+DEAD_TTL = 10 * 60
+PLAYLIST_CACHE_SIZE = 256 * 1024  # in bytes
+
+
+def is_playlist(url):
+    return url.lower().split('?', 1)[0].endswith(PLAYLIST_EXTS)
+
+
+def parse(text):
+    """Return the list of stream URLs in the playlist `text`
+
+    Understands the ``FileN=<url>`` entries of .pls files, and the plain
+    (or extended) .m3u format with one URL per line.
+    """
+    urls = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.lower().startswith('file') and '=' in line:
+            line = line.split('=', 1)[1].strip()
+        if line.startswith(('http://', 'https://')):
+            urls.append(line)
+    return urls
+
+
+class PlaylistCache(object):
+    """Stream URLs of playlists, resolved once and kept for `ttl` seconds
+
+    Stream URLs reported as `failed` go to the end of the list for DEAD_TTL
+    seconds, so the next attempt fails over to another entry of the
+    playlist. If a playlist cannot be fetched again after `ttl`, its
+    previous stream URLs are used.
+
+    Args:
+        cache (DiskCache): where the playlists are kept, defaults to
+            ``~/.tty_radio-cache/playlists``
+        ttl (float): seconds a resolved playlist is used
+    """
+    def __init__(self, cache=None, ttl=PLAYLIST_TTL):
+        if cache is None:
+            cache = DiskCache(
+                PLAYLIST_CACHE_SIZE,
+                path=path_join(expanduser('~'), CACHE_DIR, 'playlists'))
+        self.cache = cache
+        self.ttl = ttl
+        self.fetches = 0
+        self._lock = Lock()
+        # playlist url -> {'urls': [...], 'resolved': time,
+        #                  'dead': {stream url: time it failed}}
+        self._entries = {}
+
+    def __str__(self):
+        return 'PlaylistCache(cache=%s,ttl=%s,fetches=%d)' % (
+            self.cache, self.ttl, self.fetches)
+
+    def __repr__(self):
+        return str(self)
+
+    def _entry(self, url):
+        with self._lock:
+            if url not in self._entries:
+                (data, meta) = self.cache.get('playlist:' + url)
+                try:
+                    self._entries[url] = json.loads(data.decode('utf-8'))
+                except (AttributeError, ValueError):
+                    self._entries[url] = None
+            return self._entries[url]
+
+    def _store(self, url, entry):
+        with self._lock:
+            self._entries[url] = entry
+        self.cache.put('playlist:' + url, json.dumps(entry).encode('utf-8'))
+
+    def urls(self, url, timeout=FETCH_TIMEOUT, session=None):
+        """Return the stream URLs of the playlist `url`, those that did not
+        fail recently first; ``[url]`` if `url` is not a playlist
+
+        Raises ValueError if the playlist has no stream URLs, and
+        requests.RequestException if it cannot be fetched (and was not
+        resolved before). The playlist is fetched with the requests.Session
+        `session`, if given.
+        """
+        if not is_playlist(url):
+            return [url]
+        entry = self._entry(url)
+        if entry is None or time() - entry['resolved'] > self.ttl:
+            try:
+                entry = self._fetch(url, timeout, session, entry)
+            except (requests.RequestException, ValueError):
+                if entry is None:
+                    raise
+                # stale, but better than nothing
+        now = time()
+        dead = entry['dead']
+        # stable sort, so the playlist order is kept otherwise
+        return sorted(
+            entry['urls'], key=lambda u: now - dead.get(u, 0) < DEAD_TTL)
+
+    def _fetch(self, url, timeout, session, old):
+        if session is None:
+            session = requests
+        self.fetches += 1
+        resp = session.get(url, timeout=timeout)
+        resp.raise_for_status()
+        urls = parse(resp.text)
+        if len(urls) == 0:
+            raise ValueError('no stream URL in playlist %s' % url)
+        dead = {}
+        if old is not None:
+            dead = dict((u, t) for (u, t) in old['dead'].items() if u in urls)
+        entry = {'urls': urls, 'resolved': time(), 'dead': dead}
+        self._store(url, entry)
+        return entry
+
+    def failed(self, url, stream_url):
+        """Note that `stream_url` of the playlist `url` could not be played"""
+        entry = self._entry(url)
+        if entry is None or stream_url not in entry['urls']:
+            return
+        entry = dict(entry, dead=dict(entry['dead']))
+        entry['dead'][stream_url] = time()
+        self._store(url, entry)
+
+    def succeeded(self, url, stream_url):
+        """Note that `stream_url` of the playlist `url` plays"""
+        entry = self._entry(url)
+        if entry is None or stream_url not in entry['dead']:
+            return
+        entry = dict(entry, dead=dict(entry['dead']))
+        del entry['dead'][stream_url]
+        self._store(url, entry)
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_cache():
+    """Return the (shared) PlaylistCache"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PlaylistCache()
+        return _cache
+
+
+def resolve(url, timeout=FETCH_TIMEOUT, session=None):
+    """Return the first stream URL of a playlist `url` (see
+    `PlaylistCache.urls`), or `url` itself if it is not a playlist"""
+    return get_cache().urls(url, timeout, session)[0]
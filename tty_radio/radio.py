@@ -1,22 +1,166 @@
 from __future__ import print_function
+import platform
+PY3 = False
+if platform.python_version().startswith('3'):
+    PY3 = True
+from collections import OrderedDict
+from itertools import count
+from threading import Condition, Event, RLock, Thread
+if PY3:
+    from queue import Queue
+else:
+    from Queue import Queue
 
 from .station import Favs, Soma
+from .history import History
 
+# playback states
+IDLE = 'idle'
+STARTING = 'starting'
+PLAYING = 'playing'
+PAUSING = 'pausing'
+PAUSED = 'paused'
+STOPPING = 'stopping'
+# state while a transition is in progress, and once it is done
+TRANSITIONS = {
+    'play': (STARTING, PLAYING),
+    'pause': (PAUSING, PAUSED),
+    'stop': (STOPPING, IDLE),
+}
+# number of finished transitions that can still be looked up by id
+TRANSITION_HISTORY = 100
 
-class Radio(object):
+
+class StatusFeed(object):
+    """Version counter for the player status that clients can wait on
+
+    Every change of the play state or of the stream metadata bumps the
+    version. `wait` blocks until the version differs from the one a client
+    has last seen, so clients get pushed changes instead of polling.
+    """
     def __init__(self):
+        self.version = 0
+        self._cond = Condition()
+
+    def __str__(self):
+        return 'StatusFeed(version=%s)' % self.version
+
+    def __repr__(self):
+        return str(self)
+
+    def notify(self):
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+
+    def wait(self, version, timeout=None):
+        """Wait until the version is not `version`, return the current one
+
+        Returns immediately if `version` is already outdated. If there was no
+        change within `timeout` seconds, `version` is returned unchanged.
+        """
+        with self._cond:
+            if self.version == version:
+                self._cond.wait(timeout)
+            return self.version
+
+
+class Transition(object):
+    """A requested change of the playback state
+
+    Transitions are executed in order by the Radio's worker thread; `wait`
+    blocks until this one is done.
+    """
+    def __init__(self, tid, action, station=None, stream=None):
+        self.id = tid
+        self.action = action
+        self.station = station
+        self.stream = stream
+        self.error = None
+        self.done = Event()
+
+    def __str__(self):
+        return ('Transition(id=%s,action=%s,station=%s,stream=%s,done=%s)' %
+                (self.id, self.action, self.station, self.stream,
+                 self.done.is_set()))
+
+    def __repr__(self):
+        return str(self)
+
+    def wait(self, timeout=None):
+        """Block until the transition is done, return True if it is"""
+        return self.done.wait(timeout)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'station': self.station,
+            'stream': self.stream,
+            'done': self.done.is_set(),
+            'error': self.error,
+        }
+
+
+class Radio(object):
+    """Playback state machine over the stations
+
+    The state is one of idle, starting, playing, pausing, paused and stopping,
+    and changes only under a lock. `play`, `pause` and `stop` are executed as
+    transitions by a worker thread; the ``request_*`` methods return the
+    Transition immediately, the plain methods wait for it.
+
+    The songs played are recorded in `history` (a History).
+
+    A stop that is followed by a play (switching streams) leaves the old
+    stream playing until the new one can take over, see
+    `stream.Mpg123Engine`.
+    """
+    def __init__(self, history=None):
         self._station = None
         self._stream = None
+        if history is None:
+            history = History()
+        self.history = history
         self._stations = [
             Favs(),
             Soma()]
+        self._by_name = dict((st.name, st) for st in self._stations)
+        self.feed = StatusFeed()
+        for st in self._stations:
+            st.on_change = self._stream_changed
+        # serialized station list, and the station generations it is from
+        self._catalogue = None
+        self._catalogue_key = None
+        self._lock = RLock()
+        self._state = IDLE
+        self._tids = count(1)
+        self._latest = None
+        self._transitions = OrderedDict()
+        self._queue = None
 
     def __str__(self):
-        return 'Radio(station=%s,stream=%s)' % (self.station, self.stream)
+        return ('Radio(station=%s,stream=%s,state=%s)' %
+                (self.station, self.stream, self.state))
 
     def __repr__(self):
         return str(self)
 
+    def _stream_changed(self, stream, what):
+        # metadata of a stream changed, only the active one is of interest
+        if stream is self._stream:
+            if what == 'song':
+                if stream.meta is None:
+                    self.history.end()
+                else:
+                    self.history.start(
+                        stream.station, stream.name, stream.meta)
+            self.feed.notify()
+
+    @property
+    def state(self):
+        return self._state
+
     @property
     def station(self):
         if self._station is None:
@@ -29,10 +173,17 @@ class Radio(object):
             self.set(station_name)
 
     def station_obj(self, station):
-        possibles = [st for st in self._stations if station == st.name]
-        if len(possibles) != 1:
-            return None
-        return possibles[0]
+        return self._by_name.get(station)
+
+    def reload(self):
+        """Reload the streams of every station whose file changed, and
+        start refreshing outdated station files"""
+        reloaded = False
+        for st in self._stations:
+            st.revalidate()
+            if st.reload():
+                reloaded = True
+        return reloaded
 
     @property
     def stream(self):
@@ -40,19 +191,25 @@ class Radio(object):
             return None
         return self._stream.name
 
+    @property
+    def catalogue_key(self):
+        """Changes whenever the streams of any station change"""
+        self.reload()
+        return tuple(st.generation for st in self._stations)
+
     @property
     def stations(self):
         # return [st.name for st in self._stations]
-        stations = []
-        for st in self._stations:
-            streams = []
-            for stm in st.streams:
-                streams.append(stm.name)
-            stations.append({
-                'name': st.name,
-                'ui_name': st.ui_name,
-                'streams': streams})
-        return stations
+        key = self.catalogue_key
+        if key != self._catalogue_key:
+            stations = []
+            for st in self._stations:
+                stations.append({
+                    'name': st.name,
+                    'ui_name': st.ui_name,
+                    'streams': [stm.name for stm in st.streams]})
+            (self._catalogue, self._catalogue_key) = (stations, key)
+        return self._catalogue
 
     @property
     def song(self):
@@ -64,66 +221,203 @@ class Radio(object):
             # return self._stream.meta_name
         return song
 
+    @property
+    def meta_name(self):
+        if self._stream is None:
+            return None
+        return self._stream.meta_name
+
+    @property
+    def meta_song(self):
+        if self._stream is None:
+            return None
+        return self._stream.meta_song
+
+    @property
+    def meta(self):
+        """Structured metadata of the current song (dict), or None"""
+        if self._stream is None or self._stream.meta is None:
+            return None
+        return self._stream.meta.as_dict()
+
     @property
     def is_playing(self):
-        if self._stream is not None and self._stream.is_playing:
-            return True
-        return False
+        # a stream is active (possibly paused), or about to be
+        return self._state in (STARTING, PLAYING, PAUSING, PAUSED)
 
     @property
     def is_paused(self):
-        if self._stream is not None and self._stream.is_paused:
-            return True
-        return False
+        return self._state in (PAUSING, PAUSED)
+
+    def snapshot(self):
+        """Consistent view of the state, for status reports"""
+        with self._lock:
+            return {
+                'state': self._state,
+                'currently_streaming': self.is_playing,
+                'paused': self.is_paused,
+                'station': self.station,
+                'stream': self.stream,
+                'song': self.song,
+                'meta_name': self.meta_name,
+                'meta_song': self.meta_song,
+                'meta': self.meta,
+            }
 
     def set(self, station_name, stream_name=None):
-        if stream_name is None and station_name == self.station:
-            # print('Ignoring, station is same for set')
-            return True
-        if station_name == self.station and stream_name == self.stream:
-            # print('Ignoring, station and stream are same for set')
-            return True
-        if self.is_playing:
-            # print('Error, stop stream before set')
-            return False
-        obj = self.station_obj(station_name)
-        if obj is None:
-            # print('Error, no matching station')
-            return False
-        self._station = obj
-        self._stream = None
-        if stream_name is None:
+        with self._lock:
+            if stream_name is None and station_name == self.station:
+                # print('Ignoring, station is same for set')
+                return True
+            if station_name == self.station and stream_name == self.stream:
+                # print('Ignoring, station and stream are same for set')
+                return True
+            if self.is_playing:
+                # print('Error, stop stream before set')
+                return False
+            obj = self.station_obj(station_name)
+            if obj is None:
+                # print('Error, no matching station')
+                return False
+            self._station = obj
+            self._stream = None
+            self.feed.notify()
+            if stream_name is None:
+                return True
+            obj = self._station.stream_obj(stream_name)
+            if obj is None:
+                # print('Error, no matching stream')
+                return False
+            self._stream = obj
             return True
-        obj = self._station.stream_obj(stream_name)
-        if obj is None:
-            # print('Error, no matching stream')
-            return False
-        self._stream = obj
-        return True
+
+    def transition(self, tid):
+        """Return the (recent) Transition with the id `tid`, or None"""
+        with self._lock:
+            return self._transitions.get(tid)
+
+    def _begin(self, action, run):
+        # enter the in-progress state of `action` and queue it for the worker
+        # with the lock held; a transition with run=False is a no-op
+        t = Transition(next(self._tids), action, self.station, self.stream)
+        self._transitions[t.id] = t
+        while len(self._transitions) > TRANSITION_HISTORY:
+            self._transitions.popitem(last=False)
+        if not run:
+            t.done.set()
+            return t
+        self._state = TRANSITIONS[action][0]
+        self._latest = t.id
+        if self._queue is None:
+            self._queue = Queue()
+            worker = Thread(target=self._work, name='radio_transitions')
+            worker.daemon = True
+            worker.start()
+        self._queue.put((t, self._stream))
+        self.feed.notify()
+        return t
+
+    def _work(self):
+        while True:
+            (t, stream) = self._queue.get()
+            try:
+                if t.action == 'stop' and self._switching(t):
+                    stream.stop(switching=True)
+                else:
+                    getattr(stream, t.action)()
+                final_state = TRANSITIONS[t.action][1]
+            except Exception as exc_info:
+                t.error = str(exc_info)
+                final_state = IDLE
+                try:
+                    stream.stop()
+                except Exception:
+                    pass
+            if final_state != PLAYING:
+                self.history.end()
+            with self._lock:
+                # a later transition may already be under way
+                if t.id == self._latest:
+                    self._state = final_state
+            t.done.set()
+            self.feed.notify()
+
+    def _switching(self, t):
+        # whether a play was requested after the transition `t`
+        with self._lock:
+            latest = self._transitions.get(self._latest)
+            return (latest is not None and latest.id != t.id and
+                    latest.action == 'play')
+
+    def pretune(self, station=None, stream=None):
+        """Buffer a stream in the background, so that playing it starts
+        without delay
+
+        By default, the stream after the current one in the current station
+        is pretuned. Return the name of the stream, or None if it cannot be
+        pretuned.
+        """
+        with self._lock:
+            if station is None:
+                st = self._station
+            else:
+                st = self.station_obj(station)
+            if st is None:
+                return None
+            if stream is None:
+                streams = st.streams
+                if len(streams) == 0:
+                    return None
+                try:
+                    i = streams.index(self._stream) + 1
+                except ValueError:
+                    i = 0
+                obj = streams[i % len(streams)]
+            else:
+                obj = st.stream_obj(stream)
+        if obj is None or not obj.pretune():
+            return None
+        return obj.name
+
+    def request_play(self, station=None, stream=None):
+        """Start playback, return the Transition or None if not possible"""
+        with self._lock:
+            if self._state in (STARTING, PLAYING):
+                # print('Error, stop/pause stream before play')
+                return None
+            if station is not None and stream is not None:
+                if not self.set(station, stream):
+                    return None
+            if self.station is None or self.stream is None:
+                # print('Error, no station/stream set')
+                return None
+            return self._begin('play', run=True)
+
+    def request_pause(self):
+        with self._lock:
+            run = (self._stream is not None and
+                   self._state in (STARTING, PLAYING))
+            return self._begin('pause', run)
+
+    def request_stop(self):
+        with self._lock:
+            run = (self._stream is not None and
+                   self._state not in (IDLE, STOPPING))
+            return self._begin('stop', run)
 
     def play(self, station=None, stream=None):
-        if self.is_playing and not self.is_paused:
-            # print('Error, stop/pause stream before play')
-            return (None, None)
-        if station is not None and stream is not None:
-            self.set(station, stream)
-        if self.station is None or self.stream is None:
-            # print('Error, no station/stream set')
+        t = self.request_play(station, stream)
+        if t is None:
             return (None, None)
-        # if not set, then carp
-        self._stream.play()
-        return (self.station, self.stream)
+        t.wait()
+        return (t.station, t.stream)
 
     def pause(self):
-        try:
-            self._stream.pause()
-        except AttributeError:
-            pass
-        return (self.station, self.stream)
+        t = self.request_pause()
+        t.wait()
+        return (t.station, t.stream)
 
     def stop(self):
-        try:
-            self._stream.stop()
-        except AttributeError:
-            pass
-        return (self.station, self.stream)
+        t = self.request_stop()
+        t.wait()
+        return (t.station, t.stream)
@@ -0,0 +1,281 @@
+"""Relay of streams to any number of local and remote listeners
+
+In relay mode, the server opens a single upstream connection per stream,
+strips the ICY metadata from it, and serves the audio to mpg123 (and any
+other HTTP client) from a shared ring buffer. The metadata is passed to the
+subscribed readers directly.
+"""
+from __future__ import print_function
+import platform
+PY3 = False
+if platform.python_version().startswith('3'):
+    PY3 = True
+from threading import Condition, Lock, Thread
+from time import sleep, time
+if PY3:
+    from urllib.parse import quote
+else:
+    from urllib import quote
+
+import requests
+
+from .icy import IcyParser, REQUEST_HEADERS
+from .playlist import get_cache as get_playlists, resolve
+
+# bytes of audio kept for listeners (about 1 min. at 128 kbit/s)
+RING_SIZE = 1024 * 1024
+# bytes a new listener gets right away, so that the player starts quickly
+BURST = 64 * 1024
+CHUNK = 8192
+CONNECT_TIMEOUT = 10  # in seconds
+READ_TIMEOUT = 30  # in seconds
+# seconds without listeners after which the upstream connection is closed
+IDLE_TIMEOUT = 10
+# seconds to wait before reconnecting after an error, doubled up to
+# RETRY_MAX on every failure
+RETRY_MIN = 1
+RETRY_MAX = 60
+
+
+class RingBuffer(object):
+    """The most recent `size` bytes of a stream, for one writer and any
+    number of readers
+
+    Positions count all bytes ever written; a reader that fell behind by
+    more than `size` bytes skips ahead.
+    """
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.end = 0  # position after the last byte written
+        self.closed = False
+        self._data = bytearray()
+        self._cond = Condition()
+
+    def __str__(self):
+        return 'RingBuffer(size=%s,end=%s,closed=%s)' % (
+            self.size, self.end, self.closed)
+
+    def __repr__(self):
+        return str(self)
+
+    def write(self, data):
+        with self._cond:
+            self._data += data
+            if len(self._data) > self.size:
+                del self._data[:len(self._data) - self.size]
+            self.end += len(data)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def start(self, burst=BURST):
+        """Position for a new reader, `burst` bytes before the end"""
+        with self._cond:
+            return max(self.end - min(burst, len(self._data)), 0)
+
+    def read(self, pos, timeout=None):
+        """Return ``(data, pos)``: the bytes after `pos`, and the position
+        after them
+
+        Blocks until there is data; `data` is empty if the buffer is closed,
+        or after `timeout` seconds.
+        """
+        with self._cond:
+            if pos >= self.end and not self.closed:
+                self._cond.wait(timeout)
+            first = self.end - len(self._data)
+            pos = max(pos, first)
+            return (bytes(self._data[pos - first:]), self.end)
+
+
+class Relay(object):
+    """A single upstream connection to a stream, shared by all listeners
+
+    The connection is opened by `start`, re-opened after errors, and closed
+    when there were no listeners for IDLE_TIMEOUT seconds. Readers
+    subscribed with `subscribe` get the ICY lines of the stream (e.g.
+    ``ICY-META: StreamTitle='...';``), in the format mpg123 reports them.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.buffer = RingBuffer()
+        self.name = None
+        self.meta = None  # latest metadata block
+        self.listeners = 0
+        self.error = None
+        self.upstream_bytes = 0
+        self._readers = []
+        self._lock = Lock()
+        self._last_active = time()
+        self._thread = None
+
+    def __str__(self):
+        return ('Relay(url=%s,listeners=%d,running=%s)' %
+                (self.url, self.listeners, self.is_running))
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def is_running(self):
+        return self._thread is not None and not self.buffer.closed
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='relay')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def subscribe(self, reader):
+        """Pass the ICY lines of the stream to `reader`, starting with the
+        current ones"""
+        with self._lock:
+            self._readers.append(reader)
+            (name, meta) = (self.name, self.meta)
+        if name is not None:
+            reader('ICY-NAME: %s' % name)
+        if meta is not None:
+            reader('ICY-META: %s' % meta)
+
+    def unsubscribe(self, reader):
+        with self._lock:
+            if reader in self._readers:
+                self._readers.remove(reader)
+
+    def _icy(self, line):
+        with self._lock:
+            readers = list(self._readers)
+        for reader in readers:
+            reader(line)
+
+    def _is_idle(self):
+        with self._lock:
+            if self.listeners > 0:
+                self._last_active = time()
+            return time() - self._last_active > IDLE_TIMEOUT
+
+    def _run(self):
+        retry = 0
+        try:
+            while not self._is_idle():
+                try:
+                    self._relay()
+                    retry = 0
+                except (requests.RequestException, IOError,
+                        ValueError) as exc_info:
+                    self.error = str(exc_info)
+                    retry = min(max(2 * retry, RETRY_MIN), RETRY_MAX)
+                    sleep(retry)
+        finally:
+            self.buffer.close()
+
+    def _relay(self):
+        stream_url = resolve(self.url)
+        try:
+            resp = requests.get(
+                stream_url, headers=REQUEST_HEADERS, stream=True,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            resp.raise_for_status()
+        except requests.RequestException as exc_info:
+            if exc_info.response is not None:
+                exc_info.response.close()
+            # try the next stream URL of a playlist next time
+            get_playlists().failed(self.url, stream_url)
+            raise
+        try:
+            self.error = None
+            name = resp.headers.get('icy-name')
+            if name is not None and name != self.name:
+                self.name = name
+                self._icy('ICY-NAME: %s' % name)
+            parser = IcyParser(int(resp.headers.get('icy-metaint', 0)))
+            for chunk in resp.iter_content(CHUNK):
+                self.upstream_bytes += len(chunk)
+                (audio, metadata) = parser.feed(chunk)
+                if audio:
+                    self.buffer.write(audio)
+                for meta in metadata:
+                    # empty blocks just repeat the current metadata
+                    if meta and meta != self.meta:
+                        self.meta = meta
+                        self._icy('ICY-META: %s' % meta)
+                if self._is_idle():
+                    return
+        finally:
+            resp.close()
+
+    def listen(self):
+        """Generate the audio of the stream, for one listener"""
+        with self._lock:
+            self.listeners += 1
+            self._last_active = time()
+        try:
+            pos = self.buffer.start()
+            while True:
+                (data, pos) = self.buffer.read(pos, READ_TIMEOUT)
+                if data:
+                    yield data
+                elif self.buffer.closed:
+                    return
+        finally:
+            with self._lock:
+                self.listeners -= 1
+                self._last_active = time()
+
+
+class RelayHub(object):
+    """The relays of the server, one per stream URL
+
+    Args:
+        base_url (str): URL of the server's relay endpoint (e.g.
+            ``http://127.0.0.1:7887/relay``), that the local player connects
+            to
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self._relays = {}
+        self._lock = Lock()
+
+    def __str__(self):
+        return 'RelayHub(base_url=%s,relays=%d)' % (
+            self.base_url, len(self._relays))
+
+    def __repr__(self):
+        return str(self)
+
+    def relay(self, url):
+        """Return the running Relay of `url`, starting one if necessary"""
+        with self._lock:
+            relay = self._relays.get(url)
+            if relay is None or not relay.is_running:
+                relay = Relay(url).start()
+                self._relays[url] = relay
+            return relay
+
+    def local_url(self, stream):
+        """URL of `stream` (a Stream) at the relay endpoint"""
+        return '%s/%s/%s' % (
+            self.base_url, quote(stream.station, safe=''),
+            quote(stream.name, safe=''))
+
+    def attach(self, stream):
+        """Subscribe the reader of `stream` to its relay, return the URL
+        the player should load"""
+        self.relay(stream.url).subscribe(stream.reader)
+        return self.local_url(stream)
+
+    def detach(self, stream):
+        with self._lock:
+            relay = self._relays.get(stream.url)
+        if relay is not None:
+            relay.unsubscribe(stream.reader)
+
+    def stats(self):
+        with self._lock:
+            relays = [r for r in self._relays.values() if r.is_running]
+        return [{'url': r.url, 'listeners': r.listeners,
+                 'upstream_bytes': r.upstream_bytes, 'error': r.error}
+                for r in relays]
@@ -0,0 +1,198 @@
+from __future__ import print_function
+import json
+from threading import Condition, Lock, Thread
+from time import time
+from os.path import expanduser, join as path_join
+
+from .cache import atomic_write
+
+# if you change QUEUE_FILE, make sure to update the documentation
+QUEUE_FILE = '.tty_radio-scrobbles.jsonl'
+# Last.fm accepts at most 50 scrobbles per request
+BATCH_SIZE = 50
+# seconds to wait before retrying after a failure, doubled on every
+# failure up to BACKOFF_MAX
+BACKOFF_MIN = 5
+BACKOFF_MAX = 30 * 60
+# Last.fm error codes meaning that a batch of scrobbles will never be
+# accepted (invalid parameters, invalid resource); all others (e.g. 9:
+# session expired, 11: service offline, 16: temporary error, 29: rate limit
+# exceeded) are retried
+REJECTED_CODES = ('6', '7')
+SESSION_EXPIRED = '9'
+
+
+class ScrobbleQueue(object):
+    """Scrobbles not yet accepted by Last.fm, persisted in a file
+
+    The file has one json object per line, so new scrobbles are appended;
+    it is rewritten only when scrobbles are removed.
+
+    Args:
+        path (str): the queue file, defaults to
+            ``~/.tty_radio-scrobbles.jsonl``
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = path_join(expanduser('~'), QUEUE_FILE)
+        self.path = path
+        self._lock = Lock()
+        self._items = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self._items.append(json.loads(line))
+                    except ValueError:
+                        pass  # partially written line
+        except IOError:
+            pass
+
+    def __str__(self):
+        return 'ScrobbleQueue(path=%s,len=%d)' % (self.path, len(self))
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, artist, title, timestamp):
+        item = {'artist': artist, 'title': title, 'timestamp': int(timestamp)}
+        with self._lock:
+            self._items.append(item)
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(item) + '\n')
+            except IOError as exc_info:
+                print("Warning: couldn't write %s: %s" % (self.path, exc_info))
+
+    def peek(self, n):
+        """Return (up to) the `n` oldest scrobbles"""
+        with self._lock:
+            return list(self._items[:n])
+
+    def drop(self, n):
+        """Remove the `n` oldest scrobbles"""
+        with self._lock:
+            del self._items[:n]
+            data = ''.join(json.dumps(item) + '\n' for item in self._items)
+            try:
+                atomic_write(self.path, data.encode('utf-8'))
+            except (IOError, OSError) as exc_info:
+                print("Warning: couldn't write %s: %s" % (self.path, exc_info))
+
+
+class Scrobbler(object):
+    """Submit scrobbles and now-playing updates in a background thread
+
+    Scrobbles go through `queue` (a ScrobbleQueue) and are submitted in
+    batches of up to BATCH_SIZE. If Last.fm cannot be reached, or reports a
+    temporary error, the scrobbles stay queued (also across restarts), and
+    submission is retried with exponential backoff. A batch is dropped only
+    if Last.fm rejects it (see REJECTED_CODES). Only the latest now-playing
+    update is sent, and it is never retried.
+
+    Args:
+        connect (callable): returns the Last.fm network (e.g. a
+            ``pylast.LastFMNetwork``), or None if it is not available; it is
+            called as ``connect(renew=True)`` after the session expired
+        queue (ScrobbleQueue): the queue of scrobbles
+        log (callable): receives log messages
+    """
+    def __init__(self, connect, queue, log=print):
+        self.connect = connect
+        self.queue = queue
+        self.log = log
+        self.backoff = 0  # seconds until the next attempt after a failure
+        self._retry_at = 0  # time of the next attempt after a failure
+        self._renew = False  # the session expired
+        self._now_playing = None
+        self._cond = Condition()
+        self._thread = None
+
+    def __str__(self):
+        return ('Scrobbler(queue=%s,backoff=%s)' % (self.queue, self.backoff))
+
+    def __repr__(self):
+        return str(self)
+
+    def start(self):
+        self._thread = Thread(target=self.run, name='scrobbler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def scrobble(self, artist, title, timestamp):
+        self.queue.put(artist, title, timestamp)
+        with self._cond:
+            self._cond.notify()
+
+    def now_playing(self, artist, title):
+        with self._cond:
+            self._now_playing = (artist, title)
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                # new scrobbles don't cut a backoff short
+                while time() < self._retry_at:
+                    self._cond.wait(self._retry_at - time())
+                while self._now_playing is None and len(self.queue) == 0:
+                    self._cond.wait()
+                (now_playing, self._now_playing) = (self._now_playing, None)
+            self.step(now_playing)
+
+    def step(self, now_playing=None):
+        """Send the now-playing update, then the queued scrobbles
+
+        Returns False if Last.fm could not be reached.
+        """
+        if self._renew:
+            network = self.connect(renew=True)
+            self._renew = False
+        else:
+            network = self.connect()
+        if network is None:
+            return self._failed('not connected')
+        if now_playing is not None:
+            try:
+                network.update_now_playing(
+                    artist=now_playing[0], title=now_playing[1])
+            except Exception as exc_info:
+                self.log("Failed to update now playing: %s" % exc_info)
+        while len(self.queue) > 0:
+            batch = self.queue.peek(BATCH_SIZE)
+            try:
+                network.scrobble_many(batch)
+            except Exception as exc_info:
+                code = error_code(exc_info)
+                if code not in REJECTED_CODES:
+                    self._renew = (code == SESSION_EXPIRED)
+                    return self._failed(exc_info)
+                self.log("Last.fm rejected %d scrobbles: %s" %
+                         (len(batch), exc_info))
+            else:
+                self.log("Scrobbled %d songs (%s - %s ...)" % (
+                    len(batch), batch[0]['artist'], batch[0]['title']))
+            self.queue.drop(len(batch))
+        self.backoff = 0
+        self._retry_at = 0
+        return True
+
+    def _failed(self, reason):
+        self.backoff = min(max(2 * self.backoff, BACKOFF_MIN), BACKOFF_MAX)
+        self._retry_at = time() + self.backoff
+        self.log("Failed to scrobble (%d queued): %s. Retry in %ds" %
+                 (len(self.queue), reason, self.backoff))
+        return False
+
+
+def error_code(exc_info):
+    """Return the Last.fm error code (str) of an exception like
+    pylast.WSError, or None for other errors (e.g. no network)"""
+    get_id = getattr(exc_info, 'get_id', None)
+    if get_id is None:
+        return None
+    return str(get_id())
@@ -21,10 +21,19 @@ class Settings(object):
             ('Server', OrderedDict([
                 ('host', '127.0.0.1'),
                 ('port', '7887'),
+                ('backend', 'threaded'),
+                ('status_socket', '~/.tty_radio-status.sock'),
+                ('relay', 'no'),
                 ('volume', '11000'),
                 ('scrobble', 'no'),
                 ('notify_logfile', ''),
+                ('history_size', '500'),
+                ('history_logfile', ''),
                 ('update_btt_widget', 'no'),
+                ('desktop_notify', 'no'),
+                ('status_file', ''),
+                ('webhook_url', ''),
+                ('notify_debounce', '0.25'),
             ])),
             ('UI',  OrderedDict([
                 ('theme', 'auto'),
@@ -62,6 +71,7 @@ class Settings(object):
                      whimsy, xbritebi, xcourbi""")
                 ),  # line breaks MUST match __main__.config docstring
                 ('show_stream_ascii_art', 'yes'),
+                ('art_cache_size', '10'),
             ])),
             ('theme_miami_vice', OrderedDict([
                 ('ui_banner', 'red'),
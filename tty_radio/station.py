@@ -3,30 +3,54 @@ import platform
 PY3 = False
 if platform.python_version().startswith('3'):
     PY3 = True
-from os import rename
+import re
 import csv
-from bs4 import BeautifulSoup
 from time import time
+from threading import Lock, Thread
 from os.path import (
     expanduser,
     join as path_join,
     getmtime as getmtime,
     isfile as isfile)
 if PY3:
-    from urllib.request import urlopen
+    from io import StringIO
 else:
-    from urllib2 import urlopen
+    from StringIO import StringIO
 
 from .stream import Stream
+from .meta import DEFAULT_RULES, rules_for
+from .cache import CACHE_DIR, DiskCache, atomic_write, fetch
 
 # maximum age of any channel file before rebuilding it
 CHAN_AGE_LIMIT = 7  # in days
+# wait before retrying a failed rebuild
+REFRESH_RETRY = 60 * 60  # in seconds
 FILE_PREFIX = '.tty_radio-'
 FILE_EXT = '.csv'
+# number of pages fetched at the same time when rebuilding a channel file
+FETCH_WORKERS = 8
+# cap on the cached pages used for rebuilding channel files
+PAGE_CACHE_SIZE = 5 * 1024 * 1024  # in bytes
+# direct stream link in a somafm.com directstreamlinks.html page
+DIRECT_LINK = re.compile(r'https?://[\w.-]+(?::\d+)?/[\w-]+-mp3\b')
 
 
 class Station(object):
+    """Named list of streams, loaded from a channel (CSV) file
+
+    The channel file is checked and read only on first access of the
+    streams (or an explicit `load`), so creating a station is cheap. An
+    outdated channel file is used as it is while a background thread
+    rebuilds it (if the station has `rebuild` set); the new streams replace
+    the old ones only once the rebuild succeeded.
+    """
     ui_name = 'Radio'
+    # also build a missing channel file in a background thread, instead of
+    # blocking start-up (the station has no streams until the build is done)
+    build_in_background = False
+    # how the ICY metadata of the streams is interpreted (meta.MetaRules),
+    # unless meta.STREAM_RULES has rules for a stream
+    meta_rules = DEFAULT_RULES
 
     def __init__(self, name, rebuild=True):
         self.name = name
@@ -35,9 +59,25 @@ class Station(object):
         home = expanduser('~')
         fname = FILE_PREFIX + name + FILE_EXT
         self.file = path_join(home, fname)
-        self.check_file()
-        self.streams = []
-        self.init_streams()
+        # called as on_change(stream, what) on stream metadata changes
+        self.on_change = None
+        self._streams = []
+        self._loaded = False
+        self._load_lock = Lock()
+        # bumped whenever the streams are (re)loaded
+        self.generation = 0
+        self.mtime = None
+        self._by_name = {}
+        self._by_url = {}
+        self._stream_strs = None
+        # 'never', 'running', 'ok' or 'failed'
+        self.refresh_status = 'never'
+        self.refresh_error = None
+        # problems the last rebuild worked around (e.g. pages it couldn't
+        # get), reported in refresh_info
+        self.refresh_warnings = []
+        self.refreshed = None  # end of the last rebuild
+        self._refresh_lock = Lock()
 
     def __str__(self):
         return ('Station(name=%s,rebuild=%s,file=%s)' %
@@ -59,17 +99,105 @@ class Station(object):
             * http://broadcast.wnrn.org:8000/wnrn.mp3,WNRN Cville,Independent Radio,http://www.wnrn.org/wp-content/themes/WNRN/images/logo2.gif
         """  # noqa
 
+    @property
+    def streams(self):
+        self.load()
+        return self._streams
+
+    def load(self):
+        """Check the channel file and read the streams, unless done before"""
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self.check_file()
+                self.init_streams()
+                self._loaded = True
+
     def check_file(self):
-        if not isfile(self.file):
+        if not isfile(self.file) and not self.build_in_background:
             self.build_file()
+        elif self.is_outdated():
+            self.refresh_async()
+
+    def is_outdated(self):
         # if channel file older than X days rebuild
+        if not isfile(self.file):
+            return True
         age_limit = time() - (60 * 60 * 24 * CHAN_AGE_LIMIT)
-        if self.rebuild and getmtime(self.file) < age_limit:
-            # on except of getmtime set chan_age = 0
-            rename(self.file, self.file + ".bck")
-            self.build_file()
+        return self.rebuild and getmtime(self.file) < age_limit
+
+    @property
+    def age(self):
+        """Age of the loaded channel file in seconds (None if none)"""
+        if self.mtime is None:
+            return None
+        return time() - self.mtime
+
+    def refresh_info(self):
+        return {
+            'age': self.age,
+            'status': self.refresh_status,
+            'error': self.refresh_error,
+            'warnings': list(self.refresh_warnings),
+            'refreshed': self.refreshed,
+        }
+
+    def refresh(self):
+        """Rebuild the channel file and load the new streams
+
+        Returns False if the rebuild failed, or another one is running. On
+        failure, the last good channel file and streams are kept.
+        """
+        if not self._refresh_lock.acquire(False):
+            return False
+        try:
+            self.refresh_status = 'running'
+            self.refresh_warnings = []
+            try:
+                self.build_file()
+            except Exception as exc_info:
+                (self.refresh_status, self.refresh_error) = (
+                    'failed', str(exc_info))
+                return False
+            finally:
+                self.refreshed = time()
+            self.init_streams()
+            (self.refresh_status, self.refresh_error) = ('ok', None)
+            return True
+        finally:
+            self._refresh_lock.release()
+
+    def refresh_async(self):
+        """Run `refresh` in a background thread, return the thread"""
+        thread = Thread(target=self.refresh, name='refresh_' + self.name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def revalidate(self):
+        """Start a background refresh if the channel file is outdated
+
+        After a failed refresh, the next attempt is made no sooner than
+        REFRESH_RETRY seconds later.
+        """
+        if not self._loaded or self.refresh_status == 'running':
+            return False
+        if not self.is_outdated():
+            return False
+        if (self.refresh_status == 'failed' and
+                time() - self.refreshed < REFRESH_RETRY):
+            return False
+        self.refresh_async()
+        return True
 
     def init_streams(self):
+        if not isfile(self.file):
+            # still being built
+            self.set_streams([])
+            return
+        mtime = getmtime(self.file)
+        streams = []
         with open(self.file, 'r') as f:
             for row in csv.reader(f):
                 # Skip rows that don't have three columns or
@@ -77,31 +205,82 @@ class Station(object):
                 if len(row) != 4 or row[0][0] == '#':
                     continue
                 row = [col.strip() for col in row]
-                self.streams.append(
+                streams.append(
                     Stream(
                         self.name,
                         row[1],
                         row[0],
                         row[2],
                         row[3],
-                        self.reader))
+                        self.reader,
+                        self.changed,
+                        rules_for(row[0], self.meta_rules)))
+        self.set_streams(streams)
+        self.mtime = mtime
+
+    def set_streams(self, streams):
+        """Replace the streams, and rebuild the indexes by name and URL"""
+        by_name = {}
+        by_url = {}
+        for stm in streams:
+            # an ambiguous name (or URL) matches nothing
+            by_name[stm.name] = None if stm.name in by_name else stm
+            by_url[stm.url] = None if stm.url in by_url else stm
+        (self._by_name, self._by_url) = (by_name, by_url)
+        self._stream_strs = None
+        self._streams = streams
+        self.generation += 1
+
+    def reload(self):
+        """Re-read the station file if it changed since it was loaded
+
+        Returns True if the streams were reloaded (or loaded).
+        """
+        if not self._loaded:
+            self.load()
+            return True
+        try:
+            if getmtime(self.file) == self.mtime:
+                return False
+        except OSError:
+            return False
+        self.init_streams()
+        return True
 
     def stream_obj(self, stream):
-        possibles = [st for st in self.streams if stream == st.name]
-        if len(possibles) != 1:
-            return None
-        return possibles[0]
+        self.load()
+        return self._by_name.get(stream)
+
+    def stream_by_url(self, url):
+        self.load()
+        return self._by_url.get(url)
+
+    @property
+    def stream_strs(self):
+        """`str` of all streams, computed once per generation"""
+        if self._stream_strs is None:
+            self._stream_strs = [str(stm) for stm in self.streams]
+        return self._stream_strs
 
     def reader(self, line):
         pass  # print('station sees: %s' % line)  for debugging
 
+    def changed(self, stream, what):
+        if self.on_change is not None:
+            self.on_change(stream, what)
+
 
 class Soma(Station):
     ui_name = 'SomaFM'
+    build_in_background = True
 
     def __init__(self):
         self.parse_url = "http://somafm.com"
         self.stream_url_base = "http://ice.somafm.com/"
+        # page cache, so that unchanged pages are not downloaded again
+        self.page_cache = DiskCache(
+            PAGE_CACHE_SIZE,
+            path=path_join(expanduser('~'), CACHE_DIR, 'pages'))
         super(Soma, self).__init__(name='soma', rebuild=True)
 
     def build_file(self):
@@ -109,56 +288,63 @@ class Soma(Station):
         # original at https://gist.github.com/roamingryan/2343819
         # mod'ed Feb 2014
         #   store name and desc seo; add img url
-        #   handle specific bad streams
-        page = urlopen(self.parse_url)
+        # The channel pages are fetched in parallel, with conditional
+        # requests for pages fetched before
+        from bs4 import BeautifulSoup  # only needed here, and slow to import
+        from multiprocessing.pool import ThreadPool
+        page = fetch(self.parse_url, self.page_cache)
         soup = BeautifulSoup(page, "html.parser")
         chan_instances = soup.findAll('li', {"class": "cbshort"})
-        print("Building new file from somafm.com...")
-        if PY3:
-            # per doc TypeError: 'str' does not support the buffer interface
-            csv_file = open(self.file, 'w', newline='')
-        else:
-            csv_file = open(self.file, 'w')
-        chan_writer = csv.writer(csv_file)
+        channels = []
         for inst in chan_instances:
             stream_url_short = inst.find('a')['href'].replace("/", "")
-            # for some reason, the following aren't at the expected URL
-            # use: http://somafm.com/ +
-            #    stream_url_short +
-            #    /directstreamlinks.html
-            #   and look under MP3 128kb for Direct Server: http://fqdn:port
-            # consider doing this longer procedure for all channels
-            # but for now, just hard code those that don't play well
-            # format of stream url
-            # original py script template: http://ice.somafm.com/<NAME>
-            # but that isn't doc'ed on soma's site anywhere
-            # what is the preferred/polite link?
-            # from: http://somafm.com/lush/directstreamlinks.html:
-            #   http://somafm.com/<NAME>.pls  for 128 Kb
-            #   http://somafm.com/<NAME>24.pls  for 24 Kb
-            #   but this doesn't load in mpg123 at all
-            # from other links on somafm site:
-            #   http://somafm.com/play/<NAME>
-            #   but this doesn't load in mpg123 at all
-            # mpg123 can handle the "direct links",
-            # but to parse for these would
-            # require requesting each channel's directstreamlinks.html
-            if stream_url_short == "airwaves":
-                stream_url = "http://uwstream2.somafm.com:5400"
-            elif stream_url_short == "earwaves":
-                stream_url = "http://sfstream1.somafm.com:5100"
-            else:
-                stream_url = (self.stream_url_base +
-                              stream_url_short)
             stream_name = inst.find('a').find('img')['alt'].split(":")[0]
-            stream_img  = self.parse_url + inst.find('a').find('img')['src']
+            stream_img = self.parse_url + inst.find('a').find('img')['src']
             stream_desc = inst.find('p').string
-            csv_row = [stream_url, stream_name, stream_desc, stream_img]
-            chan_writer.writerow(csv_row)
-            # so ascii art gets a page each
-            # os.system('cls' if os.name == 'nt' else 'clear')
-            print("  %s, %s, %s" % (stream_url, stream_name, stream_desc))
-        csv_file.close()
+            channels.append(
+                (stream_url_short, stream_name, stream_desc, stream_img))
+        pool = ThreadPool(FETCH_WORKERS)
+        try:
+            stream_urls = pool.map(
+                self.stream_url, [chan[0] for chan in channels])
+        finally:
+            pool.close()
+        csv_buffer = StringIO()
+        chan_writer = csv.writer(csv_buffer)
+        for (stream_url, chan) in zip(stream_urls, channels):
+            (_, stream_name, stream_desc, stream_img) = chan
+            chan_writer.writerow(
+                [stream_url, stream_name, stream_desc, stream_img])
+        data = csv_buffer.getvalue()
+        if PY3:
+            data = data.encode('utf-8')
+        if len(channels) == 0:
+            raise ValueError('no channels found at %s' % self.parse_url)
+        atomic_write(self.file, data)
+
+    def stream_url(self, stream_url_short):
+        """Direct URL of the 128kb MP3 stream of a channel
+
+        mpg123 can't load the somafm.com/<NAME>.pls playlists, so this looks
+        up the "Direct Server" links in the channel's directstreamlinks.html.
+        Falls back to the undocumented http://ice.somafm.com/<NAME>.
+        """
+        url = '%s/%s/directstreamlinks.html' % (
+            self.parse_url, stream_url_short)
+        try:
+            page = fetch(url, self.page_cache).decode('utf-8', 'replace')
+        except (IOError, OSError) as exc_info:
+            self.refresh_warnings.append(
+                "couldn't get %s: %s" % (url, exc_info))
+            page = ''
+        links = DIRECT_LINK.findall(page)
+        for link in links:
+            if link.endswith('-128-mp3'):
+                return link
+        for link in links:
+            if link.endswith('-mp3'):
+                return link
+        return self.stream_url_base + stream_url_short
 
 
 class Favs(Station):
@@ -181,6 +367,5 @@ http://ice.somafm.com/lush,Lush,"Electronica with sensuous/mellow vocals, mostly
 http://ice.somafm.com/suburbsofgoa,Suburbs of Goa,Desi-influenced Asian world beats and beyond,http://somafm.com/img/sog120.jpg
 http://ice.somafm.com/u80s,Underground 80s,Early 80s UK Synthpop and a bit of New Wave,http://somafm.com/img/u80s-120.png
 """  # noqa
-        print("Building new file from default favs...")
         with open(self.file, 'w') as f:
             f.write(favs)
@@ -1,31 +1,74 @@
 from __future__ import print_function
-from threading import Thread
-from time import sleep
+import os
+import select
+from time import sleep, time
+from collections import OrderedDict
+from threading import Thread, Event, Lock, Timer
 from subprocess import (
     Popen,
     PIPE,
-    STDOUT,
-    check_output,
-    CalledProcessError)
-import re
+    STDOUT)
+try:
+    import selectors
+except ImportError:  # Python 2
+    selectors = None
+
+import requests
+
+from .meta import DEFAULT_RULES
+from .playlist import get_cache as get_playlists, is_playlist
+from .icy import MetaReader
+
+# seconds to wait for the player to exit on terminate before killing it
+TERM_TIMEOUT = 5.0
+# seconds to wait for the player to acknowledge a command
+ACK_TIMEOUT = 2.0
+# seconds to wait for the player to report metadata, before reading it
+# from the stream ourselves
+META_FALLBACK = 3.0
+# seconds over which the volumes are crossfaded when switching streams,
+# in that many steps
+CROSSFADE = 1.0
+CROSSFADE_STEPS = 10
+# seconds to wait for a new stream to be decoded before giving up on a
+# gapless switch
+SWAP_TIMEOUT = 10.0
+# seconds a pretuned stream is kept loaded in the standby player
+PRETUNE_TIMEOUT = 300
+# bytes read from the player at once, and maximum length of a line
+READ_CHUNK = 4096
+MAX_LINE = 4096
 
 
 class Stream(object):
 
     vol = "11000"  # volume 0 .. 32k
+    # a relay.RelayHub if the server relays the streams, which the player
+    # then loads from the server
+    relay = None
 
-    def __init__(self, station, name, url, desc, art, reader):
+    def __init__(self, station, name, url, desc, art, reader, notify=None,
+                 rules=None):
         self.station = station
         self.name = name
         self.url = url
         self.desc = desc
         self.art = art
         self.station_reader = reader
+        # called as notify(stream, what) when 'name' or 'song' changed
+        self.station_notify = notify
+        # how to interpret the ICY metadata (a meta.MetaRules)
+        if rules is None:
+            rules = DEFAULT_RULES
+        self.rules = rules
         self.meta_name = None
-        self.meta_song = None
+        self.meta = None  # SongMeta of the current song
+        self._meta_reader = None  # icy.MetaReader, if mpg123 reports none
+        self._meta_timer = None
+        self._meta_lock = Lock()
+        self._play_id = 0  # bumped by every play, ends an earlier failover
         self._is_playing = False
         self._is_paused = False
-        self._subproc = None
 
     def __str__(self):
         return ('Stream(station=%s,name=%s,url=%s,desc=\"%s\",art=%s)' %
@@ -34,6 +77,12 @@ class Stream(object):
     def __repr__(self):
         return str(self)
 
+    @property
+    def meta_song(self):
+        if self.meta is None:
+            return None
+        return self.meta.song
+
     @property
     def is_playing(self):
         return self._is_playing
@@ -42,105 +91,750 @@ class Stream(object):
     def is_paused(self):
         return self._is_paused
 
+    @classmethod
+    def set_volume(cls, vol):
+        """Change the volume (0..32k), taking effect without interruption"""
+        cls.vol = str(vol)
+        get_engine().volume(cls.vol)
+
+    @property
+    def play_url(self):
+        """The URL the player loads"""
+        if Stream.relay is not None:
+            return Stream.relay.local_url(self)
+        return self.url
+
+    def _load_urls(self):
+        """The URLs the player may load, alternatives after the first"""
+        if Stream.relay is not None or not is_playlist(self.url):
+            return [self.play_url]
+        # the stream URLs of the playlist, so the player needn't fetch it
+        try:
+            return get_playlists().urls(self.url)
+        except (requests.RequestException, ValueError):
+            return [self.url]  # the player may have better luck
+
     def play(self):
-        self.thread = Thread(
-            target=mpg123,
-            args=(self.url, self.get_subproc, self.reader))
-        self.thread.daemon = True
-        self.thread.start()
-        while not mpg_running():
-            sleep(0.5)
+        urls = self._load_urls()
+        if Stream.relay is not None:
+            # the metadata comes from the relay, not from the player
+            Stream.relay.attach(self)
+        # the player process is reused, this just loads the url
+        get_engine().load(urls[0], self.reader)
+        self._play_id += 1
         self._is_playing = True
         self._is_paused = False
+        if urls[0] != self.play_url:  # resolved a playlist
+            thread = Thread(
+                target=self._failover, args=(self._play_id, urls),
+                name='stream_failover')
+            thread.daemon = True
+            thread.start()
+        if Stream.relay is None:
+            self._stop_meta_reader()
+            with self._meta_lock:
+                self._meta_timer = Timer(
+                    META_FALLBACK, self._start_meta_reader)
+                self._meta_timer.daemon = True
+                self._meta_timer.start()
+
+    def _failover(self, play_id, urls):
+        # load the next stream URL of the playlist while one doesn't play
+        playlists = get_playlists()
+        for (i, url) in enumerate(urls):
+            if i > 0:
+                if play_id != self._play_id or not self._is_playing:
+                    return
+                get_engine().load(url, self.reader)
+            if get_engine().wait_ready(url):
+                playlists.succeeded(self.url, url)
+                return
+            if play_id != self._play_id or not self._is_playing:
+                return
+            playlists.failed(self.url, url)
 
-    def get_subproc(self, subproc):
-        self._subproc = subproc
+    def _start_meta_reader(self):
+        # mpg123 reports no titles for some streams (e.g. some playlists)
+        with self._meta_lock:
+            if self._meta_timer is None or self.meta is not None:
+                return  # stopped in the meantime, or not needed
+            self._meta_timer = None
+            self._meta_reader = MetaReader(self.url, self._read).start()
 
-    def kill_subproc(self):
-        self._subproc.terminate()
+    def _stop_meta_reader(self):
+        with self._meta_lock:
+            if self._meta_timer is not None:
+                self._meta_timer.cancel()
+                self._meta_timer = None
+            if self._meta_reader is not None:
+                self._meta_reader.stop()
+                self._meta_reader = None
 
     def pause(self):
-        self.kill_subproc()
-        while mpg_running():
-            sleep(0.5)
+        # stop receiving the stream (like turning off a radio), a later
+        # play() re-loads it
+        get_engine().stop(self.reader)
+        if Stream.relay is not None:
+            Stream.relay.detach(self)
+        self._stop_meta_reader()
         self._is_paused = True
-        # since we are killing the proc forget everything
-        self.meta_song = None
+        # since we are dropping the stream forget everything
+        self.meta = None
         self.meta_name = None
 
-    def stop(self):
-        self.kill_subproc()
-        while mpg_running():
-            sleep(0.5)
+    def stop(self, switching=False):
+        """Stop playing; if `switching` to another stream, keep the audio
+        going until the next stream replaces it"""
+        if switching:
+            get_engine().detach(self.reader)
+        else:
+            get_engine().stop(self.reader)
+        if Stream.relay is not None:
+            Stream.relay.detach(self)
+        self._stop_meta_reader()
         self._is_playing = False
-        # since we are killing the proc forget everything
-        self.meta_song = None
+        # since we are dropping the stream forget everything
+        self.meta = None
         self.meta_name = None
 
+    def pretune(self):
+        """Start buffering the stream, muted, so that `play` is instant;
+        return False if that is not possible right now"""
+        return get_engine().pretune(self._load_urls()[0])
+
     def reader(self, inp):
+        if (inp[0:8] == "ICY-META" and
+                (self._meta_timer is not None or
+                 self._meta_reader is not None)):
+            # the player reports titles after all, which makes the fallback
+            # (a second download of the stream) redundant
+            self._stop_meta_reader()
+        self._read(inp)
+
+    def _read(self, inp):
+        # the lines of the player, or of the fallback MetaReader
         if (self.meta_name is None and
                 len(inp) > 10 and
                 inp[0:8] == "ICY-NAME"):
-            self.meta_name = parse_name(inp[10:])
+            self.meta_name = self.rules.parse_name(inp[10:])
+            self.notify('name')
         if len(inp) > 10 and inp[0:8] == "ICY-META":
-            song = parse_song(inp[10:])
-            if song is not None and len(song) == 0:
-                song = None
-            self.meta_song = song
+            # parsed once, here; consumers use the SongMeta record
+            meta = self.rules.parse_song(inp[10:])
+            song = None if meta is None else meta.song
+            if song != self.meta_song:
+                self.meta = meta
+                self.notify('song')
         self.station_reader(inp)
 
+    def notify(self, what):
+        if self.station_notify is not None:
+            self.station_notify(self, what)
 
-def mpg_running():
-    # searching for mpg123 reveals an orphaned process in parens (mpg123)
-    # so search for 'mpg123 '
-    try:
-        grep = check_output("ps | grep -v grep | grep 'mpg123 '", shell=True)
-    except CalledProcessError:
+
+class Supervisor(object):
+    """Owns a single player child process and tracks its state
+
+    The `Popen` handle is kept, so there is no need to look for the player in
+    the process table. The shared IOLoop forwards each line of output to
+    `line_reader`, and the child is waited on once its output is exhausted.
+    State changes are signalled through the `started` and `exited` events.
+
+    Args:
+        cmd (list): command line of the player
+        line_reader (callable): receives each (stripped) line of output
+        prefixes (tuple): if given, only lines starting with one of these
+            are passed to `line_reader`
+    """
+    def __init__(self, cmd, line_reader, prefixes=None):
+        self.cmd = cmd
+        self.line_reader = line_reader
+        self.prefixes = prefixes
+        self.proc = None
+        self.returncode = None
+        self.started = Event()
+        self.exited = Event()
+
+    def __str__(self):
+        pid = None
+        if self.proc is not None:
+            pid = self.proc.pid
+        return ('Supervisor(cmd=%s,pid=%s,running=%s)' %
+                (self.cmd, pid, self.is_running))
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def is_running(self):
+        return self.started.is_set() and not self.exited.is_set()
+
+    def start(self):
+        try:
+            self.proc = Popen(
+                self.cmd, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        except OSError as e:
+            self.exited.set()
+            raise Exception('OSError %s when executing %s' % (e, self.cmd))
+        self.started.set()
+        splitter = LineSplitter(self.prefixes)
+        get_io_loop().add(
+            self.proc.stdout.fileno(),
+            lambda data: self._on_lines(splitter.feed(data)),
+            self._on_eof)
+        return self
+
+    def _on_lines(self, lines):
+        for line in lines:
+            self.line_reader(line.strip())
+
+    def _on_eof(self):
+        self.proc.stdout.close()
+        self.returncode = self.proc.wait()
+        self.exited.set()
+
+    def terminate(self, timeout=TERM_TIMEOUT):
+        """Terminate the child and block until it has exited
+
+        The child is killed if it did not exit within `timeout` seconds.
+        """
+        if self.proc is None or self.exited.is_set():
+            return
+        try:
+            self.proc.terminate()
+        except OSError:
+            pass  # exited in the meantime
+        if not self.exited.wait(timeout):
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+            self.exited.wait()
+
+    def wait(self, timeout=None):
+        """Block until the child has exited, return True if it did"""
+        return self.exited.wait(timeout)
+
+
+class LineSplitter(object):
+    """Split chunks of output into decoded lines
+
+    Lines are split as bytes, so that lines not starting with one of
+    `prefixes` (if given) are dropped without decoding them. Kept lines are
+    decoded as UTF-8, falling back to Latin-1 (which many streams use for
+    their ICY metadata), so decoding never fails. A line is cut off after
+    `max_line` bytes, so the buffered output is bounded.
+    """
+    def __init__(self, prefixes=None, max_line=MAX_LINE):
+        if prefixes is not None:
+            prefixes = tuple(p.encode('utf-8') for p in prefixes)
+        self.prefixes = prefixes
+        self.max_line = max_line
+        self._buffer = b''
+        self._overlong = False  # dropping the rest of an overlong line
+
+    def feed(self, data):
+        """Return the list of lines completed by the bytes `data`"""
+        lines = []
+        parts = (self._buffer + data).split(b'\n')
+        self._buffer = parts.pop()
+        for part in parts:
+            if self._overlong:
+                self._overlong = False
+                continue
+            self._keep(part, lines)
+        if len(self._buffer) > self.max_line:
+            if not self._overlong:
+                self._keep(self._buffer, lines)
+                self._overlong = True
+            self._buffer = b''
+        return lines
+
+    def _keep(self, line, lines):
+        if self.prefixes is not None and not line.startswith(self.prefixes):
+            return
+        line = line[:self.max_line]
+        try:
+            lines.append(line.decode('utf-8'))
+        except UnicodeDecodeError:
+            lines.append(line.decode('latin-1'))
+
+
+class IOLoop(object):
+    """A single thread reading the output of all player processes
+
+    Instead of a thread per process, file descriptors are added with
+    callbacks for incoming data and for the end of the output. The thread is
+    started on first use.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._handlers = {}  # fd -> (on_data, on_eof)
+        self._thread = None
+        (self._wake_r, self._wake_w) = os.pipe()
+
+    def __str__(self):
+        return 'IOLoop(fds=%s)' % sorted(self._handlers)
+
+    def __repr__(self):
+        return str(self)
+
+    def add(self, fd, on_data, on_eof):
+        with self._lock:
+            self._handlers[fd] = (on_data, on_eof)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='player_io')
+                self._thread.daemon = True
+                self._thread.start()
+        os.write(self._wake_w, b'+')
+
+    def _run(self):
+        selector = None
+        if selectors is not None:
+            selector = selectors.DefaultSelector()
+            selector.register(self._wake_r, selectors.EVENT_READ)
+        self._registered = set()
+        while True:
+            with self._lock:
+                fds = set(self._handlers)
+            if selector is None:
+                ready = select.select(list(fds) + [self._wake_r], [], [])[0]
+            else:
+                for fd in fds - self._registered:
+                    selector.register(fd, selectors.EVENT_READ)
+                    self._registered.add(fd)
+                ready = [key.fd for (key, _) in selector.select()]
+            for fd in ready:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, READ_CHUNK)
+                    continue
+                self._read(fd, selector)
+
+    def _read(self, fd, selector):
+        (on_data, on_eof) = self._handlers[fd]
+        try:
+            data = os.read(fd, READ_CHUNK)
+        except OSError:
+            data = b''
+        if data:
+            on_data(data)
+            return
+        with self._lock:
+            del self._handlers[fd]
+        if selector is not None:
+            selector.unregister(fd)
+            self._registered.discard(fd)
+        on_eof()
+
+
+class Mpg123Player(object):
+    """One ``mpg123 -R`` process, driven over stdin
+
+    The generic remote interface of mpg123 accepts commands like LOAD, STOP
+    and VOLUME on stdin and reports back with ``@``-prefixed lines on stdout.
+    Switching streams or changing the volume therefore needs no process
+    start-up or decoder initialisation. The process is (re-)started on
+    demand if it is not running.
+
+    ICY lines (with the ``@I`` prefix removed, i.e. in the same format as in
+    non-remote mode) are passed to ``engine._on_icy``, and the latest one of
+    each kind is kept in `icy`.
+    """
+    # -R starts the generic remote interface
+    cmd = ["mpg123", "-R"]
+    # the only output lines we act on
+    prefixes = ('@I ICY-', '@P', '@E', '@R', '@S')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._proc = None
+        self.url = None
+        self.vol = None  # in percent, as sent to the player
+        self.icy = OrderedDict()  # ICY-NAME etc. -> latest line, for `url`
+        self.error = None
+        # set once the player decodes `url`
+        self.ready = Event()
+        self._stopped = Event()
+        self._stopped.set()
+
+    def __str__(self):
+        return ('Mpg123Player(url=%s,running=%s,vol=%s)' %
+                (self.url, self.is_running, self.vol))
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def is_running(self):
+        return self._proc is not None and self._proc.is_running
+
+    @property
+    def is_playing(self):
+        return self.is_running and self.url is not None
+
+    def _ensure_running(self):
+        if self.is_running:
+            return
+        self._proc = Supervisor(
+            self.cmd, self._on_line, self.prefixes).start()
+        # no @F frame status lines, we don't use them
+        self._send('SILENCE')
+        if self.vol is not None:
+            self._send('VOLUME %s' % self.vol)
+
+    def _send(self, command):
+        stdin = self._proc.proc.stdin
+        stdin.write((command + '\n').encode('utf-8'))
+        stdin.flush()
+
+    def _command(self, command):
+        try:
+            self._send(command)
+        except (OSError, IOError, ValueError):
+            # player went away, start a fresh one and retry once
+            self._proc.terminate()
+            self._ensure_running()
+            self._send(command)
+
+    def _on_line(self, line):
+        if line.startswith('@I ICY-'):
+            self.icy[line[3:].split(':', 1)[0]] = line[3:]
+            self.engine._on_icy(self, line[3:])
+        elif line.startswith('@P 0'):
+            self._stopped.set()
+        elif line.startswith(('@S', '@P 2')):
+            if self.url is not None and not self.ready.is_set():
+                self.ready.set()
+                self.engine._on_ready(self)
+        elif line.startswith('@E'):
+            self.error = line[3:]
+
+    def load(self, url):
+        self._ensure_running()
+        self.url = url
+        self.error = None
+        self.icy.clear()
+        self.ready.clear()
+        self._stopped.clear()
+        if is_playlist(url):
+            self._command('LOADLIST 1 %s' % url)
+        else:
+            self._command('LOAD %s' % url)
+
+    def stop(self):
+        """Stop playback, and wait for the player to acknowledge it (or a
+        timeout)"""
+        self.url = None
+        self.icy.clear()
+        self.ready.clear()
+        if not self.is_running:
+            return
+        self._command('STOP')
+        self._stopped.wait(ACK_TIMEOUT)
+
+    def volume(self, vol):
+        """Set the volume, in percent"""
+        self.vol = vol
+        if self.is_running:
+            self._command('VOLUME %s' % vol)
+
+    def quit(self):
+        self.url = None
+        if self._proc is not None:
+            self._proc.terminate()
+
+
+class Mpg123Engine(object):
+    """Plays streams with an active and a (muted) standby player
+
+    Only the reader of the currently loaded stream receives the ICY lines
+    of the active player.
+
+    `pretune` loads a stream into the standby player, with the volume at
+    zero. Loading that stream then swaps the players: the ICY lines the
+    standby has already received are replayed to the new reader, and the
+    volumes are crossfaded over CROSSFADE seconds. If a stream is still
+    playing when another one is loaded (after `detach`), the new stream is
+    buffered in the standby in the same way, and swapped in once it is
+    decoded, so there is no silence in between.
+
+    The time from `load` until the new stream is audible is kept in
+    `switch_latency`.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._active = Mpg123Player(self)
+        self._standby = None  # created on demand
+        self._fading = None  # player being faded out
+        self._pending = False  # standby is to be swapped in when ready
+        self._pretune_id = 0
+        self._reader = None
+        # bumped by every load, stop and pretune, which ends any crossfade
+        # or pending swap of an earlier one
+        self._gen = 0
+        self._switch_start = None
+        self.switches = 0
+        self.pretuned_switches = 0
+        self.switch_latency = None  # in seconds
+
+    def __str__(self):
+        return ('Mpg123Engine(url=%s,running=%s,playing=%s,pretuned=%s)' %
+                (self._active.url, self.is_running, self.is_playing,
+                 self.pretuned))
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def is_running(self):
+        return self._active.is_running
+
+    @property
+    def is_playing(self):
+        return self._active.is_playing
+
+    @property
+    def error(self):
+        return self._active.error
+
+    @property
+    def pretuned(self):
+        """URL loaded in the standby player, or None"""
+        standby = self._standby
+        if standby is None or standby is self._fading or self._pending:
+            return None
+        return standby.url
+
+    def stats(self):
+        return {
+            'switches': self.switches,
+            'pretuned_switches': self.pretuned_switches,
+            'switch_latency': self.switch_latency,
+            'pretuned': self.pretuned,
+        }
+
+    def _on_icy(self, player, line):
+        # called by the IOLoop thread, must not take the lock
+        if player is self._active:
+            reader = self._reader
+            if reader is not None:
+                reader(line)
+
+    def _on_ready(self, player):
+        # called by the IOLoop thread, must not take the lock
+        if player is self._active:
+            self._switched()
+
+    def _switched(self):
+        start, self._switch_start = self._switch_start, None
+        if start is not None:
+            self.switch_latency = time() - start
+
+    def _cancel(self):
+        # end the crossfade or swap of an earlier load; with the lock held
+        self._gen += 1
+        if self._pending:
+            self._standby.stop()
+            self._pending = False
+        if self._fading is not None:
+            self._fading.stop()
+            self._fading.volume(0)
+            self._fading = None
+            self._active.volume(vol_percent(Stream.vol))
+
+    def load(self, url, reader):
+        with self._lock:
+            self._cancel()
+            self._reader = reader
+            self._switch_start = time()
+            self.switches += 1
+            standby = self._standby
+            if (standby is not None and standby.url == url and
+                    standby.is_running and standby.error is None):
+                self.pretuned_switches += 1
+                self._swap()
+            elif self._active.is_playing and url != self._active.url:
+                # keep playing the old stream until the new one is buffered
+                self._pretune(url)
+                self._pending = True
+                thread = Thread(
+                    target=self._swap_when_ready, args=(self._gen, url),
+                    name='player_swap')
+                thread.daemon = True
+                thread.start()
+            else:
+                self._active.volume(vol_percent(Stream.vol))
+                self._active.load(url)
+
+    def _swap(self):
+        # make the standby player the active one, and crossfade
+        (old, self._active) = (self._active, self._standby)
+        self._standby = old
+        reader = self._reader
+        if reader is not None:
+            for line in list(self._active.icy.values()):
+                reader(line)
+        if self._active.ready.is_set():
+            self._switched()
+        if old.is_playing:
+            self._fading = old
+            thread = Thread(
+                target=self._crossfade, args=(self._gen, old, self._active),
+                name='player_crossfade')
+            thread.daemon = True
+            thread.start()
+        else:
+            self._active.volume(vol_percent(Stream.vol))
+
+    def _swap_when_ready(self, gen, url):
+        standby = self._standby
+        standby.ready.wait(SWAP_TIMEOUT)
+        with self._lock:
+            if gen != self._gen:
+                return
+            self._pending = False
+            if standby.ready.is_set() and standby.error is None:
+                self._swap()
+            else:
+                # the standby didn't get going, load the old way
+                standby.stop()
+                self._active.volume(vol_percent(Stream.vol))
+                self._active.load(url)
+
+    def _crossfade(self, gen, old, new):
+        for i in range(1, CROSSFADE_STEPS + 1):
+            sleep(float(CROSSFADE) / CROSSFADE_STEPS)
+            with self._lock:
+                if gen != self._gen:
+                    return  # ended by _cancel
+                vol = float(vol_percent(Stream.vol))
+                new.volume('%.1f' % (vol * i / CROSSFADE_STEPS))
+                old.volume(
+                    '%.1f' % (vol * (CROSSFADE_STEPS - i) / CROSSFADE_STEPS))
+        with self._lock:
+            if gen == self._gen:
+                old.stop()
+                self._fading = None
+
+    def pretune(self, url):
+        """Load `url` in the muted standby player, so that a later `load`
+        of the same url starts without delay
+
+        Returns True if `url` is pretuned, False if it is playing already, or
+        the standby player is busy with a switch.
+        """
+        with self._lock:
+            if url == self.pretuned:
+                return True
+            if (url == self._active.url or self._pending or
+                    self._fading is not None):
+                return False
+            self._pretune(url)
+            thread = Thread(
+                target=self._expire_pretune,
+                args=(self._pretune_id, self._standby),
+                name='player_pretune')
+            thread.daemon = True
+            thread.start()
+            return True
+
+    def _pretune(self, url):
+        if self._standby is None:
+            self._standby = Mpg123Player(self)
+        self._standby.volume(0)
+        self._standby.load(url)
+        self._pretune_id += 1
+
+    def _expire_pretune(self, pretune_id, standby):
+        # don't keep receiving a stream that's not played after all
+        sleep(PRETUNE_TIMEOUT)
+        with self._lock:
+            if (pretune_id == self._pretune_id and
+                    standby is self._standby and self.pretuned is not None):
+                standby.stop()
+
+    def wait_ready(self, url, timeout=SWAP_TIMEOUT):
+        """Block until `url` is decoded; return False if the player reported
+        an error, `url` was unloaded, or after `timeout` seconds"""
+        end = time() + timeout
+        while time() < end:
+            with self._lock:
+                players = [p for p in (self._active, self._standby)
+                           if p is not None and p.url == url]
+            if len(players) == 0 or players[0].error is not None:
+                return False
+            if players[0].ready.wait(min(0.1, max(end - time(), 0))):
+                return True
         return False
-    grep = grep.decode('ascii').strip()
-    if len(grep) > 1:
-        # print('%s' % grep)
-        return True
-    return False
-
-
-def parse_name(station_deets):
-    # TODO custom parsers inherited from station/stream
-    # bc it's kinda poser having so much 'defcon' all over your screen
-    if station_deets[0:3] == "Def":
-        # print(">>> " +  station_deets)
-        return ''
-    return station_deets
-
-
-def parse_song(metadata):
-    # example to parse:
-    # StreamTitle='Stone Soup Soldiers - Pharaoh's Tears';StreamUrl='http://SomaFM.com/suburbsofgoa/';)  # noqa
-    title_re = re.compile("le='([^;]*)';")
-    # print(">>> " +  out)
-    title_m = title_re.search(metadata)
-    title = "Song title didn't parse(" + metadata + ")"
-    try:
-        title = title_m.group(1)
-    except:  # TODO find actual exception
-        return title
-    title = re.sub(r'\s{2,}-', ' -', title)
-    return title
-
-
-def mpg123(url, get_p, stream_reader):
-    # mpg123 command line mp3 stream player
-    # does unbuffered output, so the subprocess...readline snip works
-    # -C allows keyboard presses to send commands:
-    #    space is pause/resume, q is quit, +/- control volume
-    # -@ tells it to read (for stream/playlist info) filenames/URLs from url
-    subp_cmd = ["mpg123", "-f", Stream.vol, "-@", url]
-    try:
-        p = Popen(subp_cmd, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-    except OSError as e:
-        raise Exception('OSError %s when executing %s' % (e, subp_cmd))
-    get_p(p)
-    for line in iter(p.stdout.readline, b''):
-        out = bytes.decode(line)
-        out = out.strip()
-        stream_reader(out)
+
+    def detach(self, reader):
+        """Stop passing ICY lines to `reader`, but keep playing, until the
+        next `load` replaces the stream"""
+        with self._lock:
+            if reader == self._reader:
+                self._reader = None
+
+    def stop(self, reader=None):
+        """Stop playback; if `reader` is given, only if its stream is loaded
+
+        Blocks until the player has acknowledged the stop (or a timeout).
+        """
+        with self._lock:
+            if reader is not None and reader != self._reader:
+                return
+            self._cancel()
+            self._reader = None
+            self._switch_start = None
+            self._active.stop()
+
+    def volume(self, vol):
+        with self._lock:
+            if self._fading is None:
+                self._active.volume(vol_percent(vol))
+
+    def quit(self):
+        with self._lock:
+            self._gen += 1
+            self._reader = None
+            self._fading = None
+            for player in (self._active, self._standby):
+                if player is not None:
+                    player.quit()
+
+
+_engine = None
+_engine_lock = Lock()
+_io_loop = None
+
+
+def get_io_loop():
+    """Return the (shared) IOLoop for the output of player processes"""
+    global _io_loop
+    with _engine_lock:
+        if _io_loop is None:
+            _io_loop = IOLoop()
+        return _io_loop
+
+
+def get_engine():
+    """Return the (shared) player engine"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = Mpg123Engine()
+        return _engine
+
+
+def vol_percent(vol):
+    """Convert a 0..32k volume (mpg123 -f scale) to mpg123 VOLUME percent"""
+    return '%.1f' % (int(vol) * 100.0 / 32768)
+
+
+def player_stats():
+    """Return stream switching metrics of the player (a dict)"""
+    return get_engine().stats()
+
+
+def mpg_running():
+    """Return True if the player is currently playing a stream"""
+    return _engine is not None and _engine.is_playing
@@ -2,9 +2,8 @@ from __future__ import print_function
 import platform
 import sys
 import textwrap
-import re
 import math
-from time import sleep
+from time import time
 from io import StringIO
 from subprocess import (
     check_output,
@@ -21,8 +20,11 @@ else:
 from .color import colors, THEME
 from .banner import bannerize
 from .album import gen_art
-from .api import Client
+from .client import Client
+from .cache import DiskCache
 
+# max. seconds to wait for the stream name and the first song title
+META_WAIT = 5.0
 
 # TODO
 #   windows detect terminal size
@@ -31,22 +33,6 @@ from .api import Client
 #
 
 
-def stream_list(streams):
-    exploded = []
-    name_re = re.compile("name=(.*),url")
-    desc_re = re.compile("desc=\"(.*)\",art")
-    for s in streams:
-        name_m = name_re.search(s)
-        desc_m = desc_re.search(s)
-        s_exp = {
-            'name': name_m.group(1),
-            'desc': desc_m.group(1),
-            'repr': s
-        }
-        exploded.append(s_exp)
-    return exploded
-
-
 def print_streams(station, streams, stations):
     (term_w, term_h) = click.get_terminal_size()
     line_cnt = 0
@@ -63,9 +49,12 @@ def print_streams(station, streams, stations):
     for s in streams:
         prefix = (" %2d" % i + " ) " + s['name'] +
                   ' ' * (name_len - len(s['name'])))
+        desc = s['desc']
+        if s.get('now_playing') is not None:
+            desc = "%s [%s]" % (desc, s['now_playing']['song'])
         (w, h) = print_blockify(
             prefix, THEME['ui_names'],
-            s['desc'], THEME['ui_desc'])
+            desc, THEME['ui_desc'])
         line_cnt += h
         i += 1
     # TODO get rid of hard coded access to the other stations
@@ -176,11 +165,18 @@ def ui_loop(client, settings, station='favs'):
     """list possible stations, read user input, and call player"""
     # when the player is exited, this loop happens again
     c = client
+    # the whole catalogue, incl. stream details, in a single request
+    stations = c.stations(include=['streams', 'now_playing'])
     if station is None:
-        station = c.stations()[0]
-    deets = c.station(station)
-    streams = stream_list(c.streams(station))
-    stations = c.stations()
+        station = stations[0]['name']
+    deets = None
+    for st in stations:
+        if st['name'] == station:
+            deets = st
+    if deets is None:
+        print('Error, could not get station %s' % station)
+        return 'q'
+    streams = deets['streams']
     # streams.sort()  # put in alpha order
     # ######
     # print stations
@@ -218,13 +214,7 @@ def ui_loop(client, settings, station='favs'):
     # ######
     # otherwise stream num specified, so call player
     ##
-    # get the stream name only
-    to_stream = streams[stream_num]
-    # convert the name only into more details
-    stream = c.stream(station, to_stream['name'])
-    if stream is None:
-        print('Error, could not get stream details')
-        return station
+    stream = streams[stream_num]
     display_banner(
         stream['name'],
         figlet_fonts=settings.config['UI']['figlet_fonts'],
@@ -232,7 +222,7 @@ def ui_loop(client, settings, station='favs'):
         use_pyfiglet=use_pyfiglet)
     try:
         if settings.config['UI'].getboolean('show_stream_ascii_art'):
-            display_album(stream['art'])
+            display_album(stream['art'], cache=art_cache(settings))
     except ValueError:
         pass
     try:
@@ -307,22 +297,18 @@ def display_metadata(client, stream, settings):
         print()
         print()
     # stop anything playing from another client
-    status = c.status()
-    if status['currently_streaming'] and not status['paused']:
-        c.stop()
-    if not c.play(station_name, stream_name):
-        print('Error for stream %s, already playing %s' % (stream, status))
+    results = c.batch([
+        {'op': 'stop'},
+        {'op': 'play', 'station': station_name, 'stream': stream_name}])
+    if results is None or not results[1]['success']:
+        print('Error for stream %s: %s' % (stream, results))
         c.stop()
         return False
     showed_name = False
-    i = 0
-    disp_name = stream['meta_name']
-    # disp names of '', like DEF CON Radio will escape loop
-    while i < 10 and disp_name is None:
-        stream = c.stream(station_name, stream_name)
-        disp_name = stream['meta_name']
-        sleep(0.5)
-        i += 1
+    # wait for the stream name, pushed by the server as soon as it is known
+    # disp names of '', like DEF CON Radio will end the wait
+    (version, status) = wait_for_meta(c, None, 'meta_name', META_WAIT)
+    disp_name = status['meta_name']
     if disp_name is None:
         disp_name = stream_name
     if disp_name is not None and disp_name.strip() != '':
@@ -336,15 +322,10 @@ def display_metadata(client, stream, settings):
         if compact_titles:
             print()
     # wait for initial song
-    i = 0
     song_len = 0
-    song_name = stream['meta_song']
-    # song names of '', like WCPE will escape loop
-    while i < 10 and song_name is None:
-        stream = c.stream(station_name, stream_name)
-        song_name = stream['meta_song']
-        sleep(0.5)
-        i += 1
+    # song names of '', like WCPE will end the wait
+    (version, status) = wait_for_meta(c, version, 'meta_song', META_WAIT)
+    song_name = status['meta_song']
     showed_song = False
     if song_name is not None and song_name.strip() != '':
         showed_song = True
@@ -358,10 +339,9 @@ def display_metadata(client, stream, settings):
             wrap=False)[0]
         if compact_titles and not showed_name:
             print()
-    # keep polling for song title changes
+    # follow song title changes as the server pushes them
     do_another = True
     while do_another:
-        status = c.status()
         song_now = status['song']
         if (song_now != song_name and
                 song_now is not None and song_now.strip() != ''):
@@ -381,10 +361,32 @@ def display_metadata(client, stream, settings):
         is_playing = status['currently_streaming']
         if not is_playing:
             return True
-        sleep(1)
+        new_status = None
+        while new_status is None:
+            (version, new_status) = c.events(version)
+        status = new_status
     return True
 
 
+def wait_for_meta(client, version, key, timeout):
+    """Wait until the player status has a value for `key`, or `timeout`
+
+    Returns the tuple ``(version, status)`` of the most recent status.
+    """
+    deadline = time() + timeout
+    (version, status) = client.events(version, timeout=0)
+    if status is None:
+        status = client.status()
+    while status[key] is None:
+        remaining = deadline - time()
+        if remaining <= 0:
+            break
+        (version, new_status) = client.events(version, timeout=remaining)
+        if new_status is not None:
+            status = new_status
+    return (version, status)
+
+
 def print_blockify(prefix='', prefix_color='endc',
                    blk='', blk_color='endc',
                    wrap=True):
@@ -412,11 +414,29 @@ def print_blockify(prefix='', prefix_color='endc',
     return (max_blk_len, len(lines))
 
 
-def display_album(art_url):
+# DiskCaches for stream art, by their max. size in bytes
+_art_caches = {}
+
+
+def art_cache(settings):
+    """Return the DiskCache for stream art, or None if disabled"""
+    try:
+        max_mb = settings.config['UI'].getfloat('art_cache_size')
+    except ValueError:
+        max_mb = 0
+    if max_mb <= 0:
+        return None
+    max_size = int(max_mb * 1024 * 1024)
+    if max_size not in _art_caches:
+        _art_caches[max_size] = DiskCache(max_size)
+    return _art_caches[max_size]
+
+
+def display_album(art_url, cache=None):
     if art_url is None or art_url == '':
         return
     (term_w, term_h) = click.get_terminal_size()
-    art = gen_art(art_url, term_w, term_h)
+    art = gen_art(art_url, term_w, term_h, cache=cache)
     if art is None:
         return
     print("")